@@ -1,15 +1,25 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 from __future__ import print_function
 import re
 import subprocess
 import argparse
-from distutils.version import LooseVersion
+from multiprocessing.pool import ThreadPool
 import requests
-from datetime import datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from datetime import datetime, timedelta
 import json
+import os
 import sys
 
 DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RULE_KEYS = ("repositories", "include", "exclude", "keep", "keep_last", "keep_newer_than",
+             "before", "after", "order")
+DEFAULT_KEEP_LAST = 5
+DURATION_UNITS = {"s": "seconds", "m": "minutes", "h": "hours", "d": "days", "w": "weeks"}
+NON_VERSION_CHARS = re.compile('[^0-9.]')
+VERSION_NUMBERS = re.compile('[0-9]+')
 
 # taken from http://stackoverflow.com/questions/25470844/specify-format-for-input-arguments-argparse-python#answer-25470943
 def valid_date(date_str):
@@ -19,27 +29,290 @@ def valid_date(date_str):
         msg = "Not a valid date: '{0}'.".format(date_str)
         raise argparse.ArgumentTypeError(msg)
 
-def get_created_date_for_tag(tag, repository, auth, args):
+def version_key(tag):
+    """sort key ordering tags like LooseVersion of the tag with every non-digit, non-dot turned into 9"""
+    return tuple(int(number) for number in VERSION_NUMBERS.findall(NON_VERSION_CHARS.sub('9', tag)))
+
+def parse_duration(value):
+    """timedelta of a duration like 90m, 12h, 30d or 2w"""
+    match = re.match(r'^\s*([0-9]+)\s*([smhdw])\s*$', str(value))
+    if not match:
+        raise ValueError("Not a valid duration: '{0}', use e.g. 12h, 30d or 2w.".format(value))
+    return timedelta(**{DURATION_UNITS[match.group(2)]: int(match.group(1))})
+
+def compile_rule(rule, now):
+    """check a retention rule and compile its patterns and dates once"""
+    unknown = set(rule) - set(RULE_KEYS)
+    if unknown:
+        raise ValueError("Unknown keys in retention rule: {0}".format(", ".join(sorted(unknown))))
+    if rule.get("order", "name") not in ("name", "date"):
+        raise ValueError("Retention rule order must be 'name' or 'date': {0}".format(rule["order"]))
+    compiled = {
+        "repositories": re.compile(rule.get("repositories") or ""),
+        "order": rule.get("order", "name"),
+        "keep_last": int(rule.get("keep_last", DEFAULT_KEEP_LAST)),
+        "keep_newer_than": None,
+    }
+    for key in ("include", "exclude", "keep"):
+        compiled[key] = re.compile(rule[key]) if rule.get(key) else None
+    for key in ("before", "after"):
+        value = rule.get(key)
+        compiled[key] = value if value is None or isinstance(value, datetime) else datetime.strptime(value, DATE_FORMAT)
+    if rule.get("keep_newer_than"):
+        compiled["keep_newer_than"] = now - parse_duration(rule["keep_newer_than"])
+    return compiled
+
+def load_policy(path, now):
+    """compiled rules of a retention policy file, in the order they are tried for each repository"""
+    with open(path) as policy_file:
+        policy = json.load(policy_file)
+    if not isinstance(policy, dict):
+        raise ValueError("Retention policy {0} is not a JSON object".format(path))
+    rules = policy.get("rules")
+    if not rules:
+        raise ValueError("Retention policy {0} has no rules".format(path))
+    if not isinstance(rules, list):
+        raise ValueError("Retention policy {0} needs a list of rules".format(path))
+    for rule in rules:
+        if not isinstance(rule, dict):
+            raise ValueError("Every retention rule needs to be a JSON object: {0}".format(rule))
+        if not rule.get("repositories"):
+            raise ValueError("Every retention rule needs a 'repositories' regexp: {0}".format(rule))
+    return [compile_rule(rule, now) for rule in rules]
+
+def rule_from_args(args, now):
+    """the retention rule given by the command line options"""
+    return compile_rule({
+        "repositories": args.image,
+        "include": args.include,
+        "exclude": args.exclude,
+        "keep_last": DEFAULT_KEEP_LAST if args.last is None else args.last,
+        "before": args.before,
+        "after": args.after,
+        "order": args.order,
+    }, now)
+
+def rule_for(rules, repository):
+    """the first rule applying to `repository`, None if there is none"""
+    for rule in rules:
+        if rule["repositories"].search(repository):
+            return rule
+    return None
+
+def candidate_tags(rule, tags):
+    """tags the rule may delete, sorted by name"""
+    include, exclude, keep = rule["include"], rule["exclude"], rule["keep"]
+    candidates = [tag for tag in tags
+                  if (not exclude or not exclude.search(tag)) and
+                  (not include or include.search(tag)) and
+                  (not keep or not keep.search(tag))]
+    candidates.sort(key=version_key)
+    return candidates
+
+def needs_dates(rule):
+    return rule["order"] == "date" or bool(rule["before"] or rule["after"] or rule["keep_newer_than"])
+
+def tags_needing_dates(rule, tags):
+    """tags whose creation date the rule looks at"""
+    candidates = candidate_tags(rule, tags)
+    if rule["order"] == "date":
+        return candidates
+    if needs_dates(rule):
+        return candidates[:-rule["keep_last"]] if rule["keep_last"] > 0 else candidates
+    return []
+
+def select_tags(rule, tags, created_dates):
+    """tags the rule deletes, given the creation dates of the tags it needs them for
+
+    Tags are sorted by name or date and all but the last `keep_last` are
+    deleted, except those newer than `keep_newer_than`, outside of the
+    `before`/`after` window or without a known creation date.
+    """
+    candidates = candidate_tags(rule, tags)
+    if rule["order"] == "date":
+        # tags without a date sort last, so they are kept
+        candidates.sort(key=lambda tag: (created_dates.get(tag) is None, created_dates.get(tag) or datetime.min))
+    if rule["keep_last"] > 0:
+        candidates = candidates[:-rule["keep_last"]]
+    if not needs_dates(rule):
+        return candidates
+    selected = []
+    for tag in candidates:
+        created = created_dates.get(tag)
+        if created is None:
+            continue
+        if rule["keep_newer_than"] and created > rule["keep_newer_than"]:
+            continue
+        if (not rule["before"] or created < rule["before"]) and (not rule["after"] or created > rule["after"]):
+            selected.append(tag)
+    return selected
+
+def evaluate_policy(rules, catalog):
+    """(repository, tag) of every tag to delete from a catalog, in one pass over all repositories"""
+    targets = []
+    for repository, entry in catalog.items():
+        rule = rule_for(rules, repository)
+        if rule is None or not entry.get("tags"):
+            continue
+        created_dates = dict((tag, datetime.strptime(created, DATE_FORMAT))
+                             for tag, created in entry.get("created", {}).items())
+        targets.extend((repository, tag) for tag in select_tags(rule, entry["tags"], created_dates))
+    return targets
+
+def fetch_catalog(session, rules, args, date_cache=None, all_dates=False):
+    """repository -> {"tags": [...], "created": {tag: date}} of every repository a rule applies to
+
+    Tag lists and then the creation dates needed by the rules (or all of
+    them with `all_dates`) are fetched for all repositories at once.
+    """
+    response = session.get(args.registry_url + "/v2/_catalog")
+    nextQuery = get_paginate_query(response)
+    repositories = response.json()["repositories"]
+    while nextQuery is not None:
+        response = session.get(args.registry_url + nextQuery)
+        repositories.extend(response.json()['repositories'])
+        nextQuery = get_paginate_query(response)
+
+    repositories = [repository for repository in repositories if rule_for(rules, repository) is not None]
+    tags_by_repository = fetch_concurrently(lambda repository: get_tags(session, repository, args),
+                                            repositories, args)
+    catalog = dict((repository, {"tags": tags, "created": {}})
+                   for repository, tags in zip(repositories, tags_by_repository))
+
+    needed = []
+    for repository, tags in zip(repositories, tags_by_repository):
+        if tags:
+            dated = tags if all_dates else tags_needing_dates(rule_for(rules, repository), tags)
+            needed.extend((repository, tag) for tag in dated)
+    dates = fetch_concurrently(
+        lambda item: get_created_date_for_tag(session, item[1], item[0], args, date_cache),
+        needed, args)
+    for (repository, tag), created in zip(needed, dates):
+        catalog[repository]["created"][tag] = created.strftime(DATE_FORMAT)
+    return catalog
+
+def load_catalog(path):
+    """catalog saved with save_catalog"""
+    with open(path) as catalog_file:
+        return json.load(catalog_file)["repositories"]
+
+def save_catalog(path, catalog, registry_url):
+    """write the catalog atomically, to evaluate policies against it offline later"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as catalog_file:
+        json.dump({"registry_url": registry_url, "saved": datetime.utcnow().strftime(DATE_FORMAT),
+                   "repositories": catalog}, catalog_file, sort_keys=True, indent=1)
+    os.rename(tmp_path, path)
+
+def create_session(auth, args):
+    """one keep-alive session for all requests, retrying 429 and 5xx with backoff"""
+    session = requests.Session()
+    session.auth = auth
+    session.verify = args.no_check_certificate
+    retry = Retry(total=args.retries, backoff_factor=args.backoff,
+                  status_forcelist=RETRY_STATUSES)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=args.concurrency, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def fetch_concurrently(func, items, args):
+    """apply `func` to every item in order, with at most args.concurrency requests in flight"""
+    items = list(items)
+    if args.concurrency <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    pool = ThreadPool(min(args.concurrency, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+def load_date_cache(path):
+    """read the manifest digest -> creation date cache, empty if there is none yet"""
+    if not path or not os.path.isfile(path):
+        return {}
+    with open(path) as cache_file:
+        return json.load(cache_file)
+
+def save_date_cache(path, date_cache):
+    """write the date cache atomically, so an interrupted run cannot corrupt it"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as cache_file:
+        json.dump(date_cache, cache_file, sort_keys=True, indent=0)
+    os.rename(tmp_path, path)
+
+def get_created_date_for_tag(session, tag, repository, args, date_cache=None):
     headers = {'Accept': 'application/vnd.docker.distribution.manifest.v2+json'}
+    url = args.registry_url + "/v2/" + repository + "/manifests/" + tag
+
+    # config blobs are immutable per manifest digest, so a cached date never goes stale
+    manifest_digest = None
+    if date_cache is not None:
+        manifest_digest = session.head(url, headers=headers).headers.get("Docker-Content-Digest")
+        if manifest_digest in date_cache:
+            return datetime.strptime(date_cache[manifest_digest], DATE_FORMAT)
 
-    response = requests.get(args.registry_url + "/v2/" + repository + "/manifests/" + tag,
-                            auth=auth, verify=args.no_check_certificate, headers=headers)
+    response = session.get(url, headers=headers)
+    manifest_digest = response.headers.get("Docker-Content-Digest", manifest_digest)
 
     if response.json()['schemaVersion'] == 1:
         created_str = json.loads(response.json()['history'][0]['v1Compatibility'])['created'].split(".")[0]
     elif response.json()['schemaVersion'] == 2:
         digest = response.json()["config"]["digest"]
-        response = requests.get(args.registry_url + "/v2/" + repository + "/blobs/" + digest,
-                                auth=auth, verify=args.no_check_certificate, headers=headers)
+        response = session.get(args.registry_url + "/v2/" + repository + "/blobs/" + digest,
+                               headers=headers)
         created_str = response.json()['created'].split(".")[0]
+    if date_cache is not None and manifest_digest:
+        date_cache[manifest_digest] = created_str
     return(datetime.strptime(created_str,DATE_FORMAT))
 
+def get_tags(session, repository, args):
+    """list tags of `repository`, None if it has none"""
+    response = session.get(args.registry_url + "/v2/" + repository + "/tags/list")
+    return response.json().get("tags")
+
 def get_paginate_query(response):
     if 'Link' in response.headers:
         return response.headers['Link'].split('; ')[0][:-1][1:]
     else:
         return None
 
+def load_cleaner_module(script_path):
+    """import delete_docker_registry_image from `script_path` to run it in-process"""
+    from importlib.machinery import SourceFileLoader
+    import importlib.util
+    loader = SourceFileLoader("delete_docker_registry_image", script_path)
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+def delete_tags_in_process(targets, args):
+    """delete all (repository, tag) targets with one RegistryCleaner"""
+    cleaner_module = load_cleaner_module(args.script_path)
+    cleaner_module.setup_logging(args.verbose)
+    try:
+        cleaner = cleaner_module.RegistryCleaner(args.registry_data_dir, dry_run=args.dry_run)
+        cleaner.delete_images(targets)
+        cleaner.execute_plan()
+        cleaner.log_cache_stats()
+    except cleaner_module.RegistryCleanerError as error:
+        cleaner_module.logger.fatal(error)
+        sys.exit(1)
+
+def delete_tags_in_batch(targets, args):
+    """delete all (repository, tag) targets with one run of the delete script"""
+    command2run = "{0} --batch -".format(args.script_path)
+    if args.dry_run:
+        command2run += " --dry-run"
+    print("Running: {0}".format(command2run))
+    process = subprocess.Popen(command2run, shell=True, stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    images = "".join("{0}:{1}\n".format(repository, tag) for repository, tag in targets)
+    out = process.communicate(images.encode())[0]
+    print(out.decode())
+
 def main():
     """cli entrypoint"""
     parser = argparse.ArgumentParser(description="Cleanup docker registry")
@@ -51,8 +324,11 @@ def main():
                         help="Regexp to include tags")
     parser.add_argument("-i", "--image",
                         dest="image",
-                        required=True,
-                        help="Docker image to cleanup")
+                        help="Regexp of the repositories to cleanup")
+    parser.add_argument("--policy",
+                        dest="policy",
+                        help="JSON retention policy file with a rule per repository regexp, " +
+                             "instead of -i/-e/-E/-l/-b/-a/-o")
     parser.add_argument("-v", "--verbose",
                         dest="verbose",
                         action="store_true",
@@ -65,6 +341,17 @@ def main():
                         dest="script_path",
                         default="/usr/local/bin/delete_docker_registry_image",
                         help="delete_docker_registry_image full script path")
+    parser.add_argument("--in-process",
+                        dest="in_process",
+                        action="store_true",
+                        help="Import the delete_docker_registry_image script and delete all tags " +
+                             "in this process instead of running it")
+    parser.add_argument("--registry-data-dir",
+                        dest="registry_data_dir",
+                        default=os.environ.get("REGISTRY_DATA_DIR",
+                                               "/opt/registry_data/docker/registry/v2"),
+                        help="Registry data directory used with --in-process " +
+                             "(defaults to $REGISTRY_DATA_DIR)")
     parser.add_argument("-l", "--last",
                         dest="last",
                         type=int,
@@ -96,89 +383,76 @@ def main():
                         help="Password for auth")
     parser.add_argument("--no_check_certificate",
                         action='store_false')
+    parser.add_argument("-c", "--concurrency",
+                        dest="concurrency",
+                        type=int,
+                        default=8,
+                        help="Maximum number of concurrent requests to the registry")
+    parser.add_argument("--retries",
+                        dest="retries",
+                        type=int,
+                        default=5,
+                        help="Retries for requests failing with 429 or 5xx status")
+    parser.add_argument("--backoff",
+                        dest="backoff",
+                        type=float,
+                        default=0.5,
+                        help="Backoff factor in seconds between retries, doubled on each retry")
+    parser.add_argument("--date-cache",
+                        dest="date_cache",
+                        help="JSON file caching tag creation dates by manifest digest across runs")
+    parser.add_argument("--save-catalog",
+                        dest="save_catalog",
+                        help="Write the repositories, tags and tag creation dates fetched to this JSON file")
+    parser.add_argument("--catalog",
+                        dest="catalog",
+                        help="Evaluate the tags to delete against a file written by --save-catalog " +
+                             "instead of querying the registry")
     parser.add_argument("--dry-run",
                         dest='dry_run',
                         action='store_true',
                         help="Dry run - show which tags would have been deleted but do not delete them")
     args = parser.parse_args()
 
-    # Get catalog
-    if args.user and args.password:
-        auth = (args.user, args.password)
-    else:
-        auth = None
-    response = requests.get(args.registry_url + "/v2/_catalog",
-                            auth=auth, verify=args.no_check_certificate)
+    if not args.image and not args.policy:
+        parser.error("one of the arguments -i/--image --policy is required")
+    # creation dates are in UTC, as the registry reports them
+    now = datetime.utcnow()
+    try:
+        rules = load_policy(args.policy, now) if args.policy else [rule_from_args(args, now)]
+    except (IOError, OSError, ValueError, re.error) as error:
+        parser.error("invalid retention policy: {0}".format(error))
 
-    nextQuery = get_paginate_query(response)
-    repositories = response.json()["repositories"]
+    if args.catalog:
+        catalog = load_catalog(args.catalog)
+    else:
+        if args.user and args.password:
+            auth = (args.user, args.password)
+        else:
+            auth = None
+        session = create_session(auth, args)
+        date_cache = load_date_cache(args.date_cache) if args.date_cache else None
+        catalog = fetch_catalog(session, rules, args, date_cache, all_dates=bool(args.save_catalog))
+        if date_cache is not None:
+            save_date_cache(args.date_cache, date_cache)
+    if args.save_catalog:
+        save_catalog(args.save_catalog, catalog, args.registry_url)
 
-    while nextQuery is not None:
-        response = requests.get(args.registry_url + nextQuery,
-                                auth=auth, verify=args.no_check_certificate)
-        repositories.extend(response.json()['repositories'])
-        nextQuery = get_paginate_query(response)
+    for repository, entry in catalog.items():
+        if entry.get("tags") is None and rule_for(rules, repository):
+            print("No tags availables for " + repository)
+    targets = evaluate_policy(rules, catalog)
+    if args.dry_run:
+        for repository, tag in targets:
+            print("Simulate deletion of {0}:{1}".format(repository, tag))
 
-    # For each repository check it matches with args.image
-    for repository in repositories:
-        if re.search(args.image, repository):
-            # Get tags
-            response = requests.get(args.registry_url + "/v2/" + repository + "/tags/list",
-                                    auth=auth, verify=args.no_check_certificate)
-
-            tags = None
-            if "tags" in response.json().keys():
-                tags = response.json()["tags"]
-
-            # For each tag, check it does not matches with args.exclude
-            matching_tags = []
-            if tags is not None:
-                for tag in tags:
-                    if not args.exclude or not re.search(args.exclude, tag):
-                        if not args.include or re.search(args.include, tag):
-                            matching_tags.append(tag)
-
-                # Sort tags
-                if args.order == 'name':
-                    order_fn = lambda s: LooseVersion(re.sub('[^0-9.]', '9', s))
-                else:
-                    order_fn = lambda s: get_created_date_for_tag(s, repository, auth, args)
-
-                matching_tags.sort(key=order_fn)
-
-                # Set number of last tags to keep to the default value of 5
-                # if 'last' is not set
-                if args.last is None:
-                    args.last = 5
-
-                # Delete all except N last items
-                if args.last is not None and args.last > 0:
-                    matching_tags = matching_tags[:-args.last]
-                else:
-                    matching_tags = matching_tags
-
-                tags_to_delete = []
-                if args.before or args.after:
-                    for tag in matching_tags:
-                        created = get_created_date_for_tag(tag, repository, auth, args)
-
-                        if (not args.before or created < args.before) and (not args.after or created > args.after) :
-                            tags_to_delete.append(tag)
-                else:
-                    tags_to_delete = matching_tags
-
-                for tag in tags_to_delete:
-                    command2run = "{0} --image {1}:{2}". \
-                        format(args.script_path, repository, tag)
-                    if args.dry_run :
-                        print("Simulate deletion of {0}:{1}".format(repository, tag))
-                        command2run += " --dry-run"
-                    print("Running: {0}".format(command2run))
-                    out = subprocess.Popen(command2run, shell=True, stdout=subprocess.PIPE,
-                                           stderr=subprocess.STDOUT).stdout.read()
-                    print(out)
-            else:
-                print("No tags availables for " + repository)
+    # Delete all collected tags at once so the registry is only scanned one time
+    if not targets:
+        print("No tags to delete")
+    elif args.in_process:
+        delete_tags_in_process(targets, args)
+    else:
+        delete_tags_in_batch(targets, args)
 
 
 if __name__ == '__main__':
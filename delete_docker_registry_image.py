@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 """
 Usage:
 Shut down your registry service to avoid race conditions and possible data loss
@@ -6,101 +6,1409 @@ and then run the command with an image repo like this:
 delete_docker_registry_image.py --image awesomeimage --dry-run
 """
 
+import sys
+
+if sys.version_info < (3, 7):
+    sys.exit("delete_docker_registry_image.py needs Python 3.7 or newer")
+
 import argparse
+import base64
+import binascii
+import ctypes
+import ctypes.util
+import errno
+import http.client
+import io
+import ipaddress
 import json
 import logging
+import multiprocessing
 import os
-import sys
+import re
+import select
+import signal
 import shutil
-import glob
+import hashlib
+import itertools
+import socketserver
+import sqlite3
+import struct
+import threading
+import time
+from collections import Counter, OrderedDict, namedtuple
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing.pool import ThreadPool
+from urllib.parse import quote, unquote, urlparse
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_MANIFEST_CACHE_SIZE = 10000
+
+
+class Stats(object):
+    """time spent per phase and counts of filesystem operations of a run, shared by all threads"""
+
+    COUNTERS = ("directories_listed", "files_opened", "json_bytes_parsed",
+                "paths_planned", "paths_deleted", "bytes_deleted")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
 
-def del_empty_dirs(s_dir, top_level):
-    """recursively delete empty directories"""
-    b_empty = True
+    def reset(self):
+        with self._lock:
+            self.counters = OrderedDict((name, 0) for name in self.COUNTERS)
+            # phase -> [seconds, calls]
+            self.phases = OrderedDict()
 
-    for s_target in os.listdir(s_dir):
-        s_path = os.path.join(s_dir, s_target)
-        if os.path.isdir(s_path):
-            if not del_empty_dirs(s_path, False):
-                b_empty = False
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    @contextmanager
+    def timer(self, phase):
+        """add the time spent inside the with block to `phase`"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            with self._lock:
+                entry = self.phases.setdefault(phase, [0.0, 0])
+                entry[0] += elapsed
+                entry[1] += 1
+
+    def as_dict(self):
+        return {
+            "phases": dict((phase, {"seconds": seconds, "calls": calls})
+                           for phase, (seconds, calls) in self.phases.items()),
+            "counters": dict(self.counters),
+        }
+
+    def log_summary(self):
+        """log every phase, slowest first, and every counter"""
+        for phase, (seconds, calls) in sorted(self.phases.items(), key=lambda item: -item[1][0]):
+            logger.info("Stats: %-20s %10.3fs in %d calls", phase, seconds, calls)
+        for name, value in self.counters.items():
+            logger.info("Stats: %-20s %d", name, value)
+
+    def to_prometheus(self, success):
+        """the stats in the Prometheus text format, for the node-exporter textfile collector"""
+        lines = [
+            "# HELP registry_cleaner_phase_seconds Seconds spent in each phase of the last run.",
+            "# TYPE registry_cleaner_phase_seconds gauge",
+        ]
+        lines.extend('registry_cleaner_phase_seconds{{phase="{0}"}} {1:.6f}'.format(phase, seconds)
+                     for phase, (seconds, _) in self.phases.items())
+        lines.extend([
+            "# HELP registry_cleaner_phase_calls Times each phase was entered in the last run.",
+            "# TYPE registry_cleaner_phase_calls gauge",
+        ])
+        lines.extend('registry_cleaner_phase_calls{{phase="{0}"}} {1}'.format(phase, calls)
+                     for phase, (_, calls) in self.phases.items())
+        for name, value in self.counters.items():
+            lines.extend([
+                "# HELP registry_cleaner_{0} {1} in the last run.".format(name, name.replace("_", " ").capitalize()),
+                "# TYPE registry_cleaner_{0} gauge".format(name),
+                "registry_cleaner_{0} {1}".format(name, value),
+            ])
+        lines.extend([
+            "# HELP registry_cleaner_last_run_success Whether the last run succeeded.",
+            "# TYPE registry_cleaner_last_run_success gauge",
+            "registry_cleaner_last_run_success {0}".format(int(success)),
+            "# HELP registry_cleaner_last_run_timestamp_seconds When the last run finished.",
+            "# TYPE registry_cleaner_last_run_timestamp_seconds gauge",
+            "registry_cleaner_last_run_timestamp_seconds {0:.3f}".format(time.time()),
+        ])
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, success):
+        """write the stats to `path` atomically, in the Prometheus text format if it ends in .prom"""
+        if path.endswith(".prom"):
+            content = self.to_prometheus(success)
         else:
-            b_empty = False
+            data = self.as_dict()
+            data["success"] = success
+            data["timestamp"] = time.time()
+            content = json.dumps(data, indent=2, sort_keys=True) + "\n"
+        # the textfile collector must never see a half written file
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as out:
+            out.write(content)
+        os.rename(tmp_path, path)
+
+
+stats = Stats()
 
-    if b_empty:
-        logger.debug("Deleting empty directory '%s'", s_dir)
-        if not top_level:
-            os.rmdir(s_dir)
 
-    return b_empty
+def timed(phase):
+    """decorator adding the time spent in a function to `phase` of the stats"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stats.timer(phase):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
 
 
-def get_layers_from_blob(path):
-    """parse json blob and get set of layer digests"""
+def parallel_map(func, items, jobs=1):
+    """apply `func` to every item in order, on up to `jobs` threads"""
+    items = list(items)
+    if jobs <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    pool = ThreadPool(min(jobs, len(items)))
     try:
-        with open(path, "r") as blob:
-            data_raw = blob.read()
-            data = json.loads(data_raw)
-            if data["schemaVersion"] == 1:
-                result = set([entry["blobSum"].split(":")[1] for entry in data["fsLayers"]])
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def scan_dir(path, follow_symlinks=False):
+    """split the entries of `path` into (subdirectory paths, file paths), reusing d_type
+
+    Symlinks to directories count as files, like in os.walk, unless
+    `follow_symlinks` is set, like os.path.isdir.
+    """
+    dirs = []
+    files = []
+    stats.count("directories_listed")
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=follow_symlinks):
+                dirs.append(entry.path)
             else:
-                result = set([entry["digest"].split(":")[1] for entry in data["layers"]])
-                if "config" in data:
-                    result.add(data["config"]["digest"].split(":")[1])
-            return result
+                files.append(entry.path)
+    return dirs, files
+
+
+def list_dir(path):
+    """os.listdir, counted in the stats"""
+    stats.count("directories_listed")
+    return os.listdir(path)
+
+
+def del_empty_dirs(s_dir, top_level, jobs=1):
+    """delete empty directories below `s_dir` in one bottom-up pass, return whether it is empty
+
+    The tree is walked with an explicit stack, so its depth is not limited by
+    Python's recursion limit; with `jobs` > 1 each subdirectory of `s_dir` is
+    handled on its own thread.
+    """
+    if jobs > 1:
+        dirs, files = scan_dir(s_dir)
+        results = parallel_map(lambda s_path: del_empty_dirs(s_path, False), dirs, jobs)
+        b_empty = not files and all(results)
+        if b_empty:
+            logger.debug("Deleting empty directory '%s'", s_dir)
+            if not top_level:
+                os.rmdir(s_dir)
+        return b_empty
+
+    # a frame is [path, parent frame, whether anything is kept below path]
+    root = [s_dir, None, False]
+    stack = [(root, False)]
+    while stack:
+        frame, visited = stack.pop()
+        s_path, parent, keep = frame
+        if not visited:
+            try:
+                dirs, files = scan_dir(s_path)
+            except OSError as error:
+                logger.warning("Not pruning %s: %s", s_path, error)
+                dirs, files = [], [s_path]
+            frame[2] = bool(files)
+            stack.append((frame, True))
+            stack.extend(([s_dir_child, frame, False], False) for s_dir_child in reversed(dirs))
+        elif keep:
+            if parent is not None:
+                parent[2] = True
+        else:
+            logger.debug("Deleting empty directory '%s'", s_path)
+            if parent is not None or not top_level:
+                os.rmdir(s_path)
+    return not root[2]
+
+
+def del_empty_parents(paths, top_dir):
+    """delete the parents of deleted `paths` that are now empty, walking up to `top_dir`"""
+    top_dir = os.path.normpath(top_dir)
+    by_depth = {}
+    for path in paths:
+        s_dir = os.path.dirname(os.path.normpath(path))
+        by_depth.setdefault(s_dir.count(os.sep), set()).add(s_dir)
+    # deepest first, so a directory is only looked at after its emptied children are gone
+    depth = max(by_depth) if by_depth else 0
+    while depth > 0:
+        for s_dir in sorted(by_depth.pop(depth, ())):
+            if s_dir == top_dir or not s_dir.startswith(top_dir + os.sep):
+                continue
+            try:
+                os.rmdir(s_dir)
+            except OSError:
+                continue
+            logger.debug("Deleted empty directory '%s'", s_dir)
+            by_depth.setdefault(depth - 1, set()).add(os.path.dirname(s_dir))
+        depth -= 1
+
+
+SCHEMA_VERSION = re.compile(rb'"schemaVersion"\s*:\s*(\d+)')
+BLOB_SUM_FIELD = re.compile(rb'"blobSum"\s*:\s*"sha256:([0-9a-f]{64})"')
+DIGEST_FIELD = re.compile(rb'"digest"\s*:\s*"sha256:([0-9a-f]{64})"')
+MANIFEST_BATCH_SIZE = 256
+
+Manifest = namedtuple("Manifest", ["layers", "children"])
+
+
+def scan_manifest(data):
+    """(layer digests, child manifest digests) picked out of manifest bytes without parsing them
+
+    Only handles the layouts the registry writes: schema 1 manifests with
+    fsLayers before history, image manifests with a config and layers, and
+    manifest lists or OCI image indexes listing child manifests. Returns None
+    for anything else, e.g. escaped keys, a subject or fields counted
+    differently than expected.
+    """
+    version = SCHEMA_VERSION.search(data)
+    if version is None:
+        return None
+    if version.group(1) == b"1":
+        # the history holds escaped JSON strings, so everything needed comes before it
+        end = data.find(b'"history"')
+        head = data[:end]
+        blob_sums = BLOB_SUM_FIELD.findall(head)
+        if (end < 0 or not blob_sums or b'"fsLayers"' not in head or b"\\u" in head
+                or head.count(b'"blobSum"') != len(blob_sums)):
+            return None
+        return set(digest.decode() for digest in blob_sums), set()
+    if (version.group(1) != b"2" or data.count(b'"schemaVersion"') != 1 or b"\\u" in data
+            or b'"subject"' in data):
+        return None
+    digests = DIGEST_FIELD.findall(data)
+    # every descriptor has exactly one digest and one size
+    if data.count(b'"digest"') != len(digests) or data.count(b'"size"') != len(digests):
+        return None
+    digests = set(digest.decode() for digest in digests)
+    has_layers = b'"layers"' in data
+    if b'"manifests"' in data:
+        return (set(), digests) if not has_layers else None
+    return (digests, set()) if has_layers and b'"config"' in data else None
+
+
+def parse_manifest(data):
+    """(layer digests, child manifest digests, whether scan_manifest sufficed) of manifest bytes
+
+    Layers include the config blob; child manifests are those of a manifest
+    list or OCI image index. Raises on anything that is not a manifest.
+    """
+    scanned = scan_manifest(data)
+    if scanned is not None:
+        return scanned + (True,)
+    document = json.loads(data.decode("utf-8"))
+    if document["schemaVersion"] == 1:
+        return set(entry["blobSum"].split(":")[1] for entry in document["fsLayers"]), set(), False
+    if "manifests" in document:
+        return set(), set(entry["digest"].split(":")[1] for entry in document["manifests"]), False
+    layers = set(entry["digest"].split(":")[1] for entry in document["layers"])
+    if "config" in document:
+        layers.add(document["config"]["digest"].split(":")[1])
+    return layers, set(), False
+
+
+def pack_digests(digests):
+    """`digests` as one bytes object of 32 raw bytes each, or a tuple if one of them is not a hex sha256"""
+    if all(len(digest) == 64 for digest in digests):
+        try:
+            return b"".join(binascii.unhexlify(digest) for digest in digests)
+        except (TypeError, ValueError):
+            pass
+    return tuple(digests)
+
+
+def unpack_digests(packed):
+    """frozenset of the hex digests in what pack_digests returned, or in any other collection"""
+    if isinstance(packed, bytes):
+        return frozenset(binascii.hexlify(packed[i:i + 32]).decode() for i in range(0, len(packed), 32))
+    return frozenset(packed)
+
+
+def read_manifest(path, storage=None):
+    """(bytes read, layers, child manifests, whether scan_manifest sufficed) of a manifest blob
+
+    Returns None if the blob does not exist and the error as a string if it
+    cannot be parsed, so it can run in a worker process.
+    """
+    try:
+        if storage is None:
+            with open(path, "rb") as stream:
+                data = stream.read()
+        else:
+            data = storage.read_bytes(path)
+        layers, children, fast = parse_manifest(data)
+    except (IOError, OSError) as error:
+        if error.errno == errno.ENOENT:
+            return None
+        return str(error)
     except Exception as error:
-        logger.critical("Failed to read layers from blob:%s", error)
-        return set()
+        return "{0}: {1}".format(type(error).__name__, error)
+    return len(data), layers, children, fast
 
 
-def get_digest_from_blob(path):
+def read_manifests(paths):
+    """read_manifest of every local path in `paths` with packed digests, one batch of a process pool"""
+    result = []
+    for path in paths:
+        manifest = read_manifest(path)
+        if isinstance(manifest, tuple):
+            manifest = (manifest[0], pack_digests(manifest[1]), pack_digests(manifest[2]), manifest[3])
+        result.append(manifest)
+    return result
+
+
+def get_digest_from_blob(path, storage=None):
     """parse file and get digest"""
     try:
-        with open(path, "r") as blob:
-            return blob.read().split(":")[1]
+        stats.count("files_opened")
+        return (storage or local_storage).read(path).split(":")[1]
     except Exception as error:
         logger.critical("Failed to read digest from blob:%s", error)
         return ""
 
 
-def get_links(path, _filter=None):
-    """recursively walk `path` and parse every link inside"""
-    result = []
-    for root, _, files in os.walk(path):
-        for each in files:
-            if each == "link":
-                filepath = os.path.join(root, each)
-                if not _filter or _filter in filepath:
-                    result.append(get_digest_from_blob(filepath))
+def iter_link_paths(path, storage=None):
+    """recursively walk `path` and yield the path of every link inside"""
+    for filepath in (storage or local_storage).walk_files(path):
+        if os.path.basename(filepath) == "link":
+            yield filepath
+
+
+def get_links(path, _filter=None, jobs=1, storage=None):
+    """recursively walk `path` and parse every link inside, one subdirectory per thread"""
+    storage = storage or local_storage
+
+    def parse(paths):
+        paths = [filepath for filepath in paths if not _filter or _filter in filepath]
+        return storage.map(lambda filepath: get_digest_from_blob(filepath, storage), paths)
+
+    if jobs <= 1:
+        return parse(iter_link_paths(path, storage))
+    try:
+        dirs, files = storage.scan_dir(path)
+    except OSError:
+        return []
+    result = parse(f for f in files if os.path.basename(f) == "link")
+    for links in parallel_map(lambda subdir: parse(iter_link_paths(subdir, storage)), dirs, jobs):
+        result.extend(links)
     return result
 
 
+# blob and link directories the registry writes exactly one file into
+LEAF_DIR = re.compile(r"/(blobs/sha256/[0-9a-f]{2}|_layers/sha256|_manifests/tags/[^/]+/index/sha256)/[0-9a-f]{64}$")
+
+
+def leaf_file(path):
+    """the one file inside a blob, layer link or tag index directory, None for any other directory
+
+    Revision directories are not included, older registries keep signatures in them.
+    """
+    match = LEAF_DIR.search(path)
+    if match is None:
+        return None
+    return os.path.join(path, "data" if match.group(1).startswith("blobs/") else "link")
+
+
+def get_link_entry(relpath):
+    """split a link path relative to the repositories directory into (repo, kind)"""
+    parts = relpath.split(os.sep)
+    for i, part in enumerate(parts):
+        if part.startswith("_"):
+            break
+    else:
+        return None
+    repo = "/".join(parts[:i])
+    rest = parts[i:]
+    if rest[0] == "_layers":
+        return repo, "layer"
+    if rest[0] == "_manifests" and len(rest) > 3:
+        if rest[1] == "revisions":
+            return repo, "revision"
+        if rest[1] == "tags":
+            return repo, "tag" if rest[3] == "current" else "tag_index"
+    return None
+
+
+def pack_digest(digest):
+    """32 raw bytes of a hex sha256 digest, or the digest itself if it is not hex"""
+    try:
+        return binascii.unhexlify(digest)
+    except (TypeError, ValueError):
+        return digest
+
+
+def unpack_digest(packed):
+    """inverse of pack_digest"""
+    return binascii.hexlify(packed).decode() if isinstance(packed, bytes) else packed
+
+
+class DigestSet(object):
+    """set of sha256 digests held as 32 raw bytes instead of 64 character strings"""
+
+    def __init__(self, digests=()):
+        self._digests = set()
+        self.update(digests)
+
+    def __len__(self):
+        return len(self._digests)
+
+    def __contains__(self, digest):
+        return pack_digest(digest) in self._digests
+
+    def __iter__(self):
+        for packed in self._digests:
+            yield unpack_digest(packed)
+
+    def add(self, digest):
+        """add one hex digest"""
+        self._digests.add(pack_digest(digest))
+
+    def update(self, digests):
+        """add every hex digest of `digests`"""
+        self._digests.update(pack_digest(digest) for digest in digests)
+
+
+class LinkIndex(object):
+    """reverse index of every link in the registry: digest -> (repo, kind) of each link
+
+    Digests are kept as 32 raw bytes. A digest linked once, like most layers,
+    maps straight to one shared (repo, kind) key, so millions of links fit in
+    little memory; a digest linked more than once maps to a dict counting the
+    links of each key, so adding and discarding a link never copies the others.
+    """
+
+    def __init__(self):
+        self._refs = {}
+        self._keys = {}
+
+    def __len__(self):
+        return len(self._refs)
+
+    def _key(self, repo, kind):
+        """one shared (repo, kind) tuple for all links of that repository and kind"""
+        key = (repo, kind)
+        return self._keys.setdefault(key, key)
+
+    @staticmethod
+    def _counts(entries):
+        """key -> number of links of a `_refs` value"""
+        return entries if isinstance(entries, dict) else {entries: 1}
+
+    def add(self, digest, repo, kind):
+        """record one link to `digest`"""
+        packed = pack_digest(digest)
+        key = self._key(repo, kind)
+        entries = self._refs.get(packed)
+        if entries is None:
+            self._refs[packed] = key
+        elif isinstance(entries, dict):
+            entries[key] = entries.get(key, 0) + 1
+        else:
+            self._refs[packed] = {entries: 2} if entries == key else {entries: 1, key: 1}
+
+    def discard(self, digest, repo, kind):
+        """forget one link to `digest`, e.g. after it has been deleted"""
+        packed = pack_digest(digest)
+        entries = self._refs.get(packed)
+        key = (repo, kind)
+        if not isinstance(entries, dict):
+            if entries == key:
+                del self._refs[packed]
+            return
+        count = entries.get(key)
+        if count is None:
+            return
+        if count > 1:
+            entries[key] = count - 1
+        else:
+            del entries[key]
+        if len(entries) == 1:
+            (last, count), = entries.items()
+            if count == 1:
+                self._refs[packed] = last
+
+    def drop_repository(self, repo, digests):
+        """forget every link of `repo` to any of `digests`, e.g. to index it again"""
+        for digest in digests:
+            packed = pack_digest(digest)
+            entries = self._refs.get(packed)
+            if entries is None:
+                continue
+            kept = dict((key, count) for key, count in self._counts(entries).items() if key[0] != repo)
+            if not kept:
+                del self._refs[packed]
+            elif len(kept) == 1 and sum(kept.values()) == 1:
+                self._refs[packed] = next(iter(kept))
+            else:
+                self._refs[packed] = kept
+
+    def references(self, digest):
+        """set of (repo, kind) entries still linking to `digest`"""
+        entries = self._refs.get(pack_digest(digest))
+        return set() if entries is None else set(self._counts(entries))
+
+    def is_referenced(self, digest):
+        """check if any link to `digest` is left"""
+        return pack_digest(digest) in self._refs
+
+    def items(self):
+        """(digest, tuple of (repo, kind) of each link) for every linked digest"""
+        for packed, entries in self._refs.items():
+            if isinstance(entries, dict):
+                entries = tuple(key for key, count in entries.items() for _ in range(count))
+            else:
+                entries = (entries,)
+            yield unpack_digest(packed), entries
+
+    def digests(self, kind=None):
+        """every linked digest, or only those linked by a link of `kind`"""
+        return [unpack_digest(packed) for packed, entries in self._refs.items()
+                if kind is None or any(k == kind for _, k in self._counts(entries))]
+
+    def in_other_repository(self, digest, repo):
+        """check if a repository other than `repo` links to `digest`"""
+        entries = self._refs.get(pack_digest(digest))
+        return entries is not None and any(other != repo for other, _ in self._counts(entries))
+
+
+def repository_signature(repo_dir):
+    """fingerprint of the directory and tag link mtimes that change whenever a link of a repository does"""
+    tags_dir = os.path.join(repo_dir, "_manifests/tags")
+    try:
+        tags = sorted(list_dir(tags_dir))
+    except OSError:
+        tags = []
+    paths = [repo_dir, os.path.join(repo_dir, "_layers/sha256"),
+             os.path.join(repo_dir, "_manifests/revisions/sha256"), tags_dir]
+    for tag in tags:
+        paths.append(os.path.join(tags_dir, tag, "index/sha256"))
+        paths.append(os.path.join(tags_dir, tag, "current/link"))
+    parts = list(tags)
+    for path in paths:
+        try:
+            parts.append(str(os.stat(path).st_mtime_ns))
+        except OSError:
+            parts.append("-")
+    return hashlib.sha1("\n".join(parts).encode()).hexdigest()
+
+
+class LinkIndexStore(object):
+    """links of every repository persisted in SQLite, with the signature they were scanned at"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS repositories (name TEXT PRIMARY KEY, signature TEXT);
+        CREATE TABLE IF NOT EXISTS links (repository TEXT, repo TEXT, kind TEXT, digest BLOB);
+        CREATE INDEX IF NOT EXISTS links_repository ON links (repository);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        self.connection.executescript(self.SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def signatures(self):
+        """repository -> signature it was last scanned at"""
+        return dict(self.connection.execute("SELECT name, signature FROM repositories"))
+
+    def replace(self, repository, signature, links):
+        """store the (digest, repo, kind) links scanned from `repository`"""
+        with self.connection:
+            self.connection.execute("BEGIN")
+            self.connection.execute("DELETE FROM links WHERE repository = ?", (repository,))
+            self.connection.executemany(
+                "INSERT INTO links VALUES (?, ?, ?, ?)",
+                ((repository, repo, kind, pack_digest(digest)) for digest, repo, kind in links))
+            self.connection.execute("INSERT OR REPLACE INTO repositories VALUES (?, ?)",
+                                    (repository, signature))
+
+    def remove(self, repository):
+        """forget a repository that no longer exists"""
+        with self.connection:
+            self.connection.execute("BEGIN")
+            self.connection.execute("DELETE FROM links WHERE repository = ?", (repository,))
+            self.connection.execute("DELETE FROM repositories WHERE name = ?", (repository,))
+
+    def invalidate(self, repo):
+        """make the next run rescan `repo`; links are stored under the repository they are in"""
+        self.connection.execute("UPDATE repositories SET signature = NULL WHERE name = ?", (repo,))
+
+    def clear(self):
+        """drop everything, so the next refresh rescans all repositories"""
+        with self.connection:
+            self.connection.execute("BEGIN")
+            self.connection.execute("DELETE FROM links")
+            self.connection.execute("DELETE FROM repositories")
+
+    def links(self, repository):
+        """(digest, repo, kind) of every stored link of `repository`"""
+        return [(unpack_digest(bytes(digest)), repo, kind) for repo, kind, digest in
+                self.connection.execute("SELECT repo, kind, digest FROM links WHERE repository = ?",
+                                        (repository,))]
+
+
+class LRUCache(object):
+    """bounded mapping evicting the least recently used entry, counting hits and misses"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """look up `key` and mark it as recently used"""
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """store `key`, evicting the oldest entry when full"""
+        if self.maxsize <= 0:
+            return
+        self._data.pop(key, None)
+        self._data[key] = value
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+
+class LocalStorage(object):
+    """registry storage on a local or mounted filesystem
+
+    Every storage driver takes the same absolute paths below the registry
+    data directory. Directories only exist on storages with
+    `has_directories`, and `delete_chunk` is how many paths `delete_trees`
+    takes at once.
+    """
+
+    has_directories = True
+    delete_chunk = 1
+
+    def scan_dir(self, path, follow_symlinks=False):
+        """(subdirectory paths, file paths) in `path`, raising OSError if there is no such directory"""
+        return scan_dir(path, follow_symlinks)
+
+    def list_dir(self, path):
+        """names of the entries of `path`, raising OSError if there is no such directory"""
+        return list_dir(path)
+
+    def isdir(self, path):
+        return os.path.isdir(path)
+
+    def isfile(self, path):
+        return os.path.isfile(path)
+
+    def read(self, path):
+        """contents of the file at `path` as text"""
+        with open(path, "r") as stream:
+            return stream.read()
+
+    def read_bytes(self, path):
+        """contents of the file at `path`"""
+        with open(path, "rb") as stream:
+            return stream.read()
+
+    def size(self, path):
+        """size in bytes of the file at `path`, raising OSError if there is none"""
+        return os.path.getsize(path)
+
+    def walk_files(self, path):
+        """path of every file below `path`, nothing if there is no such directory"""
+        stack = [path]
+        while stack:
+            try:
+                dirs, files = scan_dir(stack.pop())
+            except OSError:
+                continue
+            for filepath in files:
+                yield filepath
+            stack.extend(reversed(dirs))
+
+    def file_sizes(self, path):
+        """(path, size) of every file below `path`"""
+        for filepath in self.walk_files(path):
+            try:
+                yield filepath, os.path.getsize(filepath)
+            except OSError:
+                continue
+
+    def map(self, func, items, jobs=1):
+        """apply `func` to every item on up to `jobs` threads, e.g. to read many files, in order"""
+        return parallel_map(func, items, jobs)
+
+    def delete_trees(self, paths):
+        """delete every path with everything below it, return None or the error for each path"""
+        errors = []
+        for path in paths:
+            try:
+                shutil.rmtree(path)
+            except Exception as error:
+                errors.append(error)
+            else:
+                errors.append(None)
+        return errors
+
+
+local_storage = LocalStorage()
+
+
+def is_s3_not_found(error):
+    """check if a botocore error is a 404 for a missing key"""
+    code = getattr(error, "response", {}).get("Error", {}).get("Code")
+    return code in ("404", "NoSuchKey", "NotFound")
+
+
+class S3Storage(object):
+    """registry storage in an S3 (compatible) bucket, as written by the registry's s3 storage driver
+
+    Paths map to keys by dropping the leading slash, so the registry data
+    directory is the driver's rootdirectory followed by /docker/registry/v2.
+    Directories are key prefixes. Whole prefixes are listed with paginated
+    ListObjectsV2 requests, `jobs` GETs run at once, and deleted keys are
+    batched into DeleteObjects requests of up to 1000 keys. Blob and link
+    directories are deleted by their one key, without listing them.
+    """
+
+    has_directories = False
+    delete_chunk = 1000
+    MAX_DELETE_KEYS = 1000
+
+    def __init__(self, bucket, client=None, endpoint_url=None, jobs=16):
+        if client is None:
+            try:
+                import boto3
+            except ImportError:
+                raise RegistryCleanerError("The S3 storage needs boto3, install it with: pip install boto3")
+            client = boto3.client("s3", endpoint_url=endpoint_url)
+        self.client = client
+        self.bucket = bucket
+        self.jobs = jobs
+
+    def _key(self, path):
+        return os.path.normpath(path).strip("/")
+
+    def _path(self, key):
+        return "/" + key.rstrip("/")
+
+    def _pages(self, path, delimiter=None):
+        """pages of a ListObjectsV2 listing of everything below `path`"""
+        kwargs = {"Bucket": self.bucket, "Prefix": self._key(path) + "/"}
+        if delimiter:
+            kwargs["Delimiter"] = delimiter
+        for page in self.client.get_paginator("list_objects_v2").paginate(**kwargs):
+            stats.count("s3_list_requests")
+            yield page
+
+    def scan_dir(self, path, follow_symlinks=False):
+        stats.count("directories_listed")
+        dirs = []
+        files = []
+        for page in self._pages(path, "/"):
+            dirs.extend(self._path(prefix["Prefix"]) for prefix in page.get("CommonPrefixes", ()))
+            files.extend(self._path(entry["Key"]) for entry in page.get("Contents", ()))
+        if not dirs and not files:
+            raise OSError(errno.ENOENT, "No such prefix in bucket {0}".format(self.bucket), path)
+        return dirs, files
+
+    def list_dir(self, path):
+        dirs, files = self.scan_dir(path)
+        return [os.path.basename(entry) for entry in dirs + files]
+
+    def isdir(self, path):
+        stats.count("s3_list_requests")
+        response = self.client.list_objects_v2(Bucket=self.bucket, Prefix=self._key(path) + "/", MaxKeys=1)
+        return response.get("KeyCount", len(response.get("Contents", ()))) > 0
+
+    def isfile(self, path):
+        try:
+            self.size(path)
+        except OSError:
+            return False
+        return True
+
+    def read(self, path):
+        return self.read_bytes(path).decode()
+
+    def read_bytes(self, path):
+        stats.count("s3_get_requests")
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self._key(path))
+        except Exception as error:
+            if is_s3_not_found(error):
+                raise IOError(errno.ENOENT, "No such key in bucket {0}".format(self.bucket), path)
+            raise
+        return response["Body"].read()
+
+    def size(self, path):
+        stats.count("s3_head_requests")
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self._key(path))["ContentLength"]
+        except Exception as error:
+            if is_s3_not_found(error):
+                raise OSError(errno.ENOENT, "No such key in bucket {0}".format(self.bucket), path)
+            raise
+
+    def walk_files(self, path):
+        for filepath, _ in self.file_sizes(path):
+            yield filepath
+
+    def file_sizes(self, path):
+        for page in self._pages(path):
+            for entry in page.get("Contents", ()):
+                yield self._path(entry["Key"]), entry["Size"]
+
+    def map(self, func, items, jobs=1):
+        return parallel_map(func, items, max(jobs, self.jobs))
+
+    def delete_trees(self, paths):
+        # blob and link directories hold a single known key, only other directories are listed
+        leaves = [leaf_file(path) for path in paths]
+        listed = iter(self.map(lambda path: [self._key(filepath) for filepath in self.walk_files(path)],
+                               [path for path, leaf in zip(paths, leaves) if leaf is None]))
+        keys = [[self._key(leaf)] if leaf is not None else next(listed) for leaf in leaves]
+        owner = {}
+        for i, path_keys in enumerate(keys):
+            owner.update((key, i) for key in path_keys)
+        errors = [None] * len(paths)
+        all_keys = sorted(owner)
+        batches = [all_keys[start:start + self.MAX_DELETE_KEYS]
+                   for start in range(0, len(all_keys), self.MAX_DELETE_KEYS)]
+
+        def delete(batch):
+            stats.count("s3_delete_requests")
+            try:
+                response = self.client.delete_objects(
+                    Bucket=self.bucket, Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True})
+            except Exception as error:
+                return [(key, error) for key in batch]
+            return [(entry["Key"], RegistryCleanerError("{0}: {1}".format(entry.get("Code"), entry.get("Message"))))
+                    for entry in response.get("Errors", ())]
+
+        for failures in self.map(delete, batches):
+            for key, error in failures:
+                errors[owner[key]] = error
+        return errors
+
+
+# deletion phases: links go before what they point to, so the registry stays consistent in between
+DELETE_PHASES = {"tag": 0, "tag_index": 0, "revision": 1, "layer": 2, "repository": 3, "directory": 3, "blob": 4}
+
+
+class DeletionPlan(object):
+    """directories to delete, collected while planning and deleted by a pool of workers afterwards"""
+
+    def __init__(self, progress_interval=5.0):
+        self.items = []
+        self.deleted = []
+        self.progress_interval = progress_interval
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, path, size=0, kind="directory", digest=None, reason=None):
+        """plan deleting `path`, which frees `size` bytes of blob data"""
+        self.items.append((path, size, kind, digest, reason))
+
+    def _without_nested(self):
+        """planned items, minus those below another planned path that deleting it removes anyway"""
+        planned = set(item[0] for item in self.items)
+        result = []
+        for item in self.items:
+            parent = os.path.dirname(item[0])
+            while parent not in planned and os.path.dirname(parent) != parent:
+                parent = os.path.dirname(parent)
+            if parent not in planned:
+                result.append(item)
+        return result
+
+    def execute(self, jobs=1, storage=None, journal=None):
+        """delete every planned path on `jobs` threads, return the (path, error) of each failure
+
+        Tags and tag index entries are deleted first, then revisions, layer
+        links, repositories and blobs last, each phase only once the one
+        before it is done. Later phases are skipped if anything failed.
+        With a journal, the items are journaled before anything is deleted
+        and a checkpoint follows every phase.
+        """
+        storage = storage or local_storage
+        errors = []
+        lock = threading.Lock()
+        # concurrent deletes of a directory and something inside it would race each other
+        self.items = self._without_nested()
+        total_bytes = sum(item[1] for item in self.items)
+        progress = {"items": 0, "bytes": 0, "start": time.time(), "logged": time.time()}
+        if journal is not None:
+            journal.plan(self.items)
+
+        def log_progress(now):
+            elapsed = max(now - progress["start"], 1e-6)
+            logger.info("Deleted %d of %d paths (%d failed), %d of %d bytes (%.1f paths/s, %.1f bytes/s)",
+                        progress["items"], len(self.items), len(errors), progress["bytes"], total_bytes,
+                        progress["items"] / elapsed, progress["bytes"] / elapsed)
+
+        def delete(chunk):
+            for item in chunk:
+                logger.info("Deleting %s", item[0])
+            results = storage.delete_trees([item[0] for item in chunk])
+            for (path, size, _, _, _), error in zip(chunk, results):
+                if error is not None:
+                    logger.critical("Failed to delete directory:%s", error)
+                    with lock:
+                        errors.append((path, error))
+                else:
+                    stats.count("paths_deleted")
+                    stats.count("bytes_deleted", size)
+                    with lock:
+                        self.deleted.append(path)
+                if journal is not None:
+                    journal.done(path, error)
+                with lock:
+                    progress["items"] += 1
+                    progress["bytes"] += size
+            with lock:
+                now = time.time()
+                if now - progress["logged"] >= self.progress_interval:
+                    progress["logged"] = now
+                    log_progress(now)
+                    if journal is not None:
+                        journal.checkpoint()
+
+        phases = {}
+        for item in self.items:
+            phases.setdefault(DELETE_PHASES.get(item[2], DELETE_PHASES["directory"]), []).append(item)
+        for phase in sorted(phases):
+            if errors:
+                logger.error("Not deleting the remaining %d paths after %d failures",
+                             sum(len(phases[later]) for later in phases if later >= phase), len(errors))
+                break
+            items = phases[phase]
+            # storages deleting many paths per request get them in chunks
+            chunks = [items[start:start + storage.delete_chunk]
+                      for start in range(0, len(items), storage.delete_chunk)]
+            parallel_map(delete, chunks, jobs)
+            if journal is not None:
+                journal.checkpoint()
+        if self.items:
+            log_progress(time.time())
+        self.items = []
+        return errors
+
+
+class PlanWriter(object):
+    """streams every delete and keep decision to `stream` as one JSON object per line
+
+    Records are written as the decisions are made, with paths relative to
+    registry_data_dir. close() appends a summary line with the number of
+    paths to delete and keep and the bytes of blob data deleting frees.
+    """
+
+    def __init__(self, stream, registry_data_dir):
+        self.stream = stream
+        self.registry_data_dir = registry_data_dir
+        self.counts = Counter()
+        self.reclaimable_bytes = 0
+
+    def record(self, action, kind, path, digest=None, size=0, reason=None):
+        """write one `action` ("delete" or "keep") decision about `path`"""
+        self.counts[action] += 1
+        if action == "delete":
+            self.reclaimable_bytes += size
+        self.stream.write(json.dumps({
+            "action": action,
+            "kind": kind,
+            "path": os.path.relpath(path, self.registry_data_dir),
+            "digest": digest,
+            "size": size,
+            "reason": reason,
+        }, sort_keys=True) + "\n")
+
+    def close(self):
+        """write the summary line and return it"""
+        summary = {"delete": self.counts["delete"], "keep": self.counts["keep"],
+                   "reclaimable_bytes": self.reclaimable_bytes}
+        self.stream.write(json.dumps({"summary": summary}, sort_keys=True) + "\n")
+        self.stream.flush()
+        return summary
+
+
+def read_plan(stream):
+    """yield the decision records of a plan written by PlanWriter, one line at a time"""
+    complete = False
+    for number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as error:
+            raise RegistryCleanerError("Invalid plan record on line {0}: {1}".format(number, error))
+        if "summary" in record:
+            complete = True
+            continue
+        yield record
+    if not complete:
+        logger.warning("Plan has no summary line, it may have been cut short")
+
+
+class DeletionJournal(object):
+    """append-only journal of the deletions of a run, to resume them after a crash
+
+    Every planned deletion is appended as a plan record (see PlanWriter) and
+    synced to disk before anything is deleted. Each path deleted then gets a
+    {"action": "done"} record (or "failed", with the error), synced at every
+    checkpoint. A crash can only lose completions since the last checkpoint,
+    and the paths they were for are gone when the journal is resumed.
+    """
+
+    def __init__(self, path, registry_data_dir):
+        self.path = path
+        self.registry_data_dir = registry_data_dir
+        self._truncate_torn_record()
+        self.stream = open(path, "a")
+        self.writer = PlanWriter(self.stream, registry_data_dir)
+        self.lock = threading.Lock()
+
+    def _truncate_torn_record(self):
+        """cut off a last record left incomplete by a crash, so appending to the journal keeps it valid"""
+        try:
+            stream = open(self.path, "rb+")
+        except (IOError, OSError):
+            return
+        with stream:
+            end = stream.seek(0, os.SEEK_END)
+            position = end
+            while position > 0:
+                start = max(position - 4096, 0)
+                stream.seek(start)
+                newline = stream.read(position - start).rfind(b"\n")
+                if newline >= 0:
+                    position = start + newline + 1
+                    break
+                position = start
+            if position < end:
+                logger.warning("Cutting the incomplete last record off the journal %s", self.path)
+                stream.truncate(position)
+
+    def plan(self, items):
+        """journal the (path, size, kind, digest, reason) of every path about to be deleted"""
+        with self.lock:
+            for path, size, kind, digest, reason in items:
+                self.writer.record("delete", kind, path, digest, size, reason)
+        self.checkpoint()
+
+    def done(self, path, error=None):
+        """journal that deleting `path` succeeded, or failed with `error`"""
+        record = {"action": "failed" if error else "done", "path": os.path.relpath(path, self.registry_data_dir)}
+        if error:
+            record["error"] = str(error)
+        with self.lock:
+            self.stream.write(json.dumps(record, sort_keys=True) + "\n")
+
+    def checkpoint(self):
+        """sync everything journaled so far to disk"""
+        with self.lock:
+            self.stream.flush()
+            os.fsync(self.stream.fileno())
+
+    def close(self):
+        self.checkpoint()
+        self.stream.close()
+
+
+def read_journal(stream):
+    """delete records of a DeletionJournal that have no done record yet, in journal order"""
+    pending = OrderedDict()
+    invalid = None
+    for number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        if invalid:
+            raise RegistryCleanerError("Invalid journal record on line {0}: {1}".format(*invalid))
+        try:
+            record = json.loads(line)
+        except ValueError as error:
+            # only the last line may be cut short, by dying while appending it
+            invalid = (number, error)
+            continue
+        if record.get("action") == "delete":
+            pending[record["path"]] = record
+        elif record.get("action") == "done":
+            pending.pop(record["path"], None)
+    if invalid:
+        logger.warning("Ignoring the incomplete last line %d of the journal", invalid[0])
+    return list(pending.values())
+
+
 class RegistryCleanerError(Exception):
     pass
 
 
+class RegistryClient(object):
+    """client for the v2 API of a running registry, keeping one persistent connection per thread"""
+
+    def __init__(self, url, timeout=60):
+        parsed = urlparse(url)
+        if parsed.scheme not in ("http", "https") or not parsed.hostname:
+            raise RegistryCleanerError("Invalid registry url '{0}'".format(url))
+        netloc = parsed.hostname + (":{0}".format(parsed.port) if parsed.port else "")
+        # without credentials, so it can be logged
+        self.url = "{0}://{1}{2}".format(parsed.scheme, netloc, parsed.path.rstrip("/"))
+        self.timeout = timeout
+        self._netloc = netloc
+        self._base_path = parsed.path.rstrip("/")
+        self._connection_class = (http.client.HTTPSConnection if parsed.scheme == "https"
+                                  else http.client.HTTPConnection)
+        self._headers = {}
+        if parsed.username:
+            credentials = "{0}:{1}".format(unquote(parsed.username), unquote(parsed.password or ""))
+            self._headers["Authorization"] = "Basic " + base64.b64encode(credentials.encode()).decode()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def close(self):
+        """close the connections of all threads, they reconnect on their next request"""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.close()
+
+    def _request(self, method, path):
+        """(status, body) of one request, reconnecting once if the kept-alive connection was closed"""
+        for attempt in (1, 2):
+            connection = getattr(self._local, "connection", None)
+            # a connection without socket was closed, e.g. by close() after the last batch
+            if connection is None or connection.sock is None:
+                connection = self._connection_class(self._netloc, timeout=self.timeout)
+                self._local.connection = connection
+                with self._lock:
+                    self._connections.append(connection)
+            try:
+                connection.request(method, self._base_path + path, headers=self._headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                self._local.connection = None
+                if attempt == 2:
+                    raise
+                continue
+            stats.count("api_requests")
+            return response.status, body
+
+    def delete_manifest(self, repo, digest):
+        """delete a manifest by digest; the registry untags every tag pointing to it"""
+        try:
+            status, body = self._request("DELETE", "/v2/{0}/manifests/sha256:{1}".format(quote(repo), digest))
+        except (http.client.HTTPException, OSError) as error:
+            raise RegistryCleanerError("Deleting manifest {0} of {1} failed: {2}".format(digest, repo, error))
+        if status == 404:
+            logger.warning("Manifest %s of %s was already deleted", digest, repo)
+        elif status not in (200, 202):
+            raise RegistryCleanerError("Deleting manifest {0} of {1} failed with HTTP {2}: {3}".format(
+                digest, repo, status, body.decode("utf-8", "replace").strip()))
+
+
 class RegistryCleaner(object):
     """Clean registry"""
 
-    def __init__(self, registry_data_dir, dry_run=False):
+    def __init__(self, registry_data_dir, dry_run=False,
+                 manifest_cache_size=DEFAULT_MANIFEST_CACHE_SIZE, jobs=1,
+                 index_file=None, rebuild_index=False, delete_jobs=None, plan_output=None,
+                 registry_client=None, storage=None, journal=None, parse_jobs=1):
         self.registry_data_dir = registry_data_dir
-        if not os.path.isdir(self.registry_data_dir):
+        self.storage = storage or local_storage
+        if not self.storage.isdir(self.registry_data_dir):
             raise RegistryCleanerError("No repositories directory found inside " \
                                        "REGISTRY_DATA_DIR '{0}'.".
                                        format(self.registry_data_dir))
         self.dry_run = dry_run
+        self.jobs = jobs
+        self.repositories_dir = os.path.join(self.registry_data_dir, "repositories")
+        self._link_index = None
+        self._deleted_paths = set()
+        self._batch_blobs = None
+        self._protected_blobs = None
+        # manifests are content addressed, so cached layer sets never go stale
+        self.manifest_cache = LRUCache(manifest_cache_size)
+        if index_file and not self.storage.has_directories:
+            # repositories are told apart from changed ones by their directory mtimes
+            raise RegistryCleanerError("An index file needs a storage with directories, "
+                                       "not {0}".format(type(self.storage).__name__))
+        self._index_store = LinkIndexStore(index_file) if index_file else None
+        self._rebuild_index = rebuild_index
+        self._invalidated_repos = set()
+        self._tag_indexes = {}
+        self.plan = DeletionPlan()
+        self.delete_jobs = delete_jobs or jobs
+        self.plan_writer = PlanWriter(plan_output, registry_data_dir) if plan_output else None
+        # with a registry client, manifests are deleted through the API and the rest is swept after
+        self.registry_client = registry_client
+        self._api_manifests = []
+        self._api_sweep = []
+        self.journal = journal
+        # manifests are parsed in this many processes where many are read at once
+        self.parse_jobs = parse_jobs
 
-    def _delete_layer(self, repo, digest):
-        """remove blob directory from filesystem"""
-        path = os.path.join(self.registry_data_dir, "repositories", repo, "_layers/sha256", digest)
-        self._delete_dir(path)
+    @property
+    def link_index(self):
+        """reverse link index shared by every delete operation, built on first use"""
+        if self._link_index is None:
+            self._link_index = self._build_link_index()
+        return self._link_index
+
+    def reset_run_state(self):
+        """forget the paths planned or deleted so far, to plan again on a registry that changed since
+
+        The link index and the manifest cache are kept.
+        """
+        self._deleted_paths = set()
+        self._batch_blobs = None
+        self._protected_blobs = None
+        self._tag_indexes = {}
+        self._api_manifests = []
+        self._api_sweep = []
+        self.plan = DeletionPlan()
+
+    @timed("link_index")
+    def _build_link_index(self):
+        """walk every repository once, `jobs` at a time, and index all of their links"""
+        logger.debug("Building link index for %s", self.repositories_dir)
+        index = LinkIndex()
+        if self._index_store is not None:
+            all_links = self._load_stored_links()
+        else:
+            repo_dirs = [os.path.join(self.repositories_dir, repo) for repo in self._get_repositories()]
+            all_links = parallel_map(self._links_under, repo_dirs, self.jobs)
+        for links in all_links:
+            for digest, repo, kind in links:
+                index.add(digest, repo, kind)
+        logger.debug("Link index holds %d digests", len(index))
+        return index
 
-    def _delete_blob(self, digest):
+    def _load_stored_links(self):
+        """links of every repository from the index file, rescanning only changed repositories"""
+        store = self._index_store
+        if self._rebuild_index:
+            logger.info("Rebuilding index file %s", store.path)
+            store.clear()
+        repos = self._get_repositories()
+        repo_dirs = [os.path.join(self.repositories_dir, repo) for repo in repos]
+        signatures = parallel_map(repository_signature, repo_dirs, self.jobs)
+        repo_dirs_set = set(repo_dirs)
+        stored = store.signatures()
+        changed = [i for i, repo in enumerate(repos) if stored.get(repo) != signatures[i]]
+        logger.debug("Rescanning %d of %d repositories for index file %s",
+                     len(changed), len(repos), store.path)
+
+        # the signature is taken before scanning, so changes made meanwhile show up next run
+        scanned = parallel_map(lambda i: self._links_under(repo_dirs[i], skip_deleted=False),
+                               changed, self.jobs)
+        for i, links in zip(changed, scanned):
+            store.replace(repos[i], signatures[i], links)
+        for repo in set(stored) - set(repos):
+            store.remove(repo)
+
+        # repositories already changed by a dry run are scanned again, minus the deleted paths
+        touched = set()
+        for path in self._deleted_paths:
+            while len(path) > len(self.repositories_dir) and path not in repo_dirs_set:
+                path = os.path.dirname(path)
+            touched.add(path)
+        return [self._links_under(repo_dir) if repo_dir in touched else store.links(repo)
+                for repo, repo_dir in zip(repos, repo_dirs)]
+
+    @timed("check_index")
+    def check_link_index(self):
+        """compare the link index against a full scan, return the digests that differ"""
+        expected = LinkIndex()
+        repo_dirs = [os.path.join(self.repositories_dir, repo) for repo in self._get_repositories()]
+        for links in parallel_map(self._links_under, repo_dirs, self.jobs):
+            for digest, repo, kind in links:
+                expected.add(digest, repo, kind)
+        actual = dict((digest, sorted(entries)) for digest, entries in self.link_index.items())
+        expected = dict((digest, sorted(entries)) for digest, entries in expected.items())
+        return sorted(digest for digest in set(actual) | set(expected)
+                      if actual.get(digest) != expected.get(digest))
+
+    def _is_deleted(self, path):
+        """check if `path` or one of its parents has already been deleted in this run"""
+        while path.startswith(self.registry_data_dir) and path != self.registry_data_dir:
+            if path in self._deleted_paths:
+                return True
+            path = os.path.dirname(path)
+        return False
+
+    def _links_under(self, path, skip_deleted=True):
+        """(digest, repo, kind) of every link below `path` that was not deleted yet"""
+        if os.path.relpath(path, self.repositories_dir).startswith(os.pardir):
+            return []
+        link = leaf_file(path) if not self.storage.has_directories else None
+        if link is not None:
+            # the link in a link directory names the digest the directory is named after, no need to list it
+            entry = get_link_entry(os.path.relpath(link, self.repositories_dir))
+            if entry is None or (skip_deleted and self._deleted_paths and self._is_deleted(path)):
+                return []
+            return [(os.path.basename(path),) + entry]
+        links = []
+        for filepath in iter_link_paths(path, self.storage):
+            if skip_deleted and self._deleted_paths and self._is_deleted(os.path.dirname(filepath)):
+                continue
+            entry = get_link_entry(os.path.relpath(filepath, self.repositories_dir))
+            if entry:
+                links.append((filepath, entry))
+        digests = self.storage.map(lambda link: get_digest_from_blob(link[0], self.storage), links)
+        return [(digest,) + entry for digest, (_, entry) in zip(digests, links)]
+
+    def _layer_path(self, repo, digest):
+        return os.path.join(self.registry_data_dir, "repositories", repo, "_layers/sha256", digest)
+
+    def _blob_path(self, digest):
+        return os.path.join(self.registry_data_dir, "blobs/sha256", digest[0:2], digest)
+
+    def _delete_layer(self, repo, digest, reason=None):
         """remove blob directory from filesystem"""
-        path = os.path.join(self.registry_data_dir, "blobs/sha256", digest[0:2], digest)
-        self._delete_dir(path)
+        self._delete_dir(self._layer_path(repo, digest), kind="layer", digest=digest, reason=reason)
+
+    def _delete_blob(self, digest, reason=None, size=None):
+        """remove blob directory from filesystem, or queue it while running a batch"""
+        if self._batch_blobs is not None:
+            self._batch_blobs.add(digest)
+            return
+        self._delete_dir(self._blob_path(digest), self._blob_size(digest) if size is None else size,
+                         kind="blob", digest=digest, reason=reason)
+
+    def _keep(self, kind, path, digest, reason):
+        """record a decision not to delete `path` in the plan output"""
+        logger.debug("Not deleting %s since %s", path, reason)
+        if self.plan_writer is not None:
+            size = self._blob_size(digest) if kind == "blob" else 0
+            self.plan_writer.record("keep", kind, path, digest, size, reason)
+
+    def _keep_blob(self, digest, reason):
+        self._keep("blob", self._blob_path(digest), digest, reason)
 
     def _blob_path_for_revision(self, digest):
         """where we can find the blob that contains the json describing this digest"""
@@ -109,239 +1417,1366 @@ class RegistryCleaner(object):
 
     def _blob_path_for_revision_is_missing(self, digest):
         """for each revision, there should be a blob describing it"""
-        return not os.path.isfile(self._blob_path_for_revision(digest))
+        return not self.storage.isfile(self._blob_path_for_revision(digest))
+
+    def _get_manifest(self, digest):
+        """(layers, child manifests) of a manifest and of every manifest it lists, memoized in the manifest cache"""
+        packed = self.manifest_cache.get(digest)
+        if packed is not None:
+            return Manifest(unpack_digests(packed[0]), unpack_digests(packed[1]))
+        manifests = self._load_manifests([digest])
+        manifest = self._expand_manifest(manifests, digest)
+        if manifest is None or digest not in manifests:
+            return Manifest(frozenset(), frozenset())
+        self.manifest_cache.put(digest, (pack_digests(manifest.layers), pack_digests(manifest.children)))
+        return manifest
 
     def _get_layers_from_blob(self, digest):
-        """get layers from blob by digest"""
-        return get_layers_from_blob(self._blob_path_for_revision(digest))
+        """get layers from blob by digest, including those of the manifests a manifest list names"""
+        return self._get_manifest(digest).layers
 
-    def _delete_dir(self, path):
-        """remove directory from filesystem"""
+    def _get_child_manifests(self, digest):
+        """manifests a manifest list or image index names, directly or through nested ones"""
+        return self._get_manifest(digest).children
+
+    def _parse_manifests(self, digests):
+        """read_manifest of every digest, `parse_jobs` batches at a time in a process pool if there are many"""
+        paths = [self._blob_path_for_revision(digest) for digest in digests]
+        if (self.parse_jobs > 1 and len(paths) > MANIFEST_BATCH_SIZE
+                and isinstance(self.storage, LocalStorage)):
+            batches = [paths[i:i + MANIFEST_BATCH_SIZE] for i in range(0, len(paths), MANIFEST_BATCH_SIZE)]
+            pool = multiprocessing.Pool(min(self.parse_jobs, len(batches)))
+            try:
+                return list(itertools.chain.from_iterable(pool.imap(read_manifests, batches)))
+            finally:
+                pool.close()
+                pool.join()
+        return self.storage.map(lambda path: read_manifest(path, self.storage), paths, self.jobs)
+
+    @timed("manifest_parsing")
+    def _load_manifests(self, digests):
+        """Manifest of each of `digests` and of every manifest they list, read past the manifest cache
+
+        Manifests whose blob is missing are left out, those that cannot be
+        read map to None.
+        """
+        result = {}
+        counts = Counter()
+        pending = sorted(set(digests))
+        seen = set(pending)
+        while pending:
+            children = set()
+            for digest, parsed in zip(pending, self._parse_manifests(pending)):
+                if parsed is None:
+                    logger.warning("Blob for manifest %s does not exist", digest)
+                    continue
+                counts["files_opened"] += 1
+                if not isinstance(parsed, tuple):
+                    logger.critical("Failed to read layers from blob:%s", parsed)
+                    result[digest] = None
+                    continue
+                size, layers, manifest_children, fast = parsed
+                counts["manifest_bytes_read"] += size
+                counts["manifests_scanned" if fast else "manifests_parsed"] += 1
+                if not fast:
+                    counts["json_bytes_parsed"] += size
+                result[digest] = Manifest(unpack_digests(layers), unpack_digests(manifest_children))
+                children.update(result[digest].children)
+            pending = sorted(children - seen)
+            seen.update(pending)
+        for name, value in counts.items():
+            stats.count(name, value)
+        return result
+
+    @staticmethod
+    def _expand_manifest(manifests, digest):
+        """Manifest with the layers and child manifests of `digest` and of all its children
+
+        None if `digest` or one of its children could not be read, an empty
+        Manifest if its blob is missing.
+        """
+        layers = set()
+        children = set()
+        stack = [digest]
+        while stack:
+            current = stack.pop()
+            if current not in manifests:
+                continue
+            manifest = manifests[current]
+            if manifest is None:
+                return None
+            layers.update(manifest.layers)
+            for child in manifest.children - children:
+                children.add(child)
+                stack.append(child)
+        return Manifest(frozenset(layers), frozenset(children))
+
+    def _delete_dir(self, path, size=0, kind="directory", digest=None, reason=None):
+        """plan removing directory from filesystem and drop its links from the link index"""
+        if self._is_deleted(path):
+            logger.debug("Already deleted: %s", path)
+            return
+        links = self._links_under(path) if self._link_index is not None else []
+        stats.count("paths_planned")
+        if self.plan_writer is not None:
+            self.plan_writer.record("delete", kind, path, digest, size, reason)
         if self.dry_run:
-            logger.info("DRY_RUN: would have deleted %s", path)
+            # with a plan output every path is in the plan already, logging each one is slow
+            logger.log(logging.DEBUG if self.plan_writer else logging.INFO,
+                       "DRY_RUN: would have deleted %s", path)
         else:
-            logger.info("Deleting %s", path)
+            logger.debug("Planning deletion of %s", path)
+            if self.registry_client is None:
+                self.plan.add(path, size, kind, digest, reason)
+            elif kind == "revision":
+                self._api_manifests.append((self._repository_of(path), digest))
+            else:
+                self._api_sweep.append((path, size, kind, digest))
+            self._invalidate_stored_repository(path)
+        self._deleted_paths.add(path)
+        for link_digest, link_repo, link_kind in links:
+            self._link_index.discard(link_digest, link_repo, link_kind)
+
+    def _repository_of(self, path):
+        """name of the repository `path` is in, None if it is not in one"""
+        relpath = os.path.relpath(path, self.repositories_dir)
+        if relpath.startswith(os.pardir):
+            return None
+        parts = relpath.split(os.sep)
+        return "/".join(itertools.takewhile(lambda part: not part.startswith("_"), parts))
+
+    def _invalidate_stored_repository(self, path):
+        """make the next run rescan the repository `path` was deleted from"""
+        repo = self._repository_of(path)
+        if self._index_store is None or repo is None:
+            return
+        if repo not in self._invalidated_repos:
+            self._invalidated_repos.add(repo)
+            self._index_store.invalidate(repo)
+
+    @timed("tag_index_lookup")
+    def _get_tag_index(self, repo):
+        """digest -> paths of its entries in the index of every tag of repository, listed once per run"""
+        tag_index = self._tag_indexes.get(repo)
+        if tag_index is not None:
+            return tag_index
+        tag_index = {}
+        tags_dir = os.path.join(self.repositories_dir, repo, "_manifests/tags")
+        try:
+            tags = self.storage.list_dir(tags_dir)
+        except OSError:
+            tags = []
+        for tag in tags:
+            index_dir = os.path.join(tags_dir, tag, "index/sha256")
             try:
-                shutil.rmtree(path)
-            except Exception as error:
-                logger.critical("Failed to delete directory:%s", error)
+                digests = self.storage.list_dir(index_dir)
+            except OSError:
+                continue
+            for digest in digests:
+                tag_index.setdefault(pack_digest(digest), []).append(os.path.join(index_dir, digest))
+        self._tag_indexes[repo] = tag_index
+        return tag_index
 
-    def _delete_from_tag_index_for_revision(self, repo, digest):
+    def _delete_from_tag_index_for_revision(self, repo, digest, reason=None):
         """delete revision from tag indexes"""
-        paths = glob.glob(
-            os.path.join(self.registry_data_dir, "repositories", repo,
-                         "_manifests/tags/*/index/sha256", digest)
-        )
-        for path in paths:
-            self._delete_dir(path)
+        # entries are only ever deleted during a run, so each one is needed once
+        for path in self._get_tag_index(repo).pop(pack_digest(digest), ()):
+            self._delete_dir(path, kind="tag_index", digest=digest, reason=reason)
 
-    def _delete_revisions(self, repo, revisions, blobs_to_keep=None):
+    def _delete_revisions(self, repo, revisions, blobs_to_keep=None, reason=None, keep_reason=None):
         """delete revisions from list of directories"""
         if blobs_to_keep is None:
             blobs_to_keep = []
         for revision_dir in revisions:
-            digests = get_links(revision_dir)
+            digests = get_links(revision_dir, storage=self.storage)
             for digest in digests:
-                self._delete_from_tag_index_for_revision(repo, digest)
+                self._delete_from_tag_index_for_revision(repo, digest, reason)
                 if digest not in blobs_to_keep:
-                    self._delete_blob(digest)
+                    self._delete_blob(digest, reason)
+                else:
+                    self._keep_blob(digest, keep_reason)
 
-            self._delete_dir(revision_dir)
+            self._delete_dir(revision_dir, kind="revision",
+                             digest=os.path.basename(revision_dir), reason=reason)
 
     def _get_tags(self, repo):
         """get all tags for given repository"""
         path = os.path.join(self.registry_data_dir, "repositories", repo, "_manifests/tags")
-        if not os.path.isdir(path):
+        if not self.storage.isdir(path):
             logger.critical("No repository '%s' found in repositories directory %s",
                              repo, self.registry_data_dir)
             return None
-        result = []
-        for each in os.listdir(path):
-            filepath = os.path.join(path, each)
-            if os.path.isdir(filepath):
-                result.append(each)
-        return result
+        dirs, _ = self.storage.scan_dir(path, follow_symlinks=True)
+        return [os.path.basename(filepath) for filepath in dirs if filepath not in self._deleted_paths]
 
+    @timed("repositories")
     def _get_repositories(self):
-        """get all repository repos"""
-        result = []
-        root = os.path.join(self.registry_data_dir, "repositories")
-        for each in os.listdir(root):
-            filepath = os.path.join(root, each)
-            if os.path.isdir(filepath):
-                inside = os.listdir(filepath)
-                if "_layers" in inside:
-                    result.append(each)
-                else:
-                    for inner in inside:
-                        result.append(os.path.join(each, inner))
-        return result
+        """get all repository repos, also those linked into the repositories directory"""
+        def repositories_in(each):
+            inside = self.storage.list_dir(os.path.join(root, each))
+            if "_layers" in inside:
+                return [each]
+            return [os.path.join(each, inner) for inner in inside]
 
-    def _get_all_links(self, except_repo=""):
-        """get links for every repository"""
         result = []
-        repositories = self._get_repositories()
-        for repo in [r for r in repositories if r != except_repo]:
-            path = os.path.join(self.registry_data_dir, "repositories", repo)
-            for link in get_links(path):
-                result.append(link)
+        root = os.path.join(self.registry_data_dir, "repositories")
+        dirs, _ = self.storage.scan_dir(root, follow_symlinks=True)
+        for repos in parallel_map(repositories_in, [os.path.basename(d) for d in dirs], self.jobs):
+            result.extend(repos)
         return result
 
+    @timed("prune")
     def prune(self):
-        """delete all empty directories in registry_data_dir"""
-        del_empty_dirs(self.registry_data_dir, True)
-
-    def _layer_in_same_repo(self, repo, tag, layer):
-        """check if layer is found in other tags of same repository"""
-        for other_tag in [t for t in self._get_tags(repo) if t != tag]:
-            path = os.path.join(self.registry_data_dir, "repositories", repo,
-                                "_manifests/tags", other_tag, "current/link")
-            manifest = get_digest_from_blob(path)
-            try:
-                layers = self._get_layers_from_blob(manifest)
-                if layer in layers:
-                    return True
-            except IOError:
-                if self._blob_path_for_revision_is_missing(manifest):
-                    logger.warn("Blob for digest %s does not exist. Deleting tag manifest: %s", manifest, other_tag)
-                    tag_dir = os.path.join(self.registry_data_dir, "repositories", repo,
-                                           "_manifests/tags", other_tag)
-                    self._delete_dir(tag_dir)
-                else:
-                    raise
-        return False
+        """delete the directories left empty by the paths deleted in this run"""
+        if not self.storage.has_directories:
+            self.plan.deleted = []
+            return
+        logger.debug("Pruning parents of %d deleted paths", len(self.plan.deleted))
+        del_empty_parents(self.plan.deleted, self.registry_data_dir)
+        self.plan.deleted = []
 
-    def _manifest_in_same_repo(self, repo, tag, manifest):
-        """check if manifest is found in other tags of same repository"""
-        for other_tag in [t for t in self._get_tags(repo) if t != tag]:
-            path = os.path.join(self.registry_data_dir, "repositories", repo,
-                                "_manifests/tags", other_tag, "current/link")
-            other_manifest = get_digest_from_blob(path)
-            if other_manifest == manifest:
-                return True
+    @timed("prune")
+    def prune_all(self):
+        """delete all empty directories in registry_data_dir"""
+        if self.dry_run:
+            logger.info("DRY_RUN: not pruning empty directories in %s", self.registry_data_dir)
+            return
+        if not self.storage.has_directories:
+            return
+        del_empty_dirs(self.registry_data_dir, True, self.jobs)
 
-        return False
+    def _get_tag_references(self, repo, except_tag):
+        """manifests of every other tag of repository and how many of them use each layer"""
+        manifests = DigestSet()
+        layer_counts = Counter()
+        for other_tag in [t for t in self._get_tags(repo) if t != except_tag]:
+            tag_dir = os.path.join(self.registry_data_dir, "repositories", repo,
+                                   "_manifests/tags", other_tag)
+            manifest = get_digest_from_blob(os.path.join(tag_dir, "current/link"), self.storage)
+            if self._blob_path_for_revision_is_missing(manifest):
+                logger.warning("Blob for digest %s does not exist. Deleting tag manifest: %s", manifest, other_tag)
+                self._delete_dir(tag_dir, kind="tag", digest=manifest, reason="manifest blob missing")
+                continue
+            manifests.add(manifest)
+            manifests.update(self._get_child_manifests(manifest))
+            layer_counts.update(pack_digest(layer) for layer in self._get_layers_from_blob(manifest))
+        return manifests, layer_counts
 
     def delete_entire_repository(self, repo):
         """delete all blobs for given repository repo"""
         logger.debug("Deleting entire repository '%s'", repo)
+        self._protected_blobs = None
         repo_dir = os.path.join(self.registry_data_dir, "repositories", repo)
-        if not os.path.isdir(repo_dir):
+        if not self.storage.isdir(repo_dir) or self._is_deleted(repo_dir):
             raise RegistryCleanerError("No repository '{0}' found in repositories "
                                        "directory {1}/repositories".
                                        format(repo, self.registry_data_dir))
-        links = set(get_links(repo_dir))
-        all_links_but_current = set(self._get_all_links(except_repo=repo))
+        if self._deleted_paths:
+            links = DigestSet(digest for digest, _, _ in self._links_under(repo_dir))
+        else:
+            links = DigestSet(get_links(repo_dir, jobs=self.jobs, storage=self.storage))
         for layer in links:
-            if layer in all_links_but_current:
-                logger.debug("Blob found in another repository. Not deleting: %s", layer)
+            if self.link_index.in_other_repository(layer, repo):
+                self._keep_blob(layer, "linked from another repository")
             else:
-                self._delete_blob(layer)
-        self._delete_dir(repo_dir)
+                self._delete_blob(layer, "repository deleted")
+        if self.registry_client is not None:
+            # the registry deletes the manifests, the repository directory is swept afterwards
+            revisions_dir = os.path.join(repo_dir, "_manifests/revisions/sha256")
+            for digest, _, _ in self._links_under(revisions_dir):
+                self._delete_dir(os.path.join(revisions_dir, digest), kind="revision",
+                                 digest=digest, reason="repository deleted")
+        self._delete_dir(repo_dir, kind="repository", reason="repository deleted")
 
     def delete_repository_tag(self, repo, tag):
         """delete all blobs only for given tag of repository"""
         logger.debug("Deleting repository '%s' with tag '%s'", repo, tag)
+        self._protected_blobs = None
         tag_dir = os.path.join(self.registry_data_dir, "repositories", repo, "_manifests/tags", tag)
-        if not os.path.isdir(tag_dir):
+        if not self.storage.isdir(tag_dir) or self._is_deleted(tag_dir):
             raise RegistryCleanerError("No repository '{0}' tag '{1}' found in repositories "
                                        "directory {2}/repositories".
                                        format(repo, tag, self.registry_data_dir))
-        manifests_for_tag = set(get_links(tag_dir))
+        manifests_for_tag = DigestSet(digest for digest, _, _ in self._links_under(tag_dir))
+        revisions_dir = os.path.join(self.repositories_dir, repo, "_manifests/revisions/sha256")
+        for manifest in list(manifests_for_tag):
+            # the manifests a manifest list names are revisions of the repository as well
+            manifests_for_tag.update(child for child in self._get_child_manifests(manifest)
+                                     if self.storage.isdir(os.path.join(revisions_dir, child)))
+        other_manifests, other_layer_counts = self._get_tag_references(repo, tag)
         revisions_to_delete = []
-        blobs_to_keep = []
-        layers = []
-        all_links_not_in_current_repo = set(self._get_all_links(except_repo=repo))
+        blobs_to_keep = DigestSet()
+        layers = DigestSet()
         for manifest in manifests_for_tag:
             logger.debug("Looking up filesystem layers for manifest digest %s", manifest)
 
-            if self._manifest_in_same_repo(repo, tag, manifest):
-                logger.debug("Not deleting since we found another tag using manifest: %s", manifest)
+            revision_dir = os.path.join(self.registry_data_dir, "repositories", repo,
+                                        "_manifests/revisions/sha256", manifest)
+            if manifest in other_manifests:
+                self._keep("revision", revision_dir, manifest, "manifest used by another tag")
                 continue
             else:
-                revisions_to_delete.append(
-                    os.path.join(self.registry_data_dir, "repositories", repo,
-                                 "_manifests/revisions/sha256", manifest)
-                )
-                if manifest in all_links_not_in_current_repo:
-                    logger.debug("Not deleting the blob data since we found another repo using manifest: %s", manifest)
-                    blobs_to_keep.append(manifest)
-
-                layers.extend(self._get_layers_from_blob(manifest))
-
-        layers_uniq = set(layers)
-        for layer in layers_uniq:
-            if self._layer_in_same_repo(repo, tag, layer):
-                logger.debug("Not deleting since we found another tag using digest: %s", layer)
+                revisions_to_delete.append(revision_dir)
+                if self.link_index.in_other_repository(manifest, repo):
+                    blobs_to_keep.add(manifest)
+
+                layers.update(self._get_layers_from_blob(manifest))
+
+        for layer in layers:
+            if other_layer_counts[pack_digest(layer)]:
+                self._keep("layer", self._layer_path(repo, layer), layer, "layer used by another tag")
                 continue
 
-            self._delete_layer(repo, layer)
-            if layer in all_links_not_in_current_repo:
-                logger.debug("Blob found in another repository. Not deleting: %s", layer)
+            self._delete_layer(repo, layer, "tag deleted")
+            if self.link_index.in_other_repository(layer, repo):
+                self._keep_blob(layer, "linked from another repository")
             else:
-                self._delete_blob(layer)
+                self._delete_blob(layer, "tag deleted")
+
+        self._delete_revisions(repo, revisions_to_delete, blobs_to_keep,
+                               "tag deleted", "linked from another repository")
+        self._delete_dir(tag_dir, kind="tag", reason="tag deleted",
+                         digest=get_digest_from_blob(os.path.join(tag_dir, "current/link"), self.storage))
 
-        self._delete_revisions(repo, revisions_to_delete, blobs_to_keep)
-        self._delete_dir(tag_dir)
+    def _get_protected_blobs(self):
+        """tagged manifests of all repositories and their layers, computed once per run"""
+        if self._protected_blobs is None:
+            protected = DigestSet()
+            tagged = self.link_index.digests("tag")
+            manifests = self._load_manifests(tagged)
+            for manifest in tagged:
+                protected.add(manifest)
+                expanded = self._expand_manifest(manifests, manifest) or Manifest(frozenset(), frozenset())
+                protected.update(expanded.children)
+                protected.update(expanded.layers)
+            logger.debug("Protecting %d tagged manifests and layers", len(protected))
+            self._protected_blobs = protected
+        return self._protected_blobs
 
     def delete_untagged(self, repo):
         """delete all untagged data from repo"""
         logger.debug("Deleting utagged data from repository '%s'", repo)
-        repositories_dir = os.path.join(self.registry_data_dir, "repositories")
-        repo_dir = os.path.join(repositories_dir, repo)
-        if not os.path.isdir(repo_dir):
+        repo_dir = os.path.join(self.repositories_dir, repo)
+        if not self.storage.isdir(repo_dir) or self._is_deleted(repo_dir):
             raise RegistryCleanerError("No repository '{0}' found in repositories "
                                        "directory {1}/repositories".
                                        format(repo, self.registry_data_dir))
-        tagged_links = set(get_links(repositories_dir, _filter="current"))
-        layers_to_protect = []
-        for link in tagged_links:
-            layers_to_protect.extend(self._get_layers_from_blob(link))
-
-        unique_layers_to_protect = set(layers_to_protect)
-        for layer in unique_layers_to_protect:
-            logger.debug("layer_to_protect: %s", layer)
+        blobs_to_protect = self._get_protected_blobs()
 
-        tagged_revisions = set(get_links(repo_dir, _filter="current"))
+        tagged_revisions = DigestSet(digest for digest, _, kind in
+                                     self._links_under(os.path.join(repo_dir, "_manifests/tags"))
+                                     if kind == "tag")
+        for manifest in list(tagged_revisions):
+            tagged_revisions.update(self._get_child_manifests(manifest))
 
         revisions_to_delete = []
-        layers_to_delete = []
+        layers_to_delete = DigestSet()
+        layers_to_keep = DigestSet()
 
         dir_for_revisions = os.path.join(repo_dir, "_manifests/revisions/sha256")
-        for rev in os.listdir(dir_for_revisions):
-            if rev not in tagged_revisions:
-                revisions_to_delete.append(os.path.join(dir_for_revisions, rev))
+        for rev in self.storage.list_dir(dir_for_revisions):
+            rev_dir = os.path.join(dir_for_revisions, rev)
+            if rev not in tagged_revisions and rev_dir not in self._deleted_paths:
+                revisions_to_delete.append(rev_dir)
                 for layer in self._get_layers_from_blob(rev):
-                    if layer not in unique_layers_to_protect:
-                        layers_to_delete.append(layer)
+                    if layer not in blobs_to_protect:
+                        layers_to_delete.add(layer)
+                    elif layer not in layers_to_keep:
+                        layers_to_keep.add(layer)
+                        self._keep_blob(layer, "used by a tagged manifest")
 
-        unique_layers_to_delete = set(layers_to_delete)
+        self._delete_revisions(repo, revisions_to_delete, blobs_to_protect,
+                               "untagged", "used by a tagged manifest")
+        for layer in layers_to_delete:
+            self._delete_blob(layer, "untagged")
+            self._delete_layer(repo, layer, "untagged")
 
-        self._delete_revisions(repo, revisions_to_delete)
-        for layer in unique_layers_to_delete:
-            self._delete_blob(layer)
-            self._delete_layer(repo, layer)
+    def delete_untagged_repositories(self, repos):
+        """delete untagged data from many repositories, sharing one set of protected blobs"""
+        failed = []
+        for repo in repos:
+            try:
+                self.delete_untagged(repo)
+            except RegistryCleanerError as error:
+                logger.error(error)
+                failed.append(repo)
+        if failed:
+            raise RegistryCleanerError("Failed to delete untagged data of {0} of {1} "
+                                       "repositories: {2}".format(len(failed), len(repos),
+                                                                  ", ".join(failed)))
+
+    def get_repositories_matching(self, pattern):
+        """repositories whose name matches the regexp `pattern`"""
+        regexp = re.compile(pattern)
+        return sorted(repo for repo in self._get_repositories() if regexp.search(repo))
+
+    @timed("delete")
+    def execute_plan(self):
+        """delete everything planned so far on `delete_jobs` threads"""
+        if self.registry_client is not None:
+            self._delete_through_registry()
+        if not self.plan:
+            return
+        logger.debug("Executing deletion plan of %d paths", len(self.plan))
+        count = len(self.plan)
+        errors = self.plan.execute(self.delete_jobs, self.storage, self.journal)
+        if errors:
+            raise RegistryCleanerError("Failed to delete {0} of {1} paths: {2}".format(
+                len(errors), count, ", ".join(path for path, _ in errors)))
+
+    def _delete_through_registry(self):
+        """delete the planned manifests through the registry API, then plan sweeping what is unused
+
+        The registry keeps serving while its API deletes the manifests (and
+        untags the tags pointing to them). Layer links, tags and blobs planned
+        for deletion are then checked against the filesystem again, so only
+        those no manifest uses any more are deleted; that sweep is the only
+        part that needs writes to the registry frozen.
+        """
+        manifests, self._api_manifests = self._api_manifests, []
+        sweep, self._api_sweep = self._api_sweep, []
+        if manifests:
+            logger.info("Deleting %d manifests through %s", len(manifests), self.registry_client.url)
+
+            def delete(item):
+                try:
+                    self.registry_client.delete_manifest(*item)
+                except RegistryCleanerError as error:
+                    logger.critical(error)
+                    return item
+                return None
+
+            try:
+                failed = [item for item in parallel_map(delete, manifests, self.delete_jobs) if item]
+            finally:
+                self.registry_client.close()
+            if failed:
+                raise RegistryCleanerError("Failed to delete {0} of {1} manifests through the registry, "
+                                           "not sweeping: {2}".format(len(failed), len(manifests), ", ".join(
+                                               "{0}@sha256:{1}".format(repo, digest) for repo, digest in failed)))
+        if sweep:
+            self._plan_sweep(sweep)
+
+    @timed("sweep_check")
+    def _plan_sweep(self, sweep):
+        """plan the (path, size, kind, digest) of `sweep` that nothing on disk uses any more"""
+        # the registry kept serving since planning, so everything is looked at again
+        self._deleted_paths = set()
+        self._tag_indexes = {}
+        self._link_index = None
+        live = {}
+
+        def live_in(repo):
+            """manifests of `repo` on disk now and their layers"""
+            if repo not in live:
+                digests = DigestSet()
+                revisions_dir = os.path.join(self.repositories_dir, repo, "_manifests/revisions")
+                for manifest, _, _ in self._links_under(revisions_dir):
+                    digests.add(manifest)
+                    digests.update(self._get_layers_from_blob(manifest))
+                live[repo] = digests
+            return live[repo]
+
+        blobs = []
+        for path, size, kind, digest in sweep:
+            if not self.storage.isdir(path):
+                continue
+            repo = self._repository_of(path)
+            if kind == "blob":
+                blobs.append((path, size, digest))
+                continue
+            if kind in ("layer", "tag_index"):
+                in_use = digest in live_in(repo)
+            elif kind == "tag":
+                in_use = get_digest_from_blob(os.path.join(path, "current/link"), self.storage) != digest
+            elif kind == "repository":
+                in_use = len(live_in(repo)) > 0
+            else:
+                in_use = False
+            if in_use:
+                logger.warning("Not deleting %s, it is in use again since planning", path)
+                continue
+            self._deleted_paths.add(path)
+            self.plan.add(path, size, kind, digest, "unused after deleting manifests through the registry")
+
+        # blobs are only deleted if no link outside of the sweep is left to them
+        for path, size, digest in blobs:
+            if self.link_index.is_referenced(digest):
+                logger.warning("Not deleting blob %s, it is linked again since planning", digest)
+            else:
+                self.plan.add(path, size, "blob", digest, "unused after deleting manifests through the registry")
+
+    @timed("gc_list_blobs")
+    def _get_blobs(self):
+        """(digest, size or None) of every blob under blobs/sha256
+
+        Listing keys returns their sizes along with them, so storages without
+        directories list the data of the blobs and need no request per size.
+        """
+        root = os.path.join(self.registry_data_dir, "blobs/sha256")
+        if not self.storage.isdir(root):
+            return []
+        prefixes, _ = self.storage.scan_dir(root)
+        if not self.storage.has_directories:
+            return list(itertools.chain.from_iterable(parallel_map(self._blob_sizes, prefixes, self.jobs)))
+        result = []
+        for blob_dirs in parallel_map(lambda prefix: self.storage.scan_dir(prefix)[0], prefixes, self.jobs):
+            result.extend((os.path.basename(blob_dir), None) for blob_dir in blob_dirs)
+        return result
+
+    def _blob_size(self, digest):
+        """size of the data of a blob, 0 if it has none"""
+        try:
+            return self.storage.size(self._blob_path_for_revision(digest))
+        except OSError:
+            return 0
+
+    @timed("gc_mark")
+    def _mark(self):
+        """digests of every tagged manifest and of the layers and configs it references"""
+        marked = set()
+        tagged = self.link_index.digests("tag")
+        manifests = self._load_manifests(tagged)
+        for manifest in tagged:
+            marked.add(manifest)
+            if manifest not in manifests:
+                continue
+            expanded = self._expand_manifest(manifests, manifest)
+            if expanded is None or not (expanded.layers or expanded.children):
+                raise RegistryCleanerError("Could not read layers of tagged manifest {0}, "
+                                           "refusing to collect garbage".format(manifest))
+            marked.update(expanded.children)
+            marked.update(expanded.layers)
+        return marked
+
+    @timed("gc")
+    def garbage_collect(self):
+        """delete every blob no tagged manifest of any repository references
+
+        One mark pass follows the current link of every tag to its manifest,
+        layers and config, one sweep pass lists blobs/sha256. Links to swept
+        blobs (layer links, untagged revisions and their tag index entries)
+        are deleted along with them. Returns the number of bytes reclaimed.
+        """
+        logger.debug("Marking blobs referenced by tagged manifests")
+        marked = self._mark()
+        logger.debug("Marked %d blobs, sweeping blobs/sha256", len(marked))
+        swept = 0
+        reclaimed = 0
+        for digest, size in self._get_blobs():
+            if digest in marked or self._is_deleted(
+                    os.path.join(self.registry_data_dir, "blobs/sha256", digest[0:2], digest)):
+                continue
+            for repo, kind in sorted(self.link_index.references(digest)):
+                if kind == "layer":
+                    self._delete_layer(repo, digest, "unreferenced")
+                elif kind == "revision":
+                    self._delete_dir(os.path.join(self.repositories_dir, repo,
+                                                  "_manifests/revisions/sha256", digest),
+                                     kind="revision", digest=digest, reason="unreferenced")
+                elif kind == "tag_index":
+                    self._delete_from_tag_index_for_revision(repo, digest, "unreferenced")
+            if size is None:
+                size = self._blob_size(digest)
+            reclaimed += size
+            swept += 1
+            self._delete_blob(digest, "unreferenced", size)
+        logger.info("Garbage collection %s %d bytes in %d blobs",
+                    "would reclaim" if self.dry_run else "reclaimed", reclaimed, swept)
+        return reclaimed
+
+    def _tag_manifests(self, repo):
+        """(tag, manifest digest) of every tag of `repo`"""
+        tags_dir = os.path.join(self.repositories_dir, repo, "_manifests/tags")
+        try:
+            tags = self.storage.list_dir(tags_dir)
+        except OSError:
+            return []
 
+        def read(tag):
+            try:
+                return self.storage.read(os.path.join(tags_dir, tag, "current/link")).split(":")[1]
+            except (IOError, OSError, IndexError):
+                return None
+
+        return [(tag, digest) for tag, digest in zip(tags, self.storage.map(read, tags)) if digest]
+
+    def _blob_sizes(self, prefix):
+        """(digest, size of its data) of every blob in one prefix directory of blobs/sha256"""
+        return [(os.path.basename(os.path.dirname(path)), size)
+                for path, size in self.storage.file_sizes(prefix) if os.path.basename(path) == "data"]
+
+    @timed("usage")
+    def usage(self):
+        """bytes every repository and tag holds alone or shares with others, in one pass over blobs/sha256
+
+        A blob is exclusive to a repository if no other repository links it,
+        and exclusive to a tag if no other tag of any repository uses it and
+        no other repository links it: those bytes are what deleting the
+        repository or tag reclaims. Shared blobs count in full as shared
+        bytes of each owner and as 1/N of their size in its apportioned bytes,
+        so the apportioned bytes of all repositories add up to the bytes in
+        use. Untagged bytes are linked from a repository but used by no tag.
+        """
+        repos = self._get_repositories()
+        tag_keys = {}
+        tag_usage = {}
+        manifests = {}
+        for repo, tags in zip(repos, parallel_map(self._tag_manifests, repos, self.jobs)):
+            for tag, manifest in tags:
+                manifests.setdefault(manifest, []).append(tag_keys.setdefault((repo, tag), (repo, tag)))
+
+        # every manifest is parsed once, however many tags point to it
+        loaded = self._load_manifests(manifests)
+        for manifest, keys in manifests.items():
+            expanded = self._expand_manifest(loaded, manifest) or Manifest(frozenset(), frozenset())
+            for digest in expanded.layers | expanded.children | set([manifest]):
+                tag_usage.setdefault(pack_digest(digest), []).extend(keys)
+        del manifests, loaded
+
+        # exclusive, shared, apportioned and untagged bytes
+        repo_bytes = dict((repo, [0, 0, 0.0, 0]) for repo in repos)
+        tag_bytes = dict((key, [0, 0, 0.0]) for key in tag_keys.values())
+        report = {"blobs": 0, "total_bytes": 0, "unreferenced_bytes": 0, "untagged_bytes": 0}
+        link_index = self.link_index
+
+        root = os.path.join(self.registry_data_dir, "blobs/sha256")
+        prefixes = self.storage.scan_dir(root)[0] if self.storage.isdir(root) else []
+        chunk = max(self.jobs, 1) * 4
+        for start in range(0, len(prefixes), chunk):
+            for blobs in parallel_map(self._blob_sizes, prefixes[start:start + chunk], self.jobs):
+                for digest, size in blobs:
+                    report["blobs"] += 1
+                    report["total_bytes"] += size
+                    users = tag_usage.get(pack_digest(digest), ())
+                    owners = set(repo for repo, _ in link_index.references(digest))
+                    owners.update(repo for repo, _ in users)
+                    if not owners:
+                        report["unreferenced_bytes"] += size
+                        continue
+                    if not users:
+                        report["untagged_bytes"] += size
+                    for repo in owners:
+                        counts = repo_bytes.setdefault(repo, [0, 0, 0.0, 0])
+                        counts[0 if len(owners) == 1 else 1] += size
+                        counts[2] += float(size) / len(owners)
+                        if not users:
+                            counts[3] += size
+                    for key in users:
+                        counts = tag_bytes[key]
+                        counts[0 if len(users) == 1 and len(owners) == 1 else 1] += size
+                        counts[2] += float(size) / len(users)
+
+        tags_by_repo = {}
+        for (repo, tag), counts in tag_bytes.items():
+            tags_by_repo.setdefault(repo, []).append({
+                "tag": tag, "exclusive_bytes": counts[0], "shared_bytes": counts[1],
+                "apportioned_bytes": int(round(counts[2]))})
+        report["repositories"] = []
+        for repo, counts in repo_bytes.items():
+            tags = sorted(tags_by_repo.get(repo, []), key=lambda entry: (-entry["exclusive_bytes"], entry["tag"]))
+            report["repositories"].append({
+                "repository": repo, "exclusive_bytes": counts[0], "shared_bytes": counts[1],
+                "apportioned_bytes": int(round(counts[2])), "untagged_bytes": counts[3], "tags": tags})
+        report["repositories"].sort(key=lambda entry: (-entry["exclusive_bytes"], entry["repository"]))
+        return report
+
+    def log_cache_stats(self):
+        """report manifest cache efficiency in verbose output"""
+        logger.debug("Manifest cache: %d hits, %d misses, %d of %d entries used",
+                     self.manifest_cache.hits, self.manifest_cache.misses,
+                     len(self.manifest_cache), self.manifest_cache.maxsize)
 
     def get_tag_count(self, repo):
         logger.debug("Get tag count of repository '%s'", repo)
         repo_dir = os.path.join(self.registry_data_dir, "repositories", repo)
         tags_dir = os.path.join(repo_dir, "_manifests/tags")
 
-        if os.path.isdir(tags_dir):
-            tags = os.listdir(tags_dir)
+        if self.storage.isdir(tags_dir):
+            tags = [t for t in self.storage.list_dir(tags_dir)
+                    if os.path.join(tags_dir, t) not in self._deleted_paths]
             return len(tags)
         else:
             logger.info("Tags directory does not exist: '%s'", tags_dir)
             return -1
 
+    def delete_image(self, repo, tag=None):
+        """delete a tag, or the entire repository if no tag is given or it is the last one"""
+        if tag:
+            tag_count = self.get_tag_count(repo)
+            if tag_count == 1:
+                self.delete_entire_repository(repo)
+            else:
+                self.delete_repository_tag(repo, tag)
+        else:
+            self.delete_entire_repository(repo)
+
+    def delete_images(self, targets):
+        """delete many (repo, tag) targets against one link index
+
+        Blobs are only collected while the targets are processed and deleted
+        once at the end, if no link to them is left after the whole batch.
+        """
+        failed = []
+        self._batch_blobs = DigestSet()
+        try:
+            for repo, tag in targets:
+                try:
+                    self.delete_image(repo, tag)
+                except RegistryCleanerError as error:
+                    logger.error(error)
+                    failed.append((repo, tag))
+            blobs = self._batch_blobs
+        finally:
+            self._batch_blobs = None
+        self._protected_blobs = None
+
+        logger.debug("Batch freed %d candidate blobs", len(blobs))
+        for digest in sorted(blobs):
+            if self.link_index.is_referenced(digest):
+                self._keep_blob(digest, "still linked after batch")
+            else:
+                self._delete_blob(digest, "no links left after batch")
+
+        if failed:
+            raise RegistryCleanerError("Failed to delete {0} of {1} images: {2}".format(
+                len(failed), len(targets),
+                ", ".join(format_image(repo, tag) for repo, tag in failed)))
+
+    def _plan_path(self, relpath):
+        """absolute path of a plan record path, which must stay inside registry_data_dir"""
+        path = os.path.normpath(os.path.join(self.registry_data_dir, relpath))
+        if os.path.isabs(relpath) or os.path.relpath(path, self.registry_data_dir).startswith(os.pardir):
+            raise RegistryCleanerError("Plan path {0} is outside of REGISTRY_DATA_DIR {1}".
+                                       format(relpath, self.registry_data_dir))
+        return path
+
+    def resume_journal(self, records):
+        """plan the deletions a journal has no done record for, without scanning the registry
+
+        Paths already gone were deleted before the crash, only their done
+        records were lost.
+        """
+        resumed = 0
+        for record in records:
+            path = self._plan_path(record["path"])
+            if self.storage.has_directories and not self.storage.isdir(path):
+                logger.debug("Already deleted: %s", path)
+                continue
+            resumed += 1
+            if self.dry_run:
+                logger.info("DRY_RUN: would have deleted %s", path)
+            else:
+                self.plan.add(path, record.get("size", 0), record["kind"], record.get("digest"),
+                              record.get("reason"))
+        logger.info("Resuming %d of %d unfinished deletions of the journal", resumed, len(records))
+
+    def apply_plan(self, records):
+        """plan the deletions of a plan written with a plan output, e.g. by an earlier dry run
+
+        Every link is checked against the repository as it is now, like after
+        deleting manifests through the registry: tags moved since are kept, as
+        are revisions a tag points to again and layers a kept revision uses.
+        A repository is kept whole if it links anything the plan does not
+        mention. Blobs are checked against the link index after all of them.
+        """
+        blobs = DigestSet()
+        known = DigestSet()
+        planned = OrderedDict()
+        for record in records:
+            if record.get("digest"):
+                known.add(record["digest"])
+            if record.get("action") != "delete":
+                continue
+            path = self._plan_path(record["path"])
+            if not self.storage.isdir(path):
+                logger.warning("Planned path %s does not exist anymore", path)
+            elif record["kind"] == "blob":
+                blobs.add(record["digest"])
+            else:
+                planned.setdefault(self._repository_of(path), []).append((path, record))
+
+        for repo, items in planned.items():
+            in_use = self._in_use_since_planned(repo, items, known) if repo else set()
+            for path, record in items:
+                if path in in_use:
+                    logger.warning("Not deleting %s, it is in use again since the plan was written", path)
+                    self._keep(record["kind"], path, record.get("digest"), "in use again since planned")
+                else:
+                    self._delete_dir(path, record.get("size", 0), record["kind"],
+                                     record.get("digest"), record.get("reason"))
+
+        logger.debug("Plan deletes %d blobs", len(blobs))
+        for digest in sorted(blobs):
+            if self.link_index.is_referenced(digest):
+                logger.warning("Blob %s was linked again since the plan was written. Not deleting", digest)
+                self._keep_blob(digest, "linked again since planned")
+            else:
+                self._delete_blob(digest, "planned")
+
+    def _in_use_since_planned(self, repo, items, known):
+        """paths of the planned (path, record) deletions in `repo` that links changed since planning need"""
+        repo_dir = os.path.join(self.repositories_dir, repo)
+        in_use = set()
+        by_kind = {}
+        for path, record in items:
+            by_kind.setdefault(record["kind"], []).append((path, record.get("digest")))
+
+        if "repository" in by_kind and any(digest not in known for digest, _, _ in
+                                           self._links_under(repo_dir, skip_deleted=False)):
+            in_use.update(path for path, _ in by_kind["repository"])
+
+        # tags moved since planning stay, and so does whatever the tags left point to
+        tags_dir = os.path.join(repo_dir, "_manifests/tags")
+        planned_tags = dict(by_kind.get("tag", ()))
+        tagged = DigestSet()
+        for tag in self.storage.list_dir(tags_dir) if self.storage.isdir(tags_dir) else ():
+            tag_dir = os.path.join(tags_dir, tag)
+            current = get_digest_from_blob(os.path.join(tag_dir, "current/link"), self.storage)
+            if tag_dir in planned_tags and planned_tags[tag_dir] in (current, None):
+                continue
+            if tag_dir in planned_tags:
+                in_use.add(tag_dir)
+            if current:
+                tagged.add(current)
+        for manifest in list(tagged):
+            tagged.update(self._get_child_manifests(manifest))
+
+        planned_revisions = dict((digest, path) for path, digest in by_kind.get("revision", ()))
+        in_use.update(path for digest, path in planned_revisions.items() if digest in tagged)
+        revisions_dir = os.path.join(repo_dir, "_manifests/revisions/sha256")
+        revisions = self.storage.list_dir(revisions_dir) if self.storage.isdir(revisions_dir) else []
+        surviving = DigestSet(digest for digest in revisions
+                              if digest not in planned_revisions or planned_revisions[digest] in in_use)
+        layers = DigestSet()
+        for digest in surviving:
+            layers.update(self._get_layers_from_blob(digest))
+        in_use.update(path for path, digest in by_kind.get("layer", ()) if digest in layers)
+        in_use.update(path for path, digest in by_kind.get("tag_index", ()) if digest in surviving)
+        return in_use
+
+
+class Inotify(object):
+    """inotify watches on directories through ctypes, each with a key to tell them apart
+
+    Raises OSError where inotify is not available.
+    """
+
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x1000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+            IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library("c")
+        if not sys.platform.startswith("linux") or not libc_name:
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        self._libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._keys = {}
+        self.overflowed = False
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, path, key):
+        """watch the directory `path` for changes reported with `key`, return whether it worked"""
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                logger.warning("Out of inotify watches (see fs.inotify.max_user_watches), "
+                               "%s is only reconciled periodically", path)
+            return False
+        self._keys[wd] = key
+        return True
+
+    def read(self, timeout):
+        """keys of the watches with changes, waiting up to `timeout` seconds for the first"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+                offset += self.EVENT.size + length
+                if mask & self.IN_Q_OVERFLOW:
+                    self.overflowed = True
+                if wd in self._keys:
+                    changed.add(self._keys[wd])
+                if mask & self.IN_IGNORED:
+                    self._keys.pop(wd, None)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class RegistryDaemon(object):
+    """keeps the link index of one RegistryCleaner current and serves delete and gc requests
+
+    The links of every repository are scanned once. Afterwards inotify
+    watches on the link directories of each repository mark it dirty, and
+    only dirty repositories are scanned again before the next request. A
+    reconciliation every `reconcile_interval` seconds rescans repositories
+    whose signature (see repository_signature) changed, in case an event was
+    missed. Requests run one at a time.
+    """
+
+    # a key of the watches on directories above the repositories
+    TREE = ("tree",)
+
+    def __init__(self, cleaner, reconcile_interval=600, use_inotify=True):
+        if not cleaner.storage.has_directories:
+            raise RegistryCleanerError("The daemon needs a local REGISTRY_DATA_DIR")
+        # the sweep after deleting through the registry drops the link index the daemon keeps current
+        if cleaner.registry_client is not None:
+            raise RegistryCleanerError("The daemon does not delete through the registry API")
+        # forking a parse pool from the threads serving requests is not safe
+        if cleaner.parse_jobs > 1:
+            raise RegistryCleanerError("The daemon parses manifests in its own process only")
+        self.cleaner = cleaner
+        # a cleaner made with dry_run=True never deletes, whatever the requests say
+        self.dry_run = cleaner.dry_run
+        self.reconcile_interval = reconcile_interval
+        self.lock = threading.Lock()
+        self._dirty_lock = threading.Lock()
+        self._dirty = set()
+        self._rediscover = False
+        self._everything = False
+        self._digests = {}
+        self._signatures = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self.last_reconcile = None
+        self.watcher = None
+        if use_inotify:
+            try:
+                self.watcher = Inotify()
+            except OSError as error:
+                logger.warning("Not watching the registry, only reconciling it periodically: %s", error)
+
+    def _repo_dir(self, repo):
+        return os.path.join(self.cleaner.repositories_dir, repo)
+
+    def _watch_tree(self):
+        """watch the repositories directory and the namespaces in it for new repositories"""
+        if self.watcher is None:
+            return
+        root = self.cleaner.repositories_dir
+        self.watcher.add(root, self.TREE)
+        for path in scan_dir(root, follow_symlinks=True)[0]:
+            if not os.path.isdir(os.path.join(path, "_layers")):
+                self.watcher.add(path, self.TREE)
+
+    def _watch_repository(self, repo):
+        """watch every directory whose mtime the signature of `repo` depends on"""
+        if self.watcher is None:
+            return
+        repo_dir = self._repo_dir(repo)
+        paths = [repo_dir, os.path.join(repo_dir, "_layers"), os.path.join(repo_dir, "_layers/sha256"),
+                 os.path.join(repo_dir, "_manifests"), os.path.join(repo_dir, "_manifests/revisions/sha256"),
+                 os.path.join(repo_dir, "_manifests/tags")]
+        try:
+            tags = list_dir(paths[-1])
+        except OSError:
+            tags = []
+        for tag in tags:
+            paths.append(os.path.join(paths[5], tag, "current"))
+            paths.append(os.path.join(paths[5], tag, "index/sha256"))
+        for path in paths:
+            if os.path.isdir(path):
+                self.watcher.add(path, repo)
+
+    def _scan(self, repo):
+        """(signature, links) of `repo`, the signature taken first so changes meanwhile show up later"""
+        repo_dir = self._repo_dir(repo)
+        signature = repository_signature(repo_dir)
+        return signature, self.cleaner._links_under(repo_dir, skip_deleted=False)
+
+    def _index(self, repo, scanned):
+        """replace what the link index holds for `repo` with a new scan of it, None if it is gone"""
+        index = self.cleaner.link_index
+        index.drop_repository(repo, self._digests.pop(repo, ()))
+        self._signatures.pop(repo, None)
+        if scanned is None:
+            return
+        signature, links = scanned
+        for digest, link_repo, kind in links:
+            index.add(digest, link_repo, kind)
+        self._digests[repo] = DigestSet(digest for digest, _, _ in links)
+        self._signatures[repo] = signature
+        self._watch_repository(repo)
+
+    def load(self):
+        """scan every repository into a new link index and start watching them"""
+        cleaner = self.cleaner
+        with self.lock:
+            self._watch_tree()
+            repos = cleaner._get_repositories()
+            cleaner._link_index = LinkIndex()
+            self._digests = {}
+            self._signatures = {}
+            with stats.timer("link_index"):
+                for repo, scanned in zip(repos, parallel_map(self._scan, repos, cleaner.jobs)):
+                    self._index(repo, scanned)
+            self.last_reconcile = time.time()
+        logger.info("Loaded %d repositories with %d linked digests%s", len(repos), len(cleaner.link_index),
+                    ", {0} inotify watches".format(len(self.watcher)) if self.watcher else "")
+
+    def mark_dirty(self, repos=(), rediscover=False, everything=False):
+        """have `repos` (or every repository) scanned again before the next request"""
+        with self._dirty_lock:
+            self._dirty.update(repos)
+            self._rediscover = self._rediscover or rediscover
+            self._everything = self._everything or everything
+
+    def poll(self, timeout=0):
+        """mark the repositories inotify reported changes for as dirty"""
+        if self.watcher is None:
+            return
+        changed = self.watcher.read(timeout)
+        if self.watcher.overflowed:
+            # events were dropped, so any repository could have changed
+            self.watcher.overflowed = False
+            self.mark_dirty(rediscover=True, everything=True)
+            return
+        self.mark_dirty([key for key in changed if key is not self.TREE], self.TREE in changed)
+
+    def _refresh(self):
+        """scan the dirty repositories again; call with the lock held"""
+        self.poll()
+        with self._dirty_lock:
+            dirty, self._dirty = self._dirty, set()
+            rediscover, self._rediscover = self._rediscover, False
+            everything, self._everything = self._everything, False
+        if rediscover:
+            self._watch_tree()
+            repos = set(self.cleaner._get_repositories())
+            dirty.update(repos if everything else repos - set(self._digests))
+            dirty.update(set(self._digests) - repos)
+        if not dirty:
+            return
+        dirty = sorted(dirty)
+        logger.debug("Scanning %d changed repositories again", len(dirty))
+        with stats.timer("link_index"):
+            scans = parallel_map(lambda repo: self._scan(repo) if os.path.isdir(self._repo_dir(repo)) else None,
+                                 dirty, self.cleaner.jobs)
+            for repo, scanned in zip(dirty, scans):
+                self._index(repo, scanned)
+
+    def reconcile(self):
+        """rescan every repository whose signature changed without an event saying so"""
+        with self.lock:
+            self._refresh()
+            repos = self.cleaner._get_repositories()
+            signatures = parallel_map(lambda repo: repository_signature(self._repo_dir(repo)), repos,
+                                      self.cleaner.jobs)
+            changed = [repo for repo, signature in zip(repos, signatures) if self._signatures.get(repo) != signature]
+            changed.extend(set(self._digests) - set(repos))
+            if changed:
+                logger.info("Reconciliation found %d changed repositories", len(changed))
+            self.mark_dirty(changed)
+            self._refresh()
+            self.last_reconcile = time.time()
+        return len(changed)
+
+    def status(self):
+        """what the daemon holds"""
+        with self._dirty_lock:
+            dirty = len(self._dirty)
+        return {"repositories": len(self._digests), "digests": len(self.cleaner.link_index),
+                "dirty": dirty, "watches": len(self.watcher) if self.watcher else 0,
+                "last_reconcile": self.last_reconcile}
+
+    def run(self, operation, dry_run=False, prune=False, plan=False):
+        """plan and execute `operation(cleaner)` against the current link index, return its plan summary
+
+        The stats are those of this run only, they start over with every request.
+        """
+        cleaner = self.cleaner
+        with self.lock:
+            stats.reset()
+            start = time.time()
+            self._refresh()
+            cleaner.reset_run_state()
+            stream = io.StringIO()
+            cleaner.plan_writer = PlanWriter(stream, cleaner.registry_data_dir)
+            dry_run = dry_run or self.dry_run
+            cleaner.dry_run = dry_run
+            try:
+                operation(cleaner)
+                summary = cleaner.plan_writer.close()
+                cleaner.execute_plan()
+                if prune and not dry_run:
+                    cleaner.prune()
+            finally:
+                # the index dropped the links of everything planned, so those repositories are scanned again
+                touched = set(cleaner._repository_of(path) for path in cleaner._deleted_paths)
+                touched.discard(None)
+                self.mark_dirty(touched)
+                cleaner.plan_writer = None
+                cleaner.dry_run = self.dry_run
+                cleaner.reset_run_state()
+            result = {"summary": summary, "dry_run": dry_run, "seconds": round(time.time() - start, 6),
+                      "stats": stats.as_dict()}
+            if plan:
+                result["plan"] = list(read_plan(io.StringIO(stream.getvalue())))
+            return result
+
+    def _watch_loop(self):
+        while not self._stop.is_set():
+            wait = max(0, self.last_reconcile + self.reconcile_interval - time.time())
+            if self.watcher is not None:
+                self.poll(min(wait, 1.0))
+            else:
+                self._stop.wait(min(wait, 1.0))
+            if time.time() >= self.last_reconcile + self.reconcile_interval:
+                self.reconcile()
+
+    def start(self):
+        """watch and reconcile on a background thread"""
+        self._thread = threading.Thread(target=self._watch_loop)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.watcher is not None:
+            self.watcher.close()
+
+
+class DaemonRequestHandler(BaseHTTPRequestHandler):
+    """JSON API of a RegistryDaemon
+
+    GET /status, POST /reconcile, and POST /delete with {"images": ["repo:tag", "repo", ...]},
+    /untagged with {"repositories": [...]} or {"match": "regexp"} and /gc, each also taking
+    "dry_run", "prune" and "plan" (to return the plan records) flags. There is
+    no authentication, anyone who can connect can delete.
+    """
+
+    def log_message(self, format, *args):
+        logger.debug("Daemon request: " + format, *args)
+
+    def send_json(self, status, body):
+        data = json.dumps(body, sort_keys=True).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/status":
+            return self.send_json(200, self.server.registry_daemon.status())
+        self.send_json(404, {"error": "unknown path {0}".format(self.path)})
+
+    def do_POST(self):
+        daemon = self.server.registry_daemon
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length).decode() or "{}") if length else {}
+            if not isinstance(body, dict):
+                raise ValueError("request body must be a JSON object")
+            for key in ("images", "repositories"):
+                values = body.get(key, [])
+                if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+                    raise ValueError("{0} must be a list of strings".format(key))
+            if not isinstance(body.get("match", ""), str):
+                raise ValueError("match must be a string")
+        except ValueError as error:
+            return self.send_json(400, {"error": "invalid request: {0}".format(error)})
+        flags = dict((flag, bool(body.get(flag))) for flag in ("dry_run", "prune", "plan"))
+        if self.path == "/delete":
+            targets = [parse_image(image) for image in body.get("images", [])]
+            if not targets:
+                return self.send_json(400, {"error": "no images to delete"})
+
+            def operation(cleaner):
+                cleaner.delete_images(targets)
+        elif self.path == "/untagged":
+            if not body.get("repositories") and not body.get("match"):
+                return self.send_json(400, {"error": "no repositories or match given"})
+
+            def operation(cleaner):
+                repos = body.get("repositories") or cleaner.get_repositories_matching(body["match"])
+                cleaner.delete_untagged_repositories(repos)
+        elif self.path == "/gc":
+            def operation(cleaner):
+                cleaner.garbage_collect()
+        elif self.path == "/reconcile":
+            operation = None
+        else:
+            return self.send_json(404, {"error": "unknown path {0}".format(self.path)})
+        try:
+            if operation is None:
+                self.send_json(200, {"changed": daemon.reconcile()})
+            else:
+                self.send_json(200, daemon.run(operation, **flags))
+        except (RegistryCleanerError, re.error) as error:
+            logger.error(error)
+            self.send_json(409, {"error": str(error)})
+        except Exception as error:
+            logger.exception("Daemon request %s failed", self.path)
+            self.send_json(500, {"error": "{0}: {1}".format(type(error).__name__, error)})
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = socketserver.UnixStreamServer.get_request(self)
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        return request, ("local", 0)
+
+
+def daemon_server(daemon, address):
+    """HTTP server for `daemon` on a Unix socket path, or on a loopback host:port
+
+    The API has no authentication, so TCP is only served on loopback addresses.
+    """
+    if ":" in address and not address.startswith(("/", ".")):
+        host, port = address.rsplit(":", 1)
+        host = host.strip("[]")
+        try:
+            loopback = host == "localhost" or ipaddress.ip_address(host).is_loopback
+        except ValueError:
+            loopback = False
+        if not loopback:
+            raise RegistryCleanerError("Daemon requests are not authenticated, "
+                                       "only loopback addresses are served, not {0}".format(host))
+        server = ThreadingHTTPServer((host, int(port)), DaemonRequestHandler)
+    else:
+        if os.path.exists(address):
+            os.unlink(address)
+        server = UnixHTTPServer(address, DaemonRequestHandler)
+    server.registry_daemon = daemon
+    return server
+
+
+def serve_daemon(daemon, address):
+    """load `daemon` and serve its requests on `address` until interrupted"""
+    server = daemon_server(daemon, address)
+    daemon.load()
+    daemon.start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logger.info("Serving requests on %s", address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        daemon.stop()
+        if isinstance(server, UnixHTTPServer):
+            os.unlink(address)
+
+
+def parse_image(image):
+    """split `repo[:tag]` into (repo, tag)"""
+    splitted = image.split(":")
+    if len(splitted) == 2:
+        return splitted[0], splitted[1]
+    return image, None
+
+
+def format_image(repo, tag=None):
+    """inverse of parse_image"""
+    return "{0}:{1}".format(repo, tag) if tag else repo
+
+
+def read_images(stream):
+    """parse one `repo[:tag]` per line, skipping blank lines and # comments"""
+    result = []
+    for line in stream:
+        line = line.strip()
+        if line and not line.startswith("#"):
+            result.append(parse_image(line))
+    return result
+
+
+def format_size(size):
+    """human readable size in bytes"""
+    for unit in ("B", "KiB", "MiB", "GiB", "TiB"):
+        if size < 1024 or unit == "TiB":
+            return "{0:.0f} {1}".format(size, unit) if unit == "B" else "{0:.1f} {1}".format(size, unit)
+        size /= 1024.0
+
+
+def write_usage(report, stream, output_format="table"):
+    """write a report of RegistryCleaner.usage as JSON or as a table, largest exclusive bytes first"""
+    if output_format == "json":
+        json.dump(report, stream, indent=1, sort_keys=True)
+        stream.write("\n")
+        return
+    row = "{0:<50} {1:>12} {2:>12} {3:>12} {4:>12}\n"
+    stream.write(row.format("REPOSITORY / :TAG", "EXCLUSIVE", "SHARED", "APPORTIONED", "UNTAGGED"))
+    for repo in report["repositories"]:
+        stream.write(row.format(repo["repository"], format_size(repo["exclusive_bytes"]),
+                                format_size(repo["shared_bytes"]), format_size(repo["apportioned_bytes"]),
+                                format_size(repo["untagged_bytes"])))
+        for tag in repo["tags"]:
+            stream.write(row.format("  :" + tag["tag"], format_size(tag["exclusive_bytes"]),
+                                    format_size(tag["shared_bytes"]), format_size(tag["apportioned_bytes"]), ""))
+    stream.write("{0} in {1} blobs, {2} untagged, {3} not linked from any repository\n".format(
+        format_size(report["total_bytes"]), report["blobs"], format_size(report["untagged_bytes"]),
+        format_size(report["unreferenced_bytes"])))
+
+
+def setup_logging(verbose):
+    """attach a stream handler to the module logger"""
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(u'%(levelname)-8s [%(asctime)s]  %(message)s'))
+    logger.addHandler(handler)
+
+    if verbose:
+        logger.setLevel(logging.DEBUG)
+    else:
+        logger.setLevel(logging.INFO)
+
+
+def report_stats(show, path, success):
+    """log the stats if `show` is set and write them to `path` if given"""
+    if show:
+        stats.log_summary()
+    if path:
+        stats.write(path, success)
+
+
 def main():
     """cli entrypoint"""
     parser = argparse.ArgumentParser(description="Cleanup docker registry")
     parser.add_argument("-i", "--image",
                         dest="image",
-                        required=True,
                         help="Docker image to cleanup")
+    parser.add_argument("-b", "--batch",
+                        dest="batch",
+                        help="File with one image (repo or repo:tag) per line to cleanup in "
+                             "one run, or - to read them from stdin")
     parser.add_argument("-v", "--verbose",
                         dest="verbose",
                         action="store_true",
@@ -357,61 +2792,263 @@ def main():
     parser.add_argument("-p", "--prune",
                         dest="prune",
                         action="store_true",
-                        help="Prune")
+                        help="Prune directories left empty by this run")
+    parser.add_argument("--prune-all",
+                        dest="prune_all",
+                        action="store_true",
+                        help="Prune every empty directory in the registry")
     parser.add_argument("-u", "--untagged",
                         dest="untagged",
                         action="store_true",
-                        help="Delete all untagged blobs for image")
+                        help="Delete all untagged blobs for image, for every repository given "
+                             "with --batch or for every repository matching --match")
+    parser.add_argument("-m", "--match",
+                        dest="match",
+                        help="Regexp of repositories to delete untagged blobs from with --untagged")
+    parser.add_argument("-g", "--gc",
+                        dest="gc",
+                        action="store_true",
+                        help="Delete every blob not referenced by a tag of any repository, "
+                             "after the images given with --image or --batch")
+    parser.add_argument("--manifest-cache-size",
+                        dest="manifest_cache_size",
+                        type=int,
+                        default=DEFAULT_MANIFEST_CACHE_SIZE,
+                        help="Number of parsed manifests to keep in memory (default: %(default)s)")
+    parser.add_argument("-j", "--jobs",
+                        dest="jobs",
+                        type=int,
+                        default=1,
+                        help="Number of threads scanning the registry concurrently (default: %(default)s)")
+    parser.add_argument("--parse-jobs",
+                        dest="parse_jobs",
+                        type=int,
+                        default=1,
+                        help="Number of processes parsing manifests when many are read at once, e.g. "
+                             "to mark blobs for --gc or to protect tagged ones for --untagged "
+                             "(default: %(default)s)")
+    parser.add_argument("--delete-jobs",
+                        dest="delete_jobs",
+                        type=int,
+                        help="Number of threads deleting planned paths (default: same as --jobs)")
+    parser.add_argument("--index-file",
+                        dest="index_file",
+                        help="SQLite file persisting the link index between runs; only "
+                             "repositories changed since the last run are scanned again")
+    parser.add_argument("--rebuild-index",
+                        dest="rebuild_index",
+                        action="store_true",
+                        help="Rescan every repository into the index file")
+    parser.add_argument("--check-index",
+                        dest="check_index",
+                        action="store_true",
+                        help="Compare the link index against a full scan and fail if they differ")
+    parser.add_argument("--plan-output",
+                        dest="plan_output",
+                        help="Write every path deleted or kept, with its kind, digest, size and "
+                             "reason, as JSON lines to this file, or - for stdout")
+    parser.add_argument("--apply-plan",
+                        dest="apply_plan",
+                        help="Delete the paths of a plan written with --plan-output, or - to read it "
+                             "from stdin")
+    parser.add_argument("--journal",
+                        dest="journal",
+                        help="Append every planned deletion and its completion to this file, "
+                             "to --resume an interrupted run from it")
+    parser.add_argument("--resume",
+                        dest="resume",
+                        help="Delete what the journal of an interrupted run has not deleted yet, "
+                             "without scanning the registry again, and keep journaling to it")
+    parser.add_argument("--registry-url",
+                        dest="registry_url",
+                        help="Delete manifests through the API of the registry at this url "
+                             "(http[s]://[user:password@]host[:port]) while it keeps serving, then only "
+                             "sweep the links and blobs nothing uses any more from disk")
+    parser.add_argument("--s3-bucket",
+                        dest="s3_bucket",
+                        help="Clean a registry stored in this S3 bucket by the s3 storage driver, "
+                             "with REGISTRY_DATA_DIR as the rootdirectory followed by /docker/registry/v2 "
+                             "(default: /docker/registry/v2); needs boto3")
+    parser.add_argument("--s3-endpoint-url",
+                        dest="s3_endpoint_url",
+                        help="Endpoint of an S3 compatible storage, e.g. MinIO")
+    parser.add_argument("--s3-jobs",
+                        dest="s3_jobs",
+                        type=int,
+                        default=16,
+                        help="Number of concurrent S3 GET and DeleteObjects requests (default: %(default)s)")
+    parser.add_argument("--usage",
+                        dest="usage",
+                        nargs="?",
+                        const="table",
+                        choices=["table", "json"],
+                        help="Report the bytes each repository and tag holds alone, shares with others "
+                             "or holds untagged, as a table (default) or JSON, and delete nothing")
+    parser.add_argument("--daemon",
+                        dest="daemon",
+                        metavar="ADDRESS",
+                        help="Load the links of every repository once, keep them current with inotify "
+                             "and serve delete and gc requests over HTTP on this Unix socket path or "
+                             "loopback host:port, without authentication")
+    parser.add_argument("--reconcile-interval",
+                        dest="reconcile_interval",
+                        type=float,
+                        default=600,
+                        help="Seconds between scans of the daemon for changes inotify missed "
+                             "(default: %(default)s)")
+    parser.add_argument("--stats",
+                        dest="stats",
+                        action="store_true",
+                        help="Log the time spent per phase and counts of filesystem operations")
+    parser.add_argument("--stats-file",
+                        dest="stats_file",
+                        help="Write the stats as JSON to this file, or in the Prometheus text format "
+                             "if it ends in .prom")
     args = parser.parse_args()
 
+    if not (args.image or args.batch or args.match or args.gc or args.check_index or args.prune_all
+            or args.apply_plan or args.usage or args.resume or args.daemon):
+        parser.error("argument -i/--image is required")
+    if args.usage and (args.image or args.batch or args.untagged or args.gc or args.apply_plan):
+        parser.error("argument --usage: not allowed with arguments -i/--image, -b/--batch, "
+                     "-u/--untagged, -g/--gc or --apply-plan")
+    if args.apply_plan and (args.image or args.batch or args.untagged or args.gc):
+        parser.error("argument --apply-plan: not allowed with arguments -i/--image, -b/--batch, "
+                     "-u/--untagged or -g/--gc")
+    if args.resume and (args.image or args.batch or args.untagged or args.gc or args.apply_plan or args.usage):
+        parser.error("argument --resume: not allowed with arguments -i/--image, -b/--batch, "
+                     "-u/--untagged, -g/--gc, --apply-plan or --usage")
+    if args.daemon and (args.image or args.batch or args.untagged or args.gc or args.apply_plan or args.usage
+                        or args.resume or args.check_index or args.prune_all):
+        parser.error("argument --daemon: not allowed with arguments -i/--image, -b/--batch, -u/--untagged, "
+                     "-g/--gc, --apply-plan, --usage, --resume, --check-index or --prune-all")
+    if args.daemon and (args.s3_bucket or args.index_file or args.plan_output or args.registry_url):
+        parser.error("argument --daemon: not allowed with arguments --s3-bucket, --index-file, --plan-output "
+                     "or --registry-url")
+    if args.daemon and args.parse_jobs > 1:
+        parser.error("argument --parse-jobs: not allowed above 1 with argument --daemon")
+    if args.resume and args.journal and os.path.abspath(args.resume) != os.path.abspath(args.journal):
+        parser.error("argument --journal: not allowed with argument --resume of another journal")
+    if args.image and args.batch:
+        parser.error("argument -b/--batch: not allowed with argument -i/--image")
+    if args.match and not args.untagged:
+        parser.error("argument -m/--match: only allowed with argument -u/--untagged")
+    if args.match and (args.image or args.batch):
+        parser.error("argument -m/--match: not allowed with argument -i/--image or -b/--batch")
+    if args.untagged and not (args.image or args.batch or args.match):
+        parser.error("argument -u/--untagged: requires argument -i/--image, -b/--batch or -m/--match")
 
-    handler = logging.StreamHandler()
-    handler.setFormatter(logging.Formatter(u'%(levelname)-8s [%(asctime)s]  %(message)s'))
-    logger.addHandler(handler)
-
-    if args.verbose:
-        logger.setLevel(logging.DEBUG)
-    else:
-        logger.setLevel(logging.INFO)
-
+    setup_logging(args.verbose)
 
     # make sure not to log before logging is setup. that'll hose your logging config.
     if args.force:
         logger.info(
             "You supplied the force switch, which is deprecated. It has no effect now, and the script defaults to doing what used to be only happen when force was true")
 
-    splitted = args.image.split(":")
-    if len(splitted) == 2:
-        image = splitted[0]
-        tag = splitted[1]
-    else:
-        image = args.image
-        tag = None
+    if args.batch == "-":
+        targets = read_images(sys.stdin)
+    elif args.batch:
+        with open(args.batch) as stream:
+            targets = read_images(stream)
+    elif args.image:
+        image, tag = parse_image(args.image)
 
     if 'REGISTRY_DATA_DIR' in os.environ:
         registry_data_dir = os.environ['REGISTRY_DATA_DIR']
+    elif args.s3_bucket:
+        registry_data_dir = "/docker/registry/v2"
     else:
         registry_data_dir = "/opt/registry_data/docker/registry/v2"
 
+    plan_output = None
+    if args.plan_output == "-":
+        plan_output = sys.stdout
+    elif args.plan_output:
+        plan_output = open(args.plan_output, "w")
+
+    journal = None
     try:
-        cleaner = RegistryCleaner(registry_data_dir, dry_run=args.dry_run)
-        if args.untagged:
-            cleaner.delete_untagged(image)
-        else:
-            if tag:
-                tag_count = cleaner.get_tag_count(image)
-                if tag_count == 1:
-                    cleaner.delete_entire_repository(image)
-                else:
-                    cleaner.delete_repository_tag(image, tag)
-            else:
-                cleaner.delete_entire_repository(image)
+        pending = None
+        if args.resume:
+            with open(args.resume) as stream:
+                pending = read_journal(stream)
+        if (args.journal or args.resume) and not args.dry_run:
+            journal = DeletionJournal(args.journal or args.resume, registry_data_dir)
+        storage = None
+        if args.s3_bucket:
+            storage = S3Storage(args.s3_bucket, endpoint_url=args.s3_endpoint_url, jobs=args.s3_jobs)
+        cleaner = RegistryCleaner(registry_data_dir, dry_run=args.dry_run,
+                                  manifest_cache_size=args.manifest_cache_size,
+                                  jobs=args.jobs,
+                                  index_file=args.index_file,
+                                  rebuild_index=args.rebuild_index,
+                                  delete_jobs=args.delete_jobs,
+                                  plan_output=plan_output,
+                                  registry_client=RegistryClient(args.registry_url) if args.registry_url else None,
+                                  storage=storage,
+                                  journal=journal,
+                                  parse_jobs=args.parse_jobs)
+        if args.daemon:
+            serve_daemon(RegistryDaemon(cleaner, args.reconcile_interval), args.daemon)
+            return
+        if args.check_index:
+            differences = cleaner.check_link_index()
+            for digest in differences:
+                logger.debug("Link index differs from full scan for digest %s", digest)
+            if differences:
+                raise RegistryCleanerError("Link index differs from a full scan for {0} digests".
+                                           format(len(differences)))
+            logger.info("Link index matches a full scan")
+        if args.usage:
+            write_usage(cleaner.usage(), sys.stdout, args.usage)
+
+        # deletions are only planned by the operations and executed together afterwards
+        failure = None
+        with stats.timer("plan"):
+            try:
+                if args.untagged and args.match:
+                    cleaner.delete_untagged_repositories(cleaner.get_repositories_matching(args.match))
+                elif args.untagged and args.batch:
+                    cleaner.delete_untagged_repositories([repo for repo, _ in targets])
+                elif args.batch:
+                    cleaner.delete_images(targets)
+                elif args.untagged:
+                    cleaner.delete_untagged(image)
+                elif args.image:
+                    cleaner.delete_image(image, tag)
+                elif args.apply_plan == "-":
+                    cleaner.apply_plan(read_plan(sys.stdin))
+                elif args.apply_plan:
+                    with open(args.apply_plan) as stream:
+                        cleaner.apply_plan(read_plan(stream))
+                elif pending is not None:
+                    cleaner.resume_journal(pending)
+
+                if args.gc:
+                    cleaner.garbage_collect()
+            except RegistryCleanerError as error:
+                failure = error
+        if cleaner.plan_writer is not None:
+            summary = cleaner.plan_writer.close()
+            logger.info("Plan deletes %d paths reclaiming %d bytes, keeps %d paths",
+                        summary["delete"], summary["reclaimable_bytes"], summary["keep"])
+        cleaner.execute_plan()
+        if failure:
+            raise failure
 
-        if args.prune:
+        if args.prune_all:
+            cleaner.prune_all()
+        elif args.prune:
             cleaner.prune()
+        cleaner.log_cache_stats()
     except RegistryCleanerError as error:
         logger.fatal(error)
+        report_stats(args.stats, args.stats_file, False)
         sys.exit(1)
+    finally:
+        if journal is not None:
+            journal.close()
+    report_stats(args.stats, args.stats_file, True)
 
 
 if __name__ == "__main__":
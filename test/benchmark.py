@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+Usage:
+Time the cleaner's operations on generated registry trees of increasing size,
+each run in a fresh process on a fresh copy of the tree, and fail if a run got
+slower, needs more memory or opens, lists or deletes more than a saved baseline:
+benchmark.py --scales 10 100 1000 --output baseline.json
+benchmark.py --scales 10 100 1000 --baseline baseline.json
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import delete_docker_registry_image as cleaner_module  # noqa: E402
+from generate_registry_tree import generate_registry  # noqa: E402
+
+# every repository generated is named ns{r % 3}/repo{r} and has tags "0", "1", ...
+REPO = "ns0/repo0"
+TAG = "0"
+
+
+def delete_repository_tag(cleaner):
+    cleaner.delete_repository_tag(REPO, TAG)
+    cleaner.execute_plan()
+
+
+def delete_entire_repository(cleaner):
+    cleaner.delete_entire_repository(REPO)
+    cleaner.execute_plan()
+
+
+def delete_untagged(cleaner):
+    cleaner.delete_untagged(REPO)
+    cleaner.execute_plan()
+
+
+def prune(cleaner):
+    cleaner.prune_all()
+
+
+OPERATIONS = {
+    # name: (untimed setup run in a process of its own, timed operation)
+    "delete_repository_tag": (None, delete_repository_tag),
+    "delete_entire_repository": (None, delete_entire_repository),
+    "delete_untagged": (None, delete_untagged),
+    "prune": (delete_entire_repository, prune),
+}
+
+
+def read_io():
+    """read and write syscall counts of this process, None where /proc is not available"""
+    try:
+        with open("/proc/self/io") as stream:
+            fields = dict(line.split(":") for line in stream if ":" in line)
+    except (IOError, OSError):
+        return None
+    return {"syscr": int(fields["syscr"]), "syscw": int(fields["syscw"])}
+
+
+def run_setup(name, root, jobs):
+    """prepare `root` for an operation, in a process of its own so it does not count towards its peak memory"""
+    setup, _ = OPERATIONS[name]
+    if setup:
+        setup(cleaner_module.RegistryCleaner(root, jobs=jobs))
+
+
+def run_operation(name, root, jobs):
+    """run one operation in this process and return its measurements"""
+    _, operation = OPERATIONS[name]
+    cleaner = cleaner_module.RegistryCleaner(root, jobs=jobs)
+    cleaner_module.stats.reset()
+    io_before = read_io()
+    start = time.time()
+    operation(cleaner)
+    result = {"wall": time.time() - start}
+    io_after = read_io()
+    if io_before and io_after:
+        result["syscr"] = io_after["syscr"] - io_before["syscr"]
+        result["syscw"] = io_after["syscw"] - io_before["syscw"]
+    # kilobytes on Linux
+    result["maxrss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # files opened, directories listed, paths deleted and so on, as counted by the cleaner
+    result["counters"] = cleaner_module.stats.as_dict()["counters"]
+    return result
+
+
+def measure(name, pristine, workdir, jobs, repeat):
+    """best of `repeat` runs of an operation, each in a new process on a copy of `pristine`"""
+    best = None
+    for _ in range(repeat):
+        root = os.path.join(workdir, "run")
+        shutil.copytree(pristine, root, symlinks=True)
+        child = [sys.executable, os.path.abspath(__file__), "--child", name, root, "--jobs", str(jobs)]
+        try:
+            subprocess.check_call(child + ["--setup"])
+            output = subprocess.check_output(child)
+        finally:
+            shutil.rmtree(root)
+        result = json.loads(output.decode())
+        if best is None or result["wall"] < best["wall"]:
+            best = result
+    return best
+
+
+def metrics(result):
+    """metric name -> value of one measurement, with the cleaner's counters as counters.<name>"""
+    flat = dict((metric, result[metric]) for metric in ("wall", "syscr", "syscw", "maxrss_kb") if metric in result)
+    flat.update(("counters." + name, value) for name, value in result.get("counters", {}).items())
+    return flat
+
+
+def regressions(results, baseline, tolerance):
+    """descriptions of every measurement more than `tolerance` above its baseline"""
+    found = []
+    for key, result in sorted(results.items()):
+        expected = baseline.get(key)
+        if not expected:
+            continue
+        result, expected = metrics(result), metrics(expected)
+        for metric in sorted(result):
+            if metric not in expected:
+                continue
+            # the absolute margin keeps sub-millisecond timings from flapping
+            if result[metric] > expected[metric] * (1 + tolerance) and result[metric] - expected[metric] > 1e-3:
+                found.append("{0} {1}: {2:.4g} > {3:.4g}".format(key, metric, result[metric], expected[metric]))
+    return found
+
+
+def main():
+    """cli entrypoint"""
+    parser = argparse.ArgumentParser(description="Benchmark cleaner operations at increasing scales")
+    parser.add_argument("--child", nargs=2, metavar=("OPERATION", "ROOT"), help=argparse.SUPPRESS)
+    parser.add_argument("--setup", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--scales", type=int, nargs="+", default=[10, 50, 200],
+                        help="Numbers of repositories to generate")
+    parser.add_argument("--tags", type=int, default=10)
+    parser.add_argument("--layers", type=int, default=5)
+    parser.add_argument("--untagged", type=int, default=2, help="Untagged revisions per repository")
+    parser.add_argument("--schema1-ratio", type=float, default=0.2)
+    parser.add_argument("--shared-ratio", type=float, default=0.2,
+                        help="Share of each manifest's layers reused across repositories")
+    parser.add_argument("--operations", nargs="+", choices=sorted(OPERATIONS), default=sorted(OPERATIONS))
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per measurement, the fastest counts")
+    parser.add_argument("--output", help="Write the results as JSON to this file, e.g. as a baseline")
+    parser.add_argument("--baseline", help="Results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Allowed increase over the baseline (default: %(default)s)")
+    args = parser.parse_args()
+
+    if args.child and args.setup:
+        run_setup(args.child[0], args.child[1], args.jobs)
+        return
+    if args.child:
+        print(json.dumps(run_operation(args.child[0], args.child[1], args.jobs)))
+        return
+
+    results = {}
+    workdir = tempfile.mkdtemp(prefix="registry-bench-")
+    try:
+        for scale in args.scales:
+            pristine = os.path.join(workdir, "pristine-{0}".format(scale))
+            counts = generate_registry(pristine, scale, args.tags, args.layers, shared_ratio=args.shared_ratio,
+                                       schema1_ratio=args.schema1_ratio, untagged=args.untagged)
+            print("scale={0}: {1}".format(scale, json.dumps(counts, sort_keys=True)))
+            for name in args.operations:
+                result = measure(name, pristine, workdir, args.jobs, args.repeat)
+                results["{0}@{1}".format(name, scale)] = result
+                print("  {0:<26} wall={1:.4f}s syscr={2} syscw={3} maxrss={4}KiB {5}".format(
+                    name, result["wall"], result.get("syscr", "-"), result.get("syscw", "-"),
+                    result["maxrss_kb"], " ".join("{0}={1}".format(counter, value) for counter, value
+                                                  in sorted(result["counters"].items()))))
+            shutil.rmtree(pristine)
+    finally:
+        shutil.rmtree(workdir)
+
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as stream:
+            found = regressions(results, json.load(stream), args.tolerance)
+        for regression in found:
+            print("REGRESSION " + regression)
+        if found:
+            sys.exit(1)
+        print("No regressions against {0}".format(args.baseline))
+
+
+if __name__ == "__main__":
+    main()
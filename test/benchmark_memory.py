@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Usage:
+Measure the peak memory of holding a registry's link references, comparing
+the compact LinkIndex and DigestSet against plain sets of hex strings:
+benchmark_memory.py --links 1000000
+benchmark_memory.py --tree --repos 1000 --tags 100 --layers 8
+"""
+
+import argparse
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import delete_docker_registry_image as cleaner_module  # noqa: E402
+from generate_registry_tree import generate_registry  # noqa: E402
+
+KINDS = ("layer", "layer", "layer", "layer", "revision", "tag", "tag_index")
+
+
+def synthetic_links(count, repos, shared_ratio=0.2):
+    """(digest, repo, kind) tuples with a `shared_ratio` share of digests reused across repos"""
+    shared = int(count * shared_ratio) or 1
+    for i in range(count):
+        seed = i % shared if i % 5 == 0 else i
+        digest = hashlib.sha256(str(seed).encode()).hexdigest()
+        yield digest, "ns{0}/repo{1}".format(i % 10, i % repos), KINDS[i % len(KINDS)]
+
+
+def build_hex_index(links):
+    """the representation the cleaner used before: hex strings mapped to dicts of counts"""
+    index = {}
+    for digest, repo, kind in links:
+        entries = index.setdefault(digest, {})
+        entries[(repo, kind)] = entries.get((repo, kind), 0) + 1
+    return index
+
+
+def build_link_index(links):
+    """the compact LinkIndex"""
+    index = cleaner_module.LinkIndex()
+    for digest, repo, kind in links:
+        index.add(digest, repo, kind)
+    return index
+
+
+def peak(func):
+    """(peak bytes traced while running `func`, result)"""
+    tracemalloc.start()
+    result = func()
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak_bytes, result
+
+
+def tree_links(cleaner):
+    """(digest, repo, kind) of every link of a registry tree, read from disk"""
+    for repo in cleaner._get_repositories():
+        for link in cleaner._links_under(os.path.join(cleaner.repositories_dir, repo)):
+            yield link
+
+
+def report(name, peak_bytes, links):
+    print("{0:<22} peak={1:>8.1f} MiB  {2:>6.1f} bytes/link".format(
+        name, peak_bytes / 1048576.0, peak_bytes / float(max(links, 1))))
+
+
+def main():
+    """cli entrypoint"""
+    parser = argparse.ArgumentParser(description="Benchmark memory of link references")
+    parser.add_argument("--links", type=int, default=1000000,
+                        help="Number of synthetic links held in memory")
+    parser.add_argument("--repos", type=int, default=4000)
+    parser.add_argument("--tree", action="store_true",
+                        help="Generate a registry tree on disk and index it with RegistryCleaner")
+    parser.add_argument("--tags", type=int, default=100)
+    parser.add_argument("--layers", type=int, default=8)
+    args = parser.parse_args()
+
+    # links are generated while measuring, like digests read from link files would be
+    root = None
+    if args.tree:
+        root = tempfile.mkdtemp(prefix="registry-bench-")
+        print("Generated {0}: {1}".format(root, generate_registry(root, args.repos, args.tags, args.layers)))
+        cleaner = cleaner_module.RegistryCleaner(root)
+        links = lambda: tree_links(cleaner)
+    else:
+        links = lambda: synthetic_links(args.links, args.repos)
+
+    try:
+        count = sum(1 for _ in links())
+        print("{0} links".format(count))
+        report("hex dict index", peak(lambda: build_hex_index(links()))[0], count)
+        report("LinkIndex", peak(lambda: build_link_index(links()))[0], count)
+        report("set of hex digests", peak(lambda: set(link[0] for link in links()))[0], count)
+        report("DigestSet", peak(lambda: cleaner_module.DigestSet(link[0] for link in links()))[0], count)
+    finally:
+        if root:
+            shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Usage:
+Compare serial and threaded registry scanning on a generated tree and check
+that both return the same links:
+benchmark_scan.py --repos 200 --tags 10 --jobs 1 4 16
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import delete_docker_registry_image as cleaner_module  # noqa: E402
+from generate_registry_tree import generate_registry  # noqa: E402
+
+
+def timed(func):
+    """run `func` and return (seconds, result)"""
+    start = time.time()
+    result = func()
+    return time.time() - start, result
+
+
+def scan(root, jobs):
+    """the scans a delete run does: repository discovery, link index and all links"""
+    cleaner = cleaner_module.RegistryCleaner(root, jobs=jobs)
+    repositories_dir = os.path.join(root, "repositories")
+    results = {}
+    times = {}
+    times["repositories"], results["repositories"] = timed(cleaner._get_repositories)
+    times["link_index"], index = timed(cleaner._build_link_index)
+    results["link_index"] = sorted((digest, sorted(entries)) for digest, entries in index.items())
+    times["get_links"], links = timed(lambda: cleaner_module.get_links(repositories_dir, jobs=jobs))
+    results["get_links"] = sorted(links)
+    return times, results
+
+
+def main():
+    """cli entrypoint"""
+    parser = argparse.ArgumentParser(description="Benchmark serial against threaded scanning")
+    parser.add_argument("--root", help="Existing registry tree to scan instead of generating one")
+    parser.add_argument("--repos", type=int, default=200)
+    parser.add_argument("--tags", type=int, default=10)
+    parser.add_argument("--layers", type=int, default=5)
+    parser.add_argument("--jobs", type=int, nargs="+", default=[1, 4, 16])
+    args = parser.parse_args()
+
+    root = args.root
+    if not root:
+        root = tempfile.mkdtemp(prefix="registry-bench-")
+        print("Generating {0}: {1}".format(root, generate_registry(root, args.repos, args.tags, args.layers)))
+    try:
+        baseline = None
+        for jobs in args.jobs:
+            times, results = scan(root, jobs)
+            if baseline is None:
+                baseline = results
+            elif results != baseline:
+                print("jobs={0}: results differ from jobs={1}".format(jobs, args.jobs[0]))
+                sys.exit(1)
+            print("jobs={0:<3} ".format(jobs) +
+                  "  ".join("{0}={1:.3f}s".format(name, times[name]) for name in sorted(times)))
+    finally:
+        if not args.root:
+            shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
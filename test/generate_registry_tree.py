@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Usage:
+Generate a synthetic docker/registry/v2 storage tree, to run the cleaner and
+its benchmarks against without docker or a running registry:
+generate_registry_tree.py /tmp/registry --repos 100 --tags 10 --layers 8
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+
+
+def write_file(path, content):
+    """write `content` to `path`, creating parent directories"""
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    with open(path, "wb") as out:
+        out.write(content)
+
+
+def write_blob(root, content):
+    """store `content` under blobs/sha256 and return its digest"""
+    digest = hashlib.sha256(content).hexdigest()
+    write_file(os.path.join(root, "blobs/sha256", digest[0:2], digest, "data"), content)
+    return digest
+
+
+def write_link(path, digest):
+    """write a link file pointing at `digest` inside directory `path`"""
+    write_file(os.path.join(path, "link"), ("sha256:" + digest).encode())
+
+
+def schema2_manifest(repo, tag, layers, config, layer_size=0, config_size=0):
+    return {
+        "schemaVersion": 2,
+        "mediaType": "application/vnd.docker.distribution.manifest.v2+json",
+        "config": {"mediaType": "application/vnd.docker.container.image.v1+json",
+                   "size": config_size, "digest": "sha256:" + config},
+        "layers": [{"mediaType": "application/vnd.docker.image.rootfs.diff.tar.gzip",
+                    "size": layer_size, "digest": "sha256:" + layer} for layer in layers],
+    }
+
+
+def schema1_manifest(repo, tag, layers, created):
+    return {
+        "schemaVersion": 1,
+        "name": repo,
+        "tag": tag,
+        "fsLayers": [{"blobSum": "sha256:" + layer} for layer in layers],
+        "history": [{"v1Compatibility": json.dumps({"created": created})} for _ in layers],
+    }
+
+
+def generate_registry(root, repos=10, tags=5, layers=5, shared_ratio=0.2,
+                      namespaces=3, layer_size=64, seed=0, schema1_ratio=0.0, untagged=0):
+    """build a registry tree under `root` and return counts of what was written
+
+    Every manifest gets `layers` layers; a `shared_ratio` share of them is drawn
+    from a pool of layers reused across all repositories, the rest is unique.
+    A `schema1_ratio` share of the manifests is written as schema 1, without a
+    config blob, and every repository gets `untagged` revisions no tag points to.
+    """
+    rnd = random.Random(seed)
+    counts = {"repositories": 0, "tags": 0, "untagged": 0, "blobs": 0, "links": 0}
+
+    shared_count = int(round(layers * shared_ratio))
+    shared_pool = [write_blob(root, "shared layer {0}".format(i).encode().ljust(layer_size))
+                   for i in range(max(shared_count * 2, 1))]
+    counts["blobs"] += len(shared_pool)
+
+    for r in range(repos):
+        repo = "ns{0}/repo{1}".format(r % namespaces, r) if namespaces else "repo{0}".format(r)
+        repo_dir = os.path.join(root, "repositories", repo)
+        counts["repositories"] += 1
+        for t in range(tags + untagged):
+            name = str(t) if t < tags else "untagged{0}".format(t - tags)
+            unique = [write_blob(root, "layer {0} {1} {2}".format(r, name, i).encode().ljust(layer_size))
+                      for i in range(layers - shared_count)]
+            shared = rnd.sample(shared_pool, min(shared_count, len(shared_pool)))
+            created = "2016-{0:02d}-{1:02d}T00:00:00.000000000Z".format(t % 12 + 1, r % 28 + 1)
+            linked = unique + shared
+            if schema1_ratio and rnd.random() < schema1_ratio:
+                manifest = schema1_manifest(repo, name, linked, created)
+            else:
+                config_data = json.dumps({"created": created, "repo": repo, "tag": t}).encode()
+                config = write_blob(root, config_data)
+                counts["blobs"] += 1
+                manifest = schema2_manifest(repo, name, linked, config, layer_size, len(config_data))
+                linked = linked + [config]
+            manifest = write_blob(root, json.dumps(manifest, indent=3).encode())
+            counts["blobs"] += len(unique) + 1
+
+            for layer in linked:
+                write_link(os.path.join(repo_dir, "_layers/sha256", layer), layer)
+            write_link(os.path.join(repo_dir, "_manifests/revisions/sha256", manifest), manifest)
+            counts["links"] += len(linked) + 1
+            if t >= tags:
+                counts["untagged"] += 1
+                continue
+            tag_dir = os.path.join(repo_dir, "_manifests/tags", name)
+            write_link(os.path.join(tag_dir, "current"), manifest)
+            write_link(os.path.join(tag_dir, "index/sha256", manifest), manifest)
+            counts["tags"] += 1
+            counts["links"] += 2
+
+    return counts
+
+
+def main():
+    """cli entrypoint"""
+    parser = argparse.ArgumentParser(description="Generate a synthetic registry storage tree")
+    parser.add_argument("root", help="Directory to create the registry tree in")
+    parser.add_argument("--repos", type=int, default=10, help="Number of repositories")
+    parser.add_argument("--tags", type=int, default=5, help="Tags per repository")
+    parser.add_argument("--layers", type=int, default=5, help="Layers per manifest")
+    parser.add_argument("--shared-ratio", type=float, default=0.2,
+                        help="Share of each manifest's layers reused across repositories")
+    parser.add_argument("--namespaces", type=int, default=3,
+                        help="Number of namespaces repositories are spread over (0 for none)")
+    parser.add_argument("--layer-size", type=int, default=64, help="Minimum size of a layer blob")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--schema1-ratio", type=float, default=0.0,
+                        help="Share of manifests written as schema 1 instead of schema 2")
+    parser.add_argument("--untagged", type=int, default=0,
+                        help="Untagged revisions per repository")
+    args = parser.parse_args()
+
+    counts = generate_registry(args.root, args.repos, args.tags, args.layers, args.shared_ratio,
+                               args.namespaces, args.layer_size, args.seed, args.schema1_ratio,
+                               args.untagged)
+    print(json.dumps(counts, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
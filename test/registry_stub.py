@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Usage:
+Serve the v2 API of a registry over a docker/registry/v2 storage tree, like a
+running registry would, so the API mode of the cleaner and clean_old_versions.py
+can be tried without docker:
+registry_stub.py /tmp/registry --port 5000
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+
+
+def read_link(path):
+    """digest a link file points to, None if there is none"""
+    try:
+        with open(path) as link:
+            return link.read().split(":")[1]
+    except (IOError, OSError, IndexError):
+        return None
+
+
+class RegistryStubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def root(self):
+        return self.server.root
+
+    def repo_dir(self, name):
+        return os.path.join(self.root, "repositories", name)
+
+    def blob_data(self, digest):
+        return os.path.join(self.root, "blobs/sha256", digest[0:2], digest, "data")
+
+    def send(self, status, body=b"", headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def error(self, status, code):
+        self.send(status, {"errors": [{"code": code}]})
+
+    def route(self):
+        """(name, kind, reference) of a /v2/<name>/<kind>/<reference> path"""
+        path = unquote(urlparse(self.path).path)
+        for kind in ("manifests", "blobs", "tags"):
+            marker = "/{0}/".format(kind)
+            if path.startswith("/v2/") and marker in path:
+                name, reference = path[len("/v2/"):].rsplit(marker, 1)
+                return name, kind, reference
+        return None, path, None
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append((self.command, self.path))
+            self.server.clients.add(self.client_address)
+            status = self.server.fail_requests.pop(0) if self.server.fail_requests else None
+        if status is not None:
+            return self.error(status, "UNAVAILABLE")
+        name, kind, reference = self.route()
+        if kind == "/v2/":
+            return self.send(200, {})
+        if kind == "/v2/_catalog":
+            repositories = []
+            base = os.path.join(self.root, "repositories")
+            for dirpath, dirnames, _ in os.walk(base):
+                if "_layers" in dirnames:
+                    repositories.append(os.path.relpath(dirpath, base))
+                    dirnames[:] = []
+            return self.send(200, {"repositories": sorted(repositories)})
+        if kind == "tags" and reference == "list":
+            tags_dir = os.path.join(self.repo_dir(name), "_manifests/tags")
+            if not os.path.isdir(tags_dir):
+                return self.error(404, "NAME_UNKNOWN")
+            return self.send(200, {"name": name, "tags": sorted(os.listdir(tags_dir))})
+        if kind == "manifests":
+            if reference.startswith("sha256:"):
+                digest = reference.split(":")[1]
+                link = os.path.join(self.repo_dir(name), "_manifests/revisions/sha256", digest, "link")
+                digest = read_link(link)
+            else:
+                digest = read_link(os.path.join(self.repo_dir(name), "_manifests/tags", reference, "current/link"))
+            if not digest or not os.path.isfile(self.blob_data(digest)):
+                return self.error(404, "MANIFEST_UNKNOWN")
+            with open(self.blob_data(digest), "rb") as blob:
+                body = blob.read()
+            media_type = json.loads(body.decode()).get("mediaType", "application/vnd.docker.distribution.manifest.v1+json")
+            return self.send(200, body, {"Docker-Content-Digest": "sha256:" + digest, "Content-Type": media_type})
+        if kind == "blobs":
+            digest = reference.split(":")[-1]
+            if not read_link(os.path.join(self.repo_dir(name), "_layers/sha256", digest, "link")) or \
+                    not os.path.isfile(self.blob_data(digest)):
+                return self.error(404, "BLOB_UNKNOWN")
+            with open(self.blob_data(digest), "rb") as blob:
+                return self.send(200, blob.read(), {"Docker-Content-Digest": "sha256:" + digest})
+        return self.error(404, "UNSUPPORTED")
+
+    do_HEAD = do_GET
+
+    def do_DELETE(self):
+        with self.server.lock:
+            self.server.requests.append((self.command, self.path))
+            if self.server.fail_deletes:
+                return self.error(500, "UNKNOWN")
+            name, kind, reference = self.route()
+            if kind != "manifests" or not reference.startswith("sha256:"):
+                return self.error(405, "UNSUPPORTED")
+            digest = reference.split(":")[1]
+            revision_dir = os.path.join(self.repo_dir(name), "_manifests/revisions/sha256", digest)
+            if not os.path.isdir(revision_dir):
+                return self.error(404, "MANIFEST_UNKNOWN")
+            # like the registry: delete the revision link and untag every tag pointing to it
+            shutil.rmtree(revision_dir)
+            tags_dir = os.path.join(self.repo_dir(name), "_manifests/tags")
+            for tag in os.listdir(tags_dir) if os.path.isdir(tags_dir) else []:
+                if read_link(os.path.join(tags_dir, tag, "current/link")) == digest:
+                    shutil.rmtree(os.path.join(tags_dir, tag))
+            return self.send(202)
+
+
+class RegistryStub(ThreadingHTTPServer):
+    """v2 API over the storage tree at `root`, recording every request in `requests`
+
+    The next GET and HEAD requests are answered with the statuses queued in
+    `fail_requests`, and `clients` collects the address of every connection.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, root, port=0):
+        ThreadingHTTPServer.__init__(self, ("127.0.0.1", port), RegistryStubHandler)
+        self.root = root
+        self.requests = []
+        self.fail_deletes = False
+        self.fail_requests = []
+        self.clients = set()
+        self.lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{0}".format(self.server_address[1])
+
+    def start(self):
+        """serve on a background thread"""
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+
+def main():
+    """cli entrypoint"""
+    parser = argparse.ArgumentParser(description="Serve the registry v2 API over a storage tree")
+    parser.add_argument("root", help="docker/registry/v2 directory to serve")
+    parser.add_argument("--port", type=int, default=5000)
+    args = parser.parse_args()
+    server = RegistryStub(args.root, args.port)
+    print("Serving {0} on {1}".format(args.root, server.url))
+    sys.stdout.flush()
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
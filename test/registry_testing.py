@@ -0,0 +1,66 @@
+"""
+Shared setup of the offline tests, which all run without docker with:
+python -m unittest discover -s test -p 'test_*.py'
+"""
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TEST_DIR, ".."))
+
+import delete_docker_registry_image as cleaner_module  # noqa: E402
+from generate_registry_tree import generate_registry, write_link  # noqa: E402
+
+
+def files_under(root):
+    """relative path of every file below `root`; empty directories do not matter to the registry"""
+    result = set()
+    for dirpath, _, filenames in os.walk(root):
+        result.update(os.path.relpath(os.path.join(dirpath, name), root) for name in filenames)
+    return result
+
+
+def push_copy(root, repo, tag, to_repo, to_tag):
+    """link the manifest of `repo`:`tag` and its blobs as `to_repo`:`to_tag`, like a cross-repository push"""
+    repo_dir = os.path.join(root, "repositories", repo)
+    manifest = cleaner_module.get_digest_from_blob(os.path.join(repo_dir, "_manifests/tags", tag, "current/link"))
+    with open(os.path.join(root, "blobs/sha256", manifest[0:2], manifest, "data"), "rb") as blob:
+        layers, _, _ = cleaner_module.parse_manifest(blob.read())
+    to_dir = os.path.join(root, "repositories", to_repo)
+    for layer in layers:
+        write_link(os.path.join(to_dir, "_layers/sha256", layer), layer)
+    write_link(os.path.join(to_dir, "_manifests/revisions/sha256", manifest), manifest)
+    write_link(os.path.join(to_dir, "_manifests/tags", to_tag, "index/sha256", manifest), manifest)
+    write_link(os.path.join(to_dir, "_manifests/tags", to_tag, "current"), manifest)
+
+
+def quiet_cleaner():
+    """silence the cleaner's logging, the assertions report what went wrong"""
+    cleaner_module.logger.setLevel(logging.CRITICAL + 1)
+
+
+class RegistryTreeTest(unittest.TestCase):
+    """a generated registry tree in self.root and an untouched copy of it in self.expected_root"""
+
+    tree = {"repos": 4, "tags": 3, "layers": 4, "untagged": 2, "schema1_ratio": 0.3}
+
+    def setUp(self):
+        quiet_cleaner()
+        cleaner_module.stats.reset()
+        self.workdir = tempfile.mkdtemp(prefix="registry-test-")
+        self.root = os.path.join(self.workdir, "registry")
+        generate_registry(self.root, **self.tree)
+        self.expected_root = os.path.join(self.workdir, "expected")
+        shutil.copytree(self.root, self.expected_root)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def assert_same_tree(self):
+        """check that self.root holds the same files as self.expected_root"""
+        self.assertEqual(files_under(self.expected_root), files_under(self.root))
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+Serve requests from the cleaner's daemon mode on a generated registry tree,
+comparing what is left with one-shot runs on a copy.
+"""
+
+import http.client
+import json
+import os
+import shutil
+import socket
+import threading
+import unittest
+
+from registry_testing import RegistryTreeTest, cleaner_module, files_under, push_copy
+
+REPO = "ns0/repo0"
+OTHER_REPO = "ns1/repo1"
+
+
+def links(daemon):
+    return dict((digest, sorted(entries)) for digest, entries in daemon.cleaner.link_index.items())
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path):
+        http.client.HTTPConnection.__init__(self, "localhost")
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+class DaemonTest(RegistryTreeTest):
+
+    def setUp(self):
+        RegistryTreeTest.setUp(self)
+        self.daemons = []
+
+    def tearDown(self):
+        for daemon in self.daemons:
+            daemon.stop()
+        RegistryTreeTest.tearDown(self)
+
+    def daemon(self, **kwargs):
+        daemon = cleaner_module.RegistryDaemon(cleaner_module.RegistryCleaner(self.root, jobs=2), **kwargs)
+        self.daemons.append(daemon)
+        daemon.load()
+        return daemon
+
+    def one_shot(self, operation):
+        cleaner = cleaner_module.RegistryCleaner(self.expected_root)
+        operation(cleaner)
+        cleaner.execute_plan()
+        cleaner.prune()
+
+    def test_requests_match_one_shot_runs(self):
+        daemon = self.daemon()
+        operations = [
+            lambda cleaner: cleaner.delete_images([(REPO, "0"), ("ns2/repo2", None)]),
+            lambda cleaner: cleaner.delete_untagged_repositories(["ns1/repo1", "ns0/repo3"]),
+            lambda cleaner: cleaner.garbage_collect(),
+        ]
+        for operation in operations:
+            before = files_under(self.root)
+            result = daemon.run(operation, dry_run=True, plan=True)
+            self.assertEqual(before, files_under(self.root))
+            self.assertEqual(result["summary"]["delete"],
+                             len([record for record in result["plan"] if record["action"] == "delete"]))
+
+            daemon.run(operation, prune=True)
+            self.one_shot(operation)
+            self.assert_same_tree()
+
+    def test_stats_start_over_with_every_request(self):
+        daemon = self.daemon()
+
+        def operation(cleaner):
+            cleaner.delete_untagged_repositories(["ns1/repo1", "ns0/repo3"])
+
+        planned = [daemon.run(operation, dry_run=True)["stats"]["counters"]["paths_planned"] for _ in range(2)]
+        self.assertTrue(planned[0])
+        self.assertEqual([planned[0]] * 2, planned)
+        self.assertEqual(planned[0], cleaner_module.stats.as_dict()["counters"]["paths_planned"])
+
+    def test_inotify_sees_push_sharing_layers(self):
+        daemon = self.daemon()
+        if daemon.watcher is None:
+            self.skipTest("needs inotify")
+        for root in (self.root, self.expected_root):
+            push_copy(root, REPO, "0", OTHER_REPO, "pushed")
+        daemon.run(lambda cleaner: cleaner.delete_repository_tag(REPO, "0"))
+        self.one_shot(lambda cleaner: cleaner.delete_repository_tag(REPO, "0"))
+        self.assert_same_tree()
+        daemon.reconcile()
+        self.assertEqual(links(daemon), links(self.daemon()))
+
+    def test_reconcile_without_inotify(self):
+        daemon = self.daemon(use_inotify=False)
+        for root in (self.root, self.expected_root):
+            push_copy(root, REPO, "0", OTHER_REPO, "pushed")
+            shutil.rmtree(os.path.join(root, "repositories/ns2/repo2"))
+        self.assertEqual(2, daemon.reconcile())
+        self.assertEqual(3, daemon.status()["repositories"])
+        daemon.run(lambda cleaner: cleaner.delete_repository_tag(REPO, "0"))
+        self.one_shot(lambda cleaner: cleaner.delete_repository_tag(REPO, "0"))
+        self.assert_same_tree()
+
+    def test_http_over_unix_socket(self):
+        daemon = self.daemon()
+        path = os.path.join(self.workdir, "daemon.sock")
+        server = cleaner_module.daemon_server(daemon, path)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            def request(method, url, body=None):
+                connection = UnixHTTPConnection(path)
+                connection.request(method, url, json.dumps(body) if body is not None else None)
+                response = connection.getresponse()
+                result = response.status, json.loads(response.read().decode())
+                connection.close()
+                return result
+
+            status, body = request("GET", "/status")
+            self.assertEqual(200, status)
+            self.assertEqual(4, body["repositories"])
+
+            status, body = request("POST", "/delete", {"images": [REPO + ":0"], "dry_run": True, "plan": True})
+            self.assertEqual(200, status)
+            self.assertTrue(body["dry_run"])
+            self.assertIn("tag", set(record["kind"] for record in body["plan"]))
+            self.assert_same_tree()
+
+            status, body = request("POST", "/delete", {"images": [REPO + ":missing"]})
+            self.assertEqual(409, status)
+            self.assert_same_tree()
+
+            self.assertEqual(400, request("POST", "/delete", {})[0])
+            # deleting untagged revisions everywhere takes an explicit "match": "."
+            self.assertEqual(400, request("POST", "/untagged", {})[0])
+            self.assertEqual(400, request("POST", "/untagged", {"repositories": []})[0])
+            for body in ({"repositories": REPO}, {"images": REPO + ":0"}, {"images": [0]}, {"match": 1}):
+                self.assertEqual(400, request("POST", "/untagged" if "images" not in body else "/delete", body)[0])
+            self.assert_same_tree()
+            self.assertEqual(404, request("GET", "/nothing")[0])
+
+            status, body = request("POST", "/gc", {"prune": True})
+            self.assertEqual(200, status)
+            self.one_shot(lambda cleaner: cleaner.garbage_collect())
+            self.assert_same_tree()
+
+            # storage errors are answered too, and the daemon keeps serving
+            os.makedirs(os.path.join(self.root, "repositories/ns5/broken/_manifests/tags"))
+            status, body = request("POST", "/untagged", {"repositories": ["ns5/broken"]})
+            self.assertEqual(500, status)
+            self.assertIn("error", body)
+            self.assertEqual(200, request("GET", "/status")[0])
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+    def test_registry_api_and_parse_pool_are_refused(self):
+        client = cleaner_module.RegistryClient("http://localhost:5000")
+        for cleaner in (cleaner_module.RegistryCleaner(self.root, registry_client=client),
+                        cleaner_module.RegistryCleaner(self.root, parse_jobs=4)):
+            with self.assertRaises(cleaner_module.RegistryCleanerError):
+                cleaner_module.RegistryDaemon(cleaner)
+
+    def test_tcp_only_on_loopback(self):
+        daemon = self.daemon()
+        for address in ("0.0.0.0:0", "192.0.2.1:0", "registry.example.com:0"):
+            with self.assertRaises(cleaner_module.RegistryCleanerError):
+                cleaner_module.daemon_server(daemon, address)
+        server = cleaner_module.daemon_server(daemon, "127.0.0.1:0")
+        server.server_close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Delete many images in one batch against one link index, comparing what is
+left with deleting them one at a time on a copy.
+"""
+
+import io
+import os
+import subprocess
+import sys
+import unittest
+
+from registry_testing import TEST_DIR, RegistryTreeTest, cleaner_module
+
+TARGETS = [("ns0/repo0", "0"), ("ns1/repo1", "1"), ("ns0/repo0", "2"), ("ns2/repo2", None)]
+
+
+class DeleteImagesTest(RegistryTreeTest):
+
+    tree = dict(RegistryTreeTest.tree, shared_ratio=0.5)
+
+    def one_at_a_time(self, targets):
+        for repo, tag in targets:
+            cleaner = cleaner_module.RegistryCleaner(self.expected_root)
+            cleaner.delete_image(repo, tag)
+            cleaner.execute_plan()
+
+    def test_batch_matches_one_at_a_time(self):
+        cleaner = cleaner_module.RegistryCleaner(self.root)
+        cleaner.delete_images(TARGETS)
+        paths = [path for path, _, _, _, _ in cleaner.plan.items]
+        self.assertEqual(len(set(paths)), len(paths))
+        cleaner.execute_plan()
+        self.one_at_a_time(TARGETS)
+        self.assert_same_tree()
+        self.assertFalse(os.path.exists(os.path.join(self.root, "repositories/ns2/repo2")))
+
+    def test_shared_blobs_of_remaining_tags_are_kept(self):
+        stream = io.StringIO()
+        cleaner = cleaner_module.RegistryCleaner(self.root, dry_run=True)
+        cleaner.plan_writer = cleaner_module.PlanWriter(stream, self.root)
+        cleaner.delete_images(TARGETS)
+        cleaner.plan_writer.close()
+        stream.seek(0)
+        blobs = {"delete": set(), "keep": set()}
+        for record in cleaner_module.read_plan(stream):
+            if record["kind"] == "blob":
+                blobs[record["action"]].add(record["digest"])
+        self.assertTrue(blobs["keep"])
+        self.assertFalse(blobs["keep"] & blobs["delete"])
+        for digest in blobs["keep"]:
+            self.assertTrue(cleaner.link_index.is_referenced(digest))
+        for digest in blobs["delete"]:
+            self.assertFalse(cleaner.link_index.is_referenced(digest))
+
+    def test_failed_target_does_not_stop_the_batch(self):
+        cleaner = cleaner_module.RegistryCleaner(self.root)
+        with self.assertRaises(cleaner_module.RegistryCleanerError) as raised:
+            cleaner.delete_images(TARGETS[:2] + [("ns0/repo0", "missing")])
+        self.assertIn("1 of 3", str(raised.exception))
+        cleaner.execute_plan()
+        self.one_at_a_time(TARGETS[:2])
+        self.assert_same_tree()
+
+    def test_untagged_needs_repositories(self):
+        script = os.path.join(TEST_DIR, "..", "delete_docker_registry_image.py")
+        for args in (["--untagged", "--check-index"], ["--untagged", "--prune-all"]):
+            process = subprocess.Popen([sys.executable, script, "--dry-run"] + args, stderr=subprocess.PIPE,
+                                       env=dict(os.environ, REGISTRY_DATA_DIR=self.root))
+            _, error = process.communicate()
+            self.assertEqual(2, process.returncode)
+            self.assertIn(b"-u/--untagged: requires", error)
+        self.assert_same_tree()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Execute deletion plans on a worker pool and check the order of the phases,
+how failures are collected and the progress logged.
+"""
+
+import os
+import threading
+import unittest
+
+from registry_testing import RegistryTreeTest, cleaner_module, files_under
+
+REPO = "ns0/repo0"
+
+
+class RecordingStorage(cleaner_module.LocalStorage):
+    """local storage remembering the paths deleted, in order, and failing to delete some of them"""
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.deleted = []
+        self.lock = threading.Lock()
+
+    def delete_trees(self, paths):
+        errors = []
+        for path in paths:
+            with self.lock:
+                self.deleted.append(path)
+            if path in self.failing:
+                errors.append("cannot delete {0}".format(path))
+            else:
+                errors.extend(cleaner_module.LocalStorage.delete_trees(self, [path]))
+        return errors
+
+
+class DeletionPlanTest(RegistryTreeTest):
+
+    def plan(self, root):
+        cleaner = cleaner_module.RegistryCleaner(root)
+        cleaner.delete_image("ns2/repo2", None)
+        cleaner.delete_repository_tag(REPO, "0")
+        cleaner.delete_untagged(REPO)
+        cleaner.garbage_collect()
+        return cleaner.plan
+
+    def kinds(self, plan):
+        return dict((item[0], item[2]) for item in plan.items)
+
+    def test_worker_pool_deletes_the_same_as_serial(self):
+        serial_plan = self.plan(self.expected_root)
+        self.assertEqual([], serial_plan.execute(jobs=1))
+        plan = self.plan(self.root)
+        self.assertEqual(set(kind for kind in self.kinds(plan).values()),
+                         set(["repository", "tag", "tag_index", "revision", "layer", "blob"]))
+        self.assertEqual([], plan.execute(jobs=8))
+        self.assert_same_tree()
+        self.assertEqual(sorted(os.path.relpath(path, self.expected_root) for path in serial_plan.deleted),
+                         sorted(os.path.relpath(path, self.root) for path in plan.deleted))
+        self.assertEqual([], plan.items)
+
+    def test_phases_run_one_after_another(self):
+        plan = self.plan(self.root)
+        kinds = self.kinds(plan)
+        storage = RecordingStorage()
+        self.assertEqual([], plan.execute(jobs=8, storage=storage))
+        phases = [cleaner_module.DELETE_PHASES[kinds[path]] for path in storage.deleted]
+        self.assertEqual(sorted(phases), phases)
+        self.assertEqual(len(plan.deleted), len(storage.deleted))
+
+    def test_failures_are_collected_and_stop_later_phases(self):
+        plan = self.plan(self.root)
+        kinds = self.kinds(plan)
+        layers = sorted(path for path, kind in kinds.items() if kind == "layer")
+        storage = RecordingStorage(failing=layers[:1])
+        errors = plan.execute(jobs=4, storage=storage)
+
+        self.assertEqual([(layers[0], "cannot delete {0}".format(layers[0]))], errors)
+        # the rest of the failed phase still ran
+        for path in layers[1:]:
+            self.assertFalse(os.path.exists(path))
+        self.assertIn(layers[0], storage.deleted)
+        self.assertFalse([path for path in storage.deleted if kinds[path] in ("repository", "blob")])
+        for path, kind in kinds.items():
+            if kind == "blob":
+                self.assertTrue(os.path.isdir(path))
+        self.assertNotIn(layers[0], plan.deleted)
+
+    def test_progress_is_logged(self):
+        plan = self.plan(self.root)
+        total = len(plan._without_nested())
+        total_bytes = sum(item[1] for item in plan._without_nested())
+        plan.progress_interval = 0
+        with self.assertLogs(cleaner_module.logger, "INFO") as logs:
+            plan.execute(jobs=2)
+        progress = [line for line in logs.output if "Deleted " in line]
+        self.assertTrue(len(progress) > 1)
+        self.assertIn("Deleted {0} of {0} paths (0 failed), {1} of {1} bytes".format(total, total_bytes),
+                      progress[-1])
+
+    def test_nested_paths_are_deleted_with_their_parent(self):
+        plan = cleaner_module.DeletionPlan()
+        repo_dir = os.path.join(self.root, "repositories", REPO)
+        plan.add(os.path.join(repo_dir, "_manifests/tags/0"), kind="tag")
+        plan.add(repo_dir, kind="repository")
+        storage = RecordingStorage()
+        self.assertEqual([], plan.execute(storage=storage))
+        self.assertEqual([repo_dir], storage.deleted)
+        self.assertFalse(any(path.startswith(os.path.join("repositories", REPO) + "/")
+                             for path in files_under(self.root)))
+
+
+if __name__ == "__main__":
+    unittest.main()
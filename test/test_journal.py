@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Interrupt deletions of the cleaner halfway and resume them from the
+journal.
+"""
+
+import io
+import os
+import shutil
+import unittest
+
+from registry_testing import RegistryTreeTest, cleaner_module
+
+REPO = "ns0/repo0"
+
+
+class Crash(Exception):
+    pass
+
+
+class RecordingStorage(cleaner_module.LocalStorage):
+    """local storage remembering the order of deletions, dying after `crash_after` of them"""
+
+    def __init__(self, crash_after=None):
+        self.deleted = []
+        self.crash_after = crash_after
+
+    def delete_trees(self, paths):
+        if self.crash_after is not None and len(self.deleted) >= self.crash_after:
+            raise Crash()
+        self.deleted.extend(paths)
+        return cleaner_module.LocalStorage.delete_trees(self, paths)
+
+
+class JournalTest(RegistryTreeTest):
+
+    def setUp(self):
+        RegistryTreeTest.setUp(self)
+        self.journal_path = os.path.join(self.workdir, "journal.jsonl")
+
+    def plan(self, cleaner):
+        cleaner.delete_repository_tag(REPO, "0")
+        cleaner.delete_untagged_repositories(["ns1/repo1", "ns2/repo2"])
+        cleaner.garbage_collect()
+
+    def journal(self):
+        return cleaner_module.DeletionJournal(self.journal_path, self.root)
+
+    def pending(self):
+        with open(self.journal_path) as stream:
+            return cleaner_module.read_journal(stream)
+
+    def test_links_are_deleted_before_blobs(self):
+        storage = RecordingStorage()
+        cleaner = cleaner_module.RegistryCleaner(self.root, storage=storage, delete_jobs=4)
+        self.plan(cleaner)
+        cleaner.execute_plan()
+        phases = [cleaner_module.DELETE_PHASES["blob" if "/blobs/" in path else "tag"] for path in storage.deleted]
+        self.assertEqual(sorted(phases), phases)
+        self.assertIn(cleaner_module.DELETE_PHASES["blob"], phases)
+
+    def test_resume_after_crash_finishes_the_run(self):
+        plan_expected = cleaner_module.RegistryCleaner(self.expected_root)
+        self.plan(plan_expected)
+        plan_expected.execute_plan()
+
+        journal = self.journal()
+        cleaner = cleaner_module.RegistryCleaner(self.root, storage=RecordingStorage(crash_after=5),
+                                                 journal=journal)
+        self.plan(cleaner)
+        with self.assertRaises(Crash):
+            cleaner.execute_plan()
+        journal.close()
+        # a torn last record of the crashed run is ignored
+        with open(self.journal_path, "a") as stream:
+            stream.write('{"action": "do')
+        pending = self.pending()
+        self.assertTrue(pending)
+
+        journal = self.journal()
+        resumed = cleaner_module.RegistryCleaner(self.root, journal=journal)
+        resumed.resume_journal(pending)
+        # nothing is scanned again
+        self.assertIsNone(resumed._link_index)
+        resumed.execute_plan()
+        journal.close()
+
+        self.assert_same_tree()
+        self.assertEqual([], self.pending())
+
+    def test_failed_links_keep_blobs(self):
+        cleaner = cleaner_module.RegistryCleaner(self.root, journal=self.journal())
+        cleaner.delete_repository_tag(REPO, "0")
+        tag_dir = os.path.join(self.root, "repositories", REPO, "_manifests/tags/0")
+        shutil.rmtree(tag_dir)
+        with self.assertRaises(cleaner_module.RegistryCleanerError):
+            cleaner.execute_plan()
+        cleaner.journal.close()
+        pending = self.pending()
+        self.assertIn("tag", set(record["kind"] for record in pending))
+        blobs = [record["path"] for record in pending if record["kind"] == "blob"]
+        self.assertTrue(blobs)
+        for blob in blobs:
+            self.assertTrue(os.path.isdir(os.path.join(self.root, blob)))
+
+    def test_invalid_record_before_the_last_line_is_an_error(self):
+        with self.assertRaises(cleaner_module.RegistryCleanerError):
+            cleaner_module.read_journal(io.StringIO('{"action": "do\n{"action": "done", "path": "x"}\n'))
+
+
+if __name__ == "__main__":
+    unittest.main()
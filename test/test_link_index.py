@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Check the link index of the cleaner against the links it was given and
+against full scans of generated registry trees.
+"""
+
+import hashlib
+import os
+import random
+import unittest
+from collections import Counter
+
+from registry_testing import RegistryTreeTest, cleaner_module, push_copy
+
+REPO = "ns0/repo0"
+OTHER_REPO = "ns1/repo1"
+
+
+def digest_of(i):
+    return hashlib.sha256(str(i).encode()).hexdigest()
+
+
+class LinkIndexTest(unittest.TestCase):
+
+    def assert_holds(self, index, links):
+        """check `index` against a Counter of (digest, repo, kind) links"""
+        expected = {}
+        for (digest, repo, kind), count in links.items():
+            expected.setdefault(digest, []).extend([(repo, kind)] * count)
+        self.assertEqual(dict((digest, sorted(entries)) for digest, entries in expected.items()),
+                         dict((digest, sorted(entries)) for digest, entries in index.items()))
+        self.assertEqual(len(expected), len(index))
+        for digest, entries in expected.items():
+            self.assertEqual(set(entries), index.references(digest))
+            self.assertEqual(any(repo != "repo0" for repo, _ in entries), index.in_other_repository(digest, "repo0"))
+        self.assertEqual(sorted(digest for digest, entries in expected.items() if ("repo1", "layer") in entries),
+                         sorted(digest for digest in index.digests("layer")
+                                if ("repo1", "layer") in index.references(digest)))
+
+    def test_matches_links_added_and_discarded(self):
+        rnd = random.Random(0)
+        index = cleaner_module.LinkIndex()
+        links = Counter()
+        for _ in range(3000):
+            link = (digest_of(rnd.randrange(40)), "repo{0}".format(rnd.randrange(3)), rnd.choice(["layer", "revision"]))
+            if rnd.random() < 0.6:
+                index.add(*link)
+                links[link] += 1
+            else:
+                index.discard(*link)
+                if links[link]:
+                    links[link] -= 1
+        links = +links
+        self.assert_holds(index, links)
+
+        index.drop_repository("repo0", [digest_of(i) for i in range(40)])
+        self.assert_holds(index, Counter(dict((link, count) for link, count in links.items() if link[1] != "repo0")))
+
+
+class CheckLinkIndexTest(RegistryTreeTest):
+
+    def test_index_follows_deletions(self):
+        cleaner = cleaner_module.RegistryCleaner(self.root)
+        cleaner.delete_repository_tag(REPO, "0")
+        cleaner.delete_untagged(OTHER_REPO)
+        cleaner.execute_plan()
+        self.assertEqual([], cleaner.check_link_index())
+
+    def test_push_after_indexing_is_reported(self):
+        cleaner = cleaner_module.RegistryCleaner(self.root)
+        self.assertEqual([], cleaner.check_link_index())
+        manifest = cleaner_module.get_digest_from_blob(
+            os.path.join(self.root, "repositories", REPO, "_manifests/tags/0/current/link"))
+        with open(os.path.join(self.root, "blobs/sha256", manifest[0:2], manifest, "data"), "rb") as blob:
+            layers = cleaner_module.parse_manifest(blob.read())[0]
+        push_copy(self.root, REPO, "0", OTHER_REPO, "pushed")
+        differences = cleaner.check_link_index()
+        # layers OTHER_REPO linked already are left as they were
+        self.assertIn(manifest, differences)
+        self.assertTrue(set(differences) <= layers | set([manifest]))
+
+    def test_index_file_after_push_and_delete(self):
+        index_file = os.path.join(self.workdir, "index.sqlite")
+        cleaner_module.RegistryCleaner(self.root, index_file=index_file).link_index
+        push_copy(self.root, REPO, "0", OTHER_REPO, "pushed")
+
+        cleaner = cleaner_module.RegistryCleaner(self.root, index_file=index_file)
+        self.assertEqual([], cleaner.check_link_index())
+        cleaner.delete_repository_tag(OTHER_REPO, "pushed")
+        cleaner.execute_plan()
+        signatures = cleaner_module.LinkIndexStore(index_file).signatures()
+        self.assertIsNone(signatures[OTHER_REPO])
+        self.assertIsNotNone(signatures[REPO])
+
+        self.assertEqual([], cleaner_module.RegistryCleaner(self.root, index_file=index_file).check_link_index())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Check the bounded LRU cache of parsed manifests, alone and as used by the
+cleaner while deleting tags.
+"""
+
+import unittest
+
+from registry_testing import RegistryTreeTest, cleaner_module
+
+REPO = "ns0/repo0"
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = cleaner_module.LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(1, cache.get("a"))
+        cache.put("c", 3)
+        self.assertEqual(2, len(cache))
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(1, cache.get("a"))
+        self.assertEqual(3, cache.get("c"))
+
+        cache.put("a", 4)
+        cache.put("d", 5)
+        self.assertEqual(4, cache.get("a"))
+        self.assertIsNone(cache.get("c"))
+
+    def test_hits_and_misses_are_counted(self):
+        cache = cleaner_module.LRUCache(4)
+        self.assertEqual("default", cache.get("a", "default"))
+        cache.put("a", 1)
+        cache.get("a")
+        cache.get("a")
+        cache.get("b")
+        self.assertEqual((2, 2), (cache.hits, cache.misses))
+
+    def test_zero_size_disables_the_cache(self):
+        for maxsize in (0, -1):
+            cache = cleaner_module.LRUCache(maxsize)
+            cache.put("a", 1)
+            self.assertEqual(0, len(cache))
+            self.assertIsNone(cache.get("a"))
+            self.assertEqual((0, 1), (cache.hits, cache.misses))
+
+
+class ManifestCacheTest(RegistryTreeTest):
+
+    def delete_tags(self, manifest_cache_size):
+        cleaner = cleaner_module.RegistryCleaner(self.root, dry_run=True, manifest_cache_size=manifest_cache_size)
+        cleaner.delete_repository_tag(REPO, "0")
+        cleaner.delete_repository_tag(REPO, "1")
+        return cleaner
+
+    def test_manifests_are_parsed_once(self):
+        cleaner = self.delete_tags(100)
+        self.assertTrue(cleaner.manifest_cache.hits)
+        self.assertEqual(len(cleaner.manifest_cache), cleaner.manifest_cache.misses)
+
+    def test_same_plan_without_cache(self):
+        cached = self.delete_tags(100)
+        uncached = self.delete_tags(0)
+        self.assertEqual(0, len(uncached.manifest_cache))
+        self.assertEqual(0, uncached.manifest_cache.hits)
+        self.assertEqual(sorted(cached.plan.items), sorted(uncached.plan.items))
+
+
+if __name__ == "__main__":
+    unittest.main()
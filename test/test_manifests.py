@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Check manifest parsing, its fast path and manifest lists (OCI image indexes)
+in generated registry trees.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from registry_testing import cleaner_module, quiet_cleaner
+from generate_registry_tree import generate_registry, write_blob, write_link
+
+REPO = "ns0/repo0"
+LIST_TYPE = "application/vnd.docker.distribution.manifest.list.v2+json"
+INDEX_TYPE = "application/vnd.oci.image.index.v1+json"
+
+
+def digest_of(name):
+    return hashlib.sha256(name.encode()).hexdigest()
+
+
+def descriptor(media_type, digest, **extra):
+    result = {"mediaType": media_type, "size": 1234, "digest": "sha256:" + digest}
+    result.update(extra)
+    return result
+
+
+def image_manifest(config, layers, **extra):
+    result = {
+        "schemaVersion": 2,
+        "mediaType": "application/vnd.oci.image.manifest.v1+json",
+        "config": descriptor("application/vnd.oci.image.config.v1+json", config),
+        "layers": [descriptor("application/vnd.oci.image.layer.v1.tar+gzip", layer) for layer in layers],
+    }
+    result.update(extra)
+    return result
+
+
+def index_manifest(children, media_type=INDEX_TYPE):
+    return {
+        "schemaVersion": 2,
+        "mediaType": media_type,
+        "manifests": [descriptor("application/vnd.oci.image.manifest.v1+json", child,
+                                 platform={"architecture": "arch{0}".format(i), "os": "linux"},
+                                 annotations={"vnd.docker.reference.digest": "sha256:" + children[0]})
+                      for i, child in enumerate(children)],
+    }
+
+
+def push_index(root, repo, tag, architectures=2):
+    """push a multi-architecture image as `repo`:`tag`, return (index, child manifests, their blobs)"""
+    repo_dir = os.path.join(root, "repositories", repo)
+    children = []
+    blobs = []
+    for arch in range(architectures):
+        layers = [write_blob(root, "{0} {1} layer {2}".format(repo, arch, i).encode()) for i in range(2)]
+        config = write_blob(root, json.dumps({"architecture": arch, "repo": repo}).encode())
+        child = write_blob(root, json.dumps(image_manifest(config, layers)).encode())
+        for layer in layers + [config]:
+            write_link(os.path.join(repo_dir, "_layers/sha256", layer), layer)
+        write_link(os.path.join(repo_dir, "_manifests/revisions/sha256", child), child)
+        children.append(child)
+        blobs.extend(layers + [config])
+    index = write_blob(root, json.dumps(index_manifest(children), indent=3).encode())
+    write_link(os.path.join(repo_dir, "_manifests/revisions/sha256", index), index)
+    write_link(os.path.join(repo_dir, "_manifests/tags", tag, "current"), index)
+    write_link(os.path.join(repo_dir, "_manifests/tags", tag, "index/sha256", index), index)
+    return index, children, blobs
+
+
+def blob_exists(root, digest):
+    return os.path.isfile(os.path.join(root, "blobs/sha256", digest[0:2], digest, "data"))
+
+
+class ParseManifestTest(unittest.TestCase):
+
+    def assert_parsed(self, manifest, layers, children, fast=True):
+        data = json.dumps(manifest, indent=3).encode()
+        self.assertEqual((set(layers), set(children), fast), cleaner_module.parse_manifest(data))
+        self.assertEqual(fast, cleaner_module.scan_manifest(data) is not None)
+
+    def test_schema1_history_is_not_parsed(self):
+        layers = [digest_of("a"), digest_of("b")]
+        history = json.dumps({"container_config": {"Labels": {"digest": "sha256:" + digest_of("x")}},
+                              "blobSum": "sha256:" + digest_of("y"), "Cmd": ["a && b"]})
+        manifest = {"schemaVersion": 1, "name": REPO, "tag": "0",
+                    "fsLayers": [{"blobSum": "sha256:" + layer} for layer in layers],
+                    "history": [{"v1Compatibility": history} for _ in layers],
+                    "signatures": [{"header": {"alg": "ES256"}, "protected": "e30"}]}
+        self.assert_parsed(manifest, layers, [])
+
+    def test_image_manifest(self):
+        self.assert_parsed(image_manifest(digest_of("config"), [digest_of("a"), digest_of("b")]),
+                           [digest_of("config"), digest_of("a"), digest_of("b")], [])
+
+    def test_manifest_list_and_index(self):
+        children = [digest_of("amd64"), digest_of("arm64")]
+        self.assert_parsed(index_manifest(children, LIST_TYPE), [], children)
+        self.assert_parsed(index_manifest(children), [], children)
+
+    def test_unusual_manifests_are_parsed_in_full(self):
+        layers = [digest_of("config"), digest_of("a")]
+        self.assert_parsed(image_manifest(layers[0], layers[1:], subject=descriptor("x", digest_of("subject"))),
+                           layers, [], fast=False)
+        self.assert_parsed(image_manifest(layers[0], layers[1:], annotations={"digest": "sha256:" + digest_of("x")}),
+                           layers, [], fast=False)
+        escaped = json.dumps(image_manifest(layers[0], layers[1:])).replace('"digest"', '"\\u0064igest"', 1)
+        self.assertIsNone(cleaner_module.scan_manifest(escaped.encode()))
+        self.assertEqual(set(layers), cleaner_module.parse_manifest(escaped.encode())[0])
+
+    def test_not_a_manifest_raises(self):
+        with self.assertRaises(ValueError):
+            cleaner_module.parse_manifest(b"not json")
+        with self.assertRaises(KeyError):
+            cleaner_module.parse_manifest(b'{"schemaVersion": 2}')
+
+
+class ManifestListTest(unittest.TestCase):
+
+    def setUp(self):
+        quiet_cleaner()
+        cleaner_module.stats.reset()
+        self.root = tempfile.mkdtemp(prefix="registry-manifests-test-")
+        generate_registry(self.root, repos=3, tags=2, layers=3, untagged=1, schema1_ratio=0.5)
+        self.index, self.children, self.blobs = push_index(self.root, REPO, "multi")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def run_cleaner(self, operation, **kwargs):
+        cleaner = cleaner_module.RegistryCleaner(self.root, **kwargs)
+        operation(cleaner)
+        cleaner.execute_plan()
+        return cleaner
+
+    def revision_exists(self, digest):
+        return os.path.isdir(os.path.join(self.root, "repositories", REPO, "_manifests/revisions/sha256", digest))
+
+    def test_gc_and_untagged_keep_children_of_tagged_index(self):
+        self.run_cleaner(lambda cleaner: cleaner.delete_untagged(REPO))
+        self.run_cleaner(lambda cleaner: cleaner.garbage_collect())
+        for digest in [self.index] + self.children + self.blobs:
+            self.assertTrue(blob_exists(self.root, digest))
+        for child in self.children:
+            self.assertTrue(self.revision_exists(child))
+        counters = cleaner_module.stats.as_dict()["counters"]
+        self.assertGreater(counters["manifests_scanned"], 0)
+
+    def test_deleting_tag_deletes_children(self):
+        unreferenced = cleaner_module.RegistryCleaner(self.root, dry_run=True).garbage_collect()
+        self.run_cleaner(lambda cleaner: cleaner.delete_repository_tag(REPO, "multi"))
+        for digest in [self.index] + self.children + self.blobs:
+            self.assertFalse(blob_exists(self.root, digest))
+            self.assertFalse(self.revision_exists(digest))
+        # nothing of the tag was left for garbage collection
+        self.assertEqual(unreferenced, cleaner_module.RegistryCleaner(self.root, dry_run=True).garbage_collect())
+
+    def test_child_used_by_another_tag_is_kept(self):
+        repo_dir = os.path.join(self.root, "repositories", REPO, "_manifests/tags/single")
+        write_link(os.path.join(repo_dir, "current"), self.children[0])
+        write_link(os.path.join(repo_dir, "index/sha256", self.children[0]), self.children[0])
+        self.run_cleaner(lambda cleaner: cleaner.delete_repository_tag(REPO, "multi"))
+        self.assertTrue(blob_exists(self.root, self.children[0]))
+        self.assertTrue(self.revision_exists(self.children[0]))
+        self.assertFalse(blob_exists(self.root, self.children[1]))
+        self.assertEqual(set(self.blobs[0:3]), set(digest for digest in self.blobs if blob_exists(self.root, digest)))
+
+    def test_process_pool_marks_the_same(self):
+        batch_size = cleaner_module.MANIFEST_BATCH_SIZE
+        cleaner_module.MANIFEST_BATCH_SIZE = 2
+        try:
+            marked = [cleaner_module.RegistryCleaner(self.root, parse_jobs=jobs)._mark() for jobs in (1, 3)]
+        finally:
+            cleaner_module.MANIFEST_BATCH_SIZE = batch_size
+        self.assertEqual(marked[0], marked[1])
+        self.assertTrue(set(self.children + self.blobs) <= marked[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Write deletion plans with dry runs and apply them later with --apply-plan,
+also after the registry changed in between.
+"""
+
+import io
+import os
+import unittest
+
+from registry_testing import RegistryTreeTest, cleaner_module, push_copy
+from generate_registry_tree import write_link
+
+REPO = "ns0/repo0"
+
+
+def link_digest(path):
+    return cleaner_module.get_digest_from_blob(path)
+
+
+class ApplyPlanTest(RegistryTreeTest):
+
+    def write_plan(self, operation):
+        stream = io.StringIO()
+        cleaner = cleaner_module.RegistryCleaner(self.root, dry_run=True, plan_output=stream)
+        operation(cleaner)
+        cleaner.plan_writer.close()
+        return stream.getvalue()
+
+    def apply_plan(self, plan):
+        cleaner = cleaner_module.RegistryCleaner(self.root)
+        cleaner.apply_plan(cleaner_module.read_plan(io.StringIO(plan)))
+        cleaner.execute_plan()
+        return cleaner
+
+    def one_shot(self, operation):
+        cleaner = cleaner_module.RegistryCleaner(self.expected_root)
+        operation(cleaner)
+        cleaner.execute_plan()
+
+    def repo_path(self, root, *parts):
+        return os.path.join(root, "repositories", REPO, "_manifests", *parts)
+
+    def untagged_revisions(self, root):
+        tagged = set(link_digest(self.repo_path(root, "tags", tag, "current/link")) for tag in "012")
+        return sorted(set(os.listdir(self.repo_path(root, "revisions/sha256"))) - tagged)
+
+    def retag(self, root, tag, digest):
+        """point `tag` at the revision `digest`, like pushing it again under that tag"""
+        write_link(self.repo_path(root, "tags", tag, "current"), digest)
+        write_link(self.repo_path(root, "tags", tag, "index/sha256", digest), digest)
+
+    def test_round_trip_matches_one_shot_run(self):
+        def operation(cleaner):
+            cleaner.delete_images([(REPO, "0"), ("ns2/repo2", None)])
+            cleaner.delete_untagged_repositories(["ns1/repo1", "ns0/repo3"])
+            cleaner.garbage_collect()
+
+        plan = self.write_plan(operation)
+        self.assert_same_tree()
+        self.apply_plan(plan)
+        self.one_shot(operation)
+        self.assert_same_tree()
+
+    def test_retagged_untagged_revision_is_kept(self):
+        plan = self.write_plan(lambda cleaner: cleaner.delete_untagged(REPO))
+        retagged, deleted = self.untagged_revisions(self.root)
+        for root in (self.root, self.expected_root):
+            self.retag(root, "0", retagged)
+        self.assertEqual([], self.apply_plan(plan).check_link_index())
+        self.assertTrue(os.path.isdir(self.repo_path(self.root, "revisions/sha256", retagged)))
+        self.assertFalse(os.path.isdir(self.repo_path(self.root, "revisions/sha256", deleted)))
+
+        # what tag 0 pointed to before is untagged now, but was not when planning
+        cleaner = cleaner_module.RegistryCleaner(self.root)
+        cleaner.delete_untagged(REPO)
+        cleaner.execute_plan()
+        self.one_shot(lambda cleaner: cleaner.delete_untagged(REPO))
+        self.assert_same_tree()
+
+    def test_moved_tag_is_kept(self):
+        plan = self.write_plan(lambda cleaner: cleaner.delete_repository_tag(REPO, "0"))
+        retagged = self.untagged_revisions(self.root)[0]
+        self.retag(self.root, "0", retagged)
+        cleaner = self.apply_plan(plan)
+
+        self.assertEqual(retagged, link_digest(self.repo_path(self.root, "tags/0/current/link")))
+        self.assertTrue(os.path.isdir(self.repo_path(self.root, "revisions/sha256", retagged)))
+        self.assertTrue(os.path.isdir(self.repo_path(self.root, "tags/0/index/sha256", retagged)))
+        self.assertEqual([], cleaner.check_link_index())
+        # the revision tag 0 pointed to when planning is gone
+        old = link_digest(self.repo_path(self.expected_root, "tags/0/current/link"))
+        self.assertFalse(os.path.isdir(self.repo_path(self.root, "revisions/sha256", old)))
+
+    def test_repository_pushed_to_is_kept(self):
+        plan = self.write_plan(lambda cleaner: cleaner.delete_image("ns2/repo2", None))
+        push_copy(self.root, REPO, "0", "ns2/repo2", "pushed")
+        self.apply_plan(plan)
+        self.assertTrue(os.path.isdir(os.path.join(self.root, "repositories/ns2/repo2/_manifests/tags/pushed")))
+        self.assertEqual([], cleaner_module.RegistryCleaner(self.root).check_link_index())
+        manifest = link_digest(os.path.join(self.root, "repositories/ns2/repo2/_manifests/tags/pushed/current/link"))
+        self.assertTrue(os.path.isfile(os.path.join(self.root, "blobs/sha256", manifest[0:2], manifest, "data")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Check that pruning after a deletion removes exactly the directories the
+deletion left empty.
+"""
+
+import os
+import unittest
+
+from registry_testing import RegistryTreeTest, cleaner_module
+
+REPO = "ns0/repo0"
+
+
+def empty_dirs(root):
+    return set(os.path.relpath(dirpath, root) for dirpath, dirnames, filenames in os.walk(root)
+               if not dirnames and not filenames)
+
+
+class PruneTest(RegistryTreeTest):
+
+    def plant_empty_dir(self, relpath):
+        """an empty directory this run did not leave behind, e.g. of an upload"""
+        os.makedirs(os.path.join(self.root, relpath))
+        return relpath
+
+    def test_prune_only_removes_what_the_run_emptied(self):
+        unrelated = self.plant_empty_dir("repositories/ns1/repo1/_uploads/abc")
+        cleaner = cleaner_module.RegistryCleaner(self.root)
+        cleaner.delete_image("ns2/repo2", None)
+        cleaner.delete_repository_tag(REPO, "0")
+        cleaner.delete_untagged(REPO)
+        cleaner.execute_plan()
+        self.assertTrue(empty_dirs(self.root) - set([unrelated]))
+
+        cleaner.prune()
+        self.assertEqual(set([unrelated]), empty_dirs(self.root))
+        self.assertFalse(os.path.exists(os.path.join(self.root, "repositories/ns2/repo2")))
+        self.assertTrue(os.path.isdir(os.path.join(self.root, "repositories", REPO, "_manifests/tags/1")))
+        self.assertEqual([], cleaner.plan.deleted)
+
+    def test_deleting_everything_leaves_the_top_directory(self):
+        unrelated = self.plant_empty_dir("scratch")
+        cleaner = cleaner_module.RegistryCleaner(self.root)
+        for repo in ("ns0/repo0", "ns1/repo1", "ns2/repo2", "ns0/repo3"):
+            cleaner.delete_image(repo, None)
+        cleaner.garbage_collect()
+        cleaner.execute_plan()
+        cleaner.prune()
+        self.assertEqual([unrelated], os.listdir(self.root))
+
+        cleaner.prune_all()
+        self.assertEqual([], os.listdir(self.root))
+
+
+if __name__ == "__main__":
+    unittest.main()
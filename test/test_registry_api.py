@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Run the registry API mode of the cleaner against a local stand-in of the
+registry, comparing what is left with offline runs on a copy.
+"""
+
+import os
+import unittest
+
+from registry_testing import RegistryTreeTest, cleaner_module, files_under
+from generate_registry_tree import write_link
+from registry_stub import RegistryStub, read_link
+
+REPO = "ns0/repo0"
+
+
+class RegistryApiTest(RegistryTreeTest):
+
+    tree = dict(RegistryTreeTest.tree, untagged=1)
+
+    def setUp(self):
+        RegistryTreeTest.setUp(self)
+        self.stub = RegistryStub(self.root).start()
+
+    def tearDown(self):
+        self.stub.stop()
+        RegistryTreeTest.tearDown(self)
+
+    def api_cleaner(self):
+        return cleaner_module.RegistryCleaner(self.root, delete_jobs=4,
+                                              registry_client=cleaner_module.RegistryClient(self.stub.url))
+
+    def deletes(self):
+        return [path for method, path in self.stub.requests if method == "DELETE"]
+
+    def assert_same_as_offline(self, operation):
+        """run `operation` in API mode and offline, and compare the files left"""
+        operation(self.api_cleaner())
+        operation(cleaner_module.RegistryCleaner(self.expected_root))
+        self.assert_same_tree()
+
+    def test_delete_tag_deletes_manifest_through_api(self):
+        manifest = read_link(os.path.join(self.root, "repositories", REPO, "_manifests/tags/0/current/link"))
+
+        def delete_tag(cleaner):
+            cleaner.delete_repository_tag(REPO, "0")
+            cleaner.execute_plan()
+
+        self.assert_same_as_offline(delete_tag)
+        self.assertEqual(["/v2/{0}/manifests/sha256:{1}".format(REPO, manifest)], self.deletes())
+
+    def test_delete_entire_repository(self):
+        def delete_repository(cleaner):
+            cleaner.delete_entire_repository(REPO)
+            cleaner.execute_plan()
+
+        self.assert_same_as_offline(delete_repository)
+        # 3 tagged and 1 untagged revision
+        self.assertEqual(4, len(self.deletes()))
+
+    def test_delete_untagged(self):
+        def delete_untagged(cleaner):
+            cleaner.delete_untagged(REPO)
+            cleaner.execute_plan()
+
+        self.assert_same_as_offline(delete_untagged)
+        self.assertEqual(1, len(self.deletes()))
+
+    def test_layer_linked_again_after_planning_is_kept(self):
+        cleaner = self.api_cleaner()
+        cleaner.delete_repository_tag(REPO, "0")
+        manifest = read_link(os.path.join(self.root, "repositories", REPO, "_manifests/tags/0/current/link"))
+        layers = cleaner._get_layers_from_blob(manifest)
+
+        # a push while the registry kept serving: another manifest uses the layers of the deleted one
+        pushed = "f" * 64
+        blob_dir = os.path.join(self.root, "blobs/sha256", pushed[0:2], pushed)
+        os.makedirs(blob_dir)
+        with open(os.path.join(blob_dir, "data"), "w") as blob:
+            blob.write('{"schemaVersion": 2, "layers": [%s]}' %
+                       ", ".join('{"digest": "sha256:%s"}' % layer for layer in layers))
+        write_link(os.path.join(self.root, "repositories", REPO, "_manifests/revisions/sha256", pushed), pushed)
+
+        cleaner.execute_plan()
+        for layer in layers:
+            self.assertTrue(os.path.isfile(os.path.join(self.root, "repositories", REPO, "_layers/sha256",
+                                                        layer, "link")))
+            self.assertTrue(os.path.isfile(os.path.join(self.root, "blobs/sha256", layer[0:2], layer, "data")))
+
+    def test_failed_api_delete_sweeps_nothing(self):
+        before = files_under(self.root)
+        self.stub.fail_deletes = True
+        cleaner = self.api_cleaner()
+        cleaner.delete_repository_tag(REPO, "0")
+        with self.assertRaises(cleaner_module.RegistryCleanerError):
+            cleaner.execute_plan()
+        self.assertEqual(before, files_under(self.root))
+
+
+if __name__ == "__main__":
+    unittest.main()
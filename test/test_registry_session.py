@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Fetch catalogs with the session of clean_old_versions.py from a local
+stand-in of the registry answering some requests with errors.
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from datetime import datetime
+
+import requests
+
+import registry_testing  # noqa: F401, puts the scripts on sys.path
+import clean_old_versions
+from generate_registry_tree import generate_registry, write_link
+from registry_stub import RegistryStub, read_link
+
+REPO = "ns0/repo0"
+
+
+class RegistrySessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="registry-session-test-")
+        generate_registry(self.root, repos=3, tags=4, layers=2, schema1_ratio=0.5, untagged=1)
+        self.stub = RegistryStub(self.root).start()
+
+    def tearDown(self):
+        self.stub.stop()
+        shutil.rmtree(self.root)
+
+    def args(self, **kwargs):
+        values = dict(registry_url=self.stub.url, retries=3, backoff=0.0, concurrency=1,
+                      no_check_certificate=True)
+        values.update(kwargs)
+        return argparse.Namespace(**values)
+
+    def session(self, args):
+        return clean_old_versions.create_session(None, args)
+
+    def test_failed_requests_are_retried_with_backoff(self):
+        args = self.args(backoff=0.05)
+        self.stub.fail_requests = [503, 429, 502]
+        start = time.time()
+        tags = clean_old_versions.get_tags(self.session(args), REPO, args)
+        # urllib3 sleeps backoff * 2 ** (n - 1) before the n-th retry: 0.05 + 0.1 + 0.2
+        self.assertGreaterEqual(time.time() - start, 0.3)
+        self.assertEqual(["0", "1", "2", "3"], tags)
+        self.assertEqual(4, len(self.stub.requests))
+
+    def test_gives_up_after_retries(self):
+        args = self.args(retries=2)
+        self.stub.fail_requests = [503] * 3
+        with self.assertRaises(requests.exceptions.RetryError):
+            clean_old_versions.get_tags(self.session(args), REPO, args)
+        self.assertEqual(3, len(self.stub.requests))
+
+    def test_one_connection_is_kept_alive(self):
+        args = self.args()
+        self.stub.fail_requests = [500]
+        rules = [clean_old_versions.compile_rule({"repositories": ".", "keep_last": 1}, datetime(2016, 7, 1))]
+        catalog = clean_old_versions.fetch_catalog(self.session(args), rules, args, all_dates=True)
+        self.assertEqual(["ns0/repo0", "ns1/repo1", "ns2/repo2"], sorted(catalog))
+        self.assertEqual(4, len(catalog[REPO]["created"]))
+        self.assertEqual(1, len(self.stub.clients))
+
+    def fetch_dates(self, date_cache):
+        args = self.args()
+        rules = [clean_old_versions.compile_rule({"repositories": "^ns0/", "keep_last": 1}, datetime(2016, 7, 1))]
+        del self.stub.requests[:]
+        catalog = clean_old_versions.fetch_catalog(self.session(args), rules, args, date_cache, all_dates=True)
+        return catalog[REPO]["created"]
+
+    def fetched(self):
+        return sorted(path for method, path in self.stub.requests
+                      if method == "GET" and ("/manifests/" in path or "/blobs/" in path))
+
+    def test_date_cache_skips_manifests_seen_before(self):
+        cache_path = os.path.join(self.root, "dates.json")
+        self.assertEqual({}, clean_old_versions.load_date_cache(cache_path))
+        date_cache = {}
+        created = self.fetch_dates(date_cache)
+        self.assertEqual(4, len(date_cache))
+        self.assertTrue(self.fetched())
+        clean_old_versions.save_date_cache(cache_path, date_cache)
+
+        date_cache = clean_old_versions.load_date_cache(cache_path)
+        self.assertEqual(created, self.fetch_dates(date_cache))
+        self.assertEqual([], self.fetched())
+        self.assertEqual(4, len([method for method, _ in self.stub.requests if method == "HEAD"]))
+
+    def test_retagged_manifest_is_fetched(self):
+        date_cache = {}
+        self.fetch_dates(date_cache)
+        repo_dir = os.path.join(self.root, "repositories", REPO, "_manifests")
+        tagged = set("sha256:" + read_link(os.path.join(repo_dir, "tags", tag, "current/link")) for tag in "0123")
+        untagged, = [digest for digest in os.listdir(os.path.join(repo_dir, "revisions/sha256"))
+                     if "sha256:" + digest not in tagged]
+        write_link(os.path.join(repo_dir, "tags/0/current"), untagged)
+
+        self.fetch_dates(date_cache)
+        self.assertEqual(["/v2/{0}/manifests/0".format(REPO)],
+                         [path for path in self.fetched() if "/manifests/" in path])
+        self.assertEqual(5, len(date_cache))
+        self.assertIn("sha256:" + untagged, date_cache)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Evaluate retention policies of clean_old_versions.py against catalog
+snapshots, offline.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from registry_testing import TEST_DIR
+import clean_old_versions
+from generate_registry_tree import generate_registry
+from registry_stub import RegistryStub
+
+NOW = datetime(2016, 7, 1)
+SCRIPT = os.path.join(TEST_DIR, "..", "clean_old_versions.py")
+
+CATALOG = {
+    "team-a/api": {
+        "tags": ["1.0", "1.2", "1.10", "1.9", "latest", "stable"],
+        "created": {"1.0": "2016-01-01T00:00:00", "1.2": "2016-02-01T00:00:00",
+                    "1.9": "2016-06-20T00:00:00", "1.10": "2016-06-25T00:00:00",
+                    "latest": "2016-06-25T00:00:00", "stable": "2016-01-01T00:00:00"},
+    },
+    "team-b/web": {
+        "tags": ["a", "b", "c", "d"],
+        "created": {"a": "2016-04-01T00:00:00", "b": "2016-01-01T00:00:00",
+                    "c": "2016-03-01T00:00:00", "d": "2016-02-01T00:00:00"},
+    },
+    "other/tool": {"tags": ["1", "2", "3"], "created": {}},
+    "empty/repo": {"tags": None},
+}
+
+
+def evaluate(rules, catalog=CATALOG):
+    return clean_old_versions.evaluate_policy([clean_old_versions.compile_rule(rule, NOW) for rule in rules],
+                                              catalog)
+
+
+class RetentionPolicyTest(unittest.TestCase):
+
+    def test_tags_sort_by_version(self):
+        tags = ["1.10", "latest", "1.9", "1.2", "2.0"]
+        self.assertEqual(["1.2", "1.9", "1.10", "2.0", "latest"],
+                         sorted(tags, key=clean_old_versions.version_key))
+
+    def test_first_matching_rule_applies(self):
+        targets = evaluate([
+            {"repositories": "^team-a/", "keep_last": 2, "keep": "^(latest|stable)$"},
+            {"repositories": "^team-", "keep_last": 3},
+        ])
+        self.assertEqual([("team-a/api", "1.0"), ("team-a/api", "1.2"), ("team-b/web", "a")], targets)
+
+    def test_repositories_without_rule_are_left_alone(self):
+        self.assertEqual([], evaluate([{"repositories": "^nothing/", "keep_last": 0}]))
+
+    def test_keep_newer_than(self):
+        targets = evaluate([{"repositories": "^team-a/", "keep_last": 0, "keep_newer_than": "30d",
+                             "keep": "^stable$"}])
+        self.assertEqual([("team-a/api", "1.0"), ("team-a/api", "1.2")], targets)
+
+    def test_order_by_date_keeps_newest(self):
+        targets = evaluate([{"repositories": "^team-b/", "keep_last": 2, "order": "date"}])
+        self.assertEqual([("team-b/web", "b"), ("team-b/web", "d")], targets)
+
+    def test_tags_without_dates_are_kept(self):
+        self.assertEqual([], evaluate([{"repositories": "^other/", "keep_last": 0, "before": "2017-01-01T00:00:00"}]))
+        self.assertEqual([("other/tool", "1")], evaluate([{"repositories": "^other/", "keep_last": 2}]))
+
+    def test_command_line_options_make_one_rule(self):
+        args = argparse.Namespace(image="^team-b/", include="^[a-c]$", exclude=None, last=1, order="name",
+                                  before=datetime(2016, 3, 15), after=None)
+        targets = clean_old_versions.evaluate_policy([clean_old_versions.rule_from_args(args, NOW)], CATALOG)
+        self.assertEqual([("team-b/web", "b")], targets)
+
+    def test_invalid_rules_are_rejected(self):
+        for rule in ({"repositories": ".", "keep_lst": 1}, {"repositories": ".", "order": "size"},
+                     {"repositories": ".", "keep_newer_than": "a month"}):
+            with self.assertRaises(ValueError):
+                clean_old_versions.compile_rule(rule, NOW)
+
+
+class CatalogSnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="retention-policy-test-")
+        self.root = os.path.join(self.workdir, "registry")
+        generate_registry(self.root, repos=3, tags=4, layers=2, schema1_ratio=0.5)
+        self.stub = RegistryStub(self.root).start()
+        self.policy = os.path.join(self.workdir, "policy.json")
+        with open(self.policy, "w") as policy:
+            json.dump({"rules": [{"repositories": "^ns0/", "keep_last": 1, "order": "date"},
+                                 {"repositories": "^ns1/", "keep_last": 3}]}, policy)
+
+    def tearDown(self):
+        self.stub.stop()
+        shutil.rmtree(self.workdir)
+
+    def run_script(self, *args):
+        return subprocess.check_output([sys.executable, SCRIPT, "--policy", self.policy, "--dry-run",
+                                        "--in-process", "--script-path",
+                                        os.path.join(TEST_DIR, "..", "delete_docker_registry_image.py"),
+                                        "--registry-data-dir", self.root] + list(args),
+                                       stderr=subprocess.STDOUT).decode()
+
+    def simulated(self, output):
+        return sorted(line for line in output.splitlines() if line.startswith("Simulate deletion of "))
+
+    def test_saved_catalog_gives_same_targets_offline(self):
+        snapshot = os.path.join(self.workdir, "catalog.json")
+        online = self.run_script("--registry-url", self.stub.url, "--save-catalog", snapshot)
+        requests_online = len(self.stub.requests)
+        offline = self.run_script("--catalog", snapshot)
+
+        self.assertEqual(requests_online, len(self.stub.requests))
+        self.assertEqual(["Simulate deletion of ns0/repo0:{0}".format(tag) for tag in "012"] +
+                         ["Simulate deletion of ns1/repo1:0"], self.simulated(online))
+        self.assertEqual(self.simulated(online), self.simulated(offline))
+        with open(snapshot) as stream:
+            catalog = json.load(stream)["repositories"]
+        self.assertEqual(["ns0/repo0", "ns1/repo1"], sorted(catalog))
+        self.assertEqual(4, len(catalog["ns1/repo1"]["created"]))
+
+    def test_rules_with_flags_and_groups_match_one_by_one(self):
+        with open(self.policy, "w") as policy:
+            json.dump({"rules": [{"repositories": "^ns0/(?P<name>.*)", "keep_last": 1, "order": "date"},
+                                 {"repositories": "(?i)^NS1/(?P<name>.*)", "keep_last": 3}]}, policy)
+        output = self.run_script("--registry-url", self.stub.url)
+        self.assertEqual(["Simulate deletion of ns0/repo0:{0}".format(tag) for tag in "012"] +
+                         ["Simulate deletion of ns1/repo1:0"], self.simulated(output))
+
+    def test_malformed_policy_files_are_rejected(self):
+        for policy in ([{"repositories": "."}], {"rules": {"repositories": "."}}, {"rules": ["^ns0/"]}):
+            with open(self.policy, "w") as stream:
+                json.dump(policy, stream)
+            with self.assertRaises(ValueError):
+                clean_old_versions.load_policy(self.policy, NOW)
+
+    def test_keep_newer_than_counts_in_utc(self):
+        created = (datetime.utcnow() - timedelta(hours=1)).strftime(clean_old_versions.DATE_FORMAT)
+        snapshot = os.path.join(self.workdir, "catalog.json")
+        with open(snapshot, "w") as stream:
+            json.dump({"repositories": {"ns0/repo0": {"tags": ["new"], "created": {"new": created}}}}, stream)
+        with open(self.policy, "w") as policy:
+            json.dump({"rules": [{"repositories": ".", "keep_last": 0, "keep_newer_than": "2h"}]}, policy)
+        # fourteen hours ahead of UTC, local time would make the tag look older than two hours
+        output = subprocess.check_output([sys.executable, SCRIPT, "--policy", self.policy, "--dry-run",
+                                          "--catalog", snapshot], stderr=subprocess.STDOUT,
+                                         env=dict(os.environ, TZ="Etc/GMT-14")).decode()
+        self.assertEqual([], self.simulated(output))
+
+
+if __name__ == "__main__":
+    unittest.main()
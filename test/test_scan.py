@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Check that threaded scans of a registry find the same repositories and
+links as serial ones, also with repositories linked into the tree.
+"""
+
+import os
+import shutil
+import unittest
+
+from registry_testing import RegistryTreeTest, cleaner_module
+
+
+def scan(root, jobs):
+    """the scans a delete run does: repository discovery, link index and all links"""
+    cleaner = cleaner_module.RegistryCleaner(root, jobs=jobs)
+    return {
+        "repositories": sorted(cleaner._get_repositories()),
+        "link_index": sorted((digest, sorted(entries)) for digest, entries in cleaner._build_link_index().items()),
+        "get_links": sorted(cleaner_module.get_links(os.path.join(root, "repositories"), jobs=jobs)),
+    }
+
+
+class ScanTest(RegistryTreeTest):
+
+    tree = {"repos": 12, "tags": 3, "layers": 3, "untagged": 1, "schema1_ratio": 0.3}
+
+    def test_threaded_scans_match_serial(self):
+        serial = scan(self.root, 1)
+        self.assertEqual(12, len(serial["repositories"]))
+        self.assertTrue(serial["link_index"])
+        for jobs in (2, 8):
+            self.assertEqual(serial, scan(self.root, jobs))
+
+    def test_linked_repositories_are_found(self):
+        elsewhere = os.path.join(self.workdir, "elsewhere")
+        os.makedirs(elsewhere)
+        repositories_dir = os.path.join(self.root, "repositories")
+        shutil.move(os.path.join(repositories_dir, "ns1"), os.path.join(elsewhere, "ns1"))
+        os.symlink(os.path.join(elsewhere, "ns1"), os.path.join(repositories_dir, "ns1"))
+        shutil.move(os.path.join(repositories_dir, "ns2/repo2"), os.path.join(elsewhere, "repo2"))
+        os.symlink(os.path.join(elsewhere, "repo2"), os.path.join(repositories_dir, "ns2/repo2"))
+
+        for jobs in (1, 8):
+            cleaner = cleaner_module.RegistryCleaner(self.root, jobs=jobs)
+            repositories = cleaner._get_repositories()
+            self.assertIn("ns1/repo1", repositories)
+            self.assertIn("ns2/repo2", repositories)
+            self.assertEqual(["0", "1", "2"], sorted(cleaner._get_tags("ns2/repo2")))
+            self.assertTrue(any(repo == "ns2/repo2" for _, entries in cleaner._build_link_index().items()
+                                for repo, _ in entries))
+        self.assertEqual(scan(self.root, 1), scan(self.root, 8))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Check the per-phase timings and counters of the cleaner and the JSON and
+Prometheus text files --stats-file writes.
+"""
+
+import json
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+from registry_testing import RegistryTreeTest, cleaner_module
+
+REPO = "ns0/repo0"
+SAMPLE = re.compile(r'^registry_cleaner_[a-z0-9_]+(\{phase="[a-z0-9_]+"\})? -?[0-9]+(\.[0-9]+)?$')
+
+
+class StatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = cleaner_module.Stats()
+        self.workdir = tempfile.mkdtemp(prefix="stats-test-")
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def fill(self):
+        cleaner_module.parallel_map(lambda _: self.stats.count("files_opened"), range(1000), 8)
+        self.stats.count("bytes_deleted", 123)
+        self.stats.count("s3_list_requests", 2)
+        for _ in range(3):
+            with self.stats.timer("delete"):
+                pass
+        with self.stats.timer("link_index"):
+            pass
+
+    def test_counters_add_up_across_threads(self):
+        self.fill()
+        data = self.stats.as_dict()
+        self.assertEqual(1000, data["counters"]["files_opened"])
+        self.assertEqual(123, data["counters"]["bytes_deleted"])
+        self.assertEqual(2, data["counters"]["s3_list_requests"])
+        self.assertEqual(0, data["counters"]["paths_deleted"])
+        self.assertEqual(3, data["phases"]["delete"]["calls"])
+        self.assertEqual(1, data["phases"]["link_index"]["calls"])
+
+        self.stats.reset()
+        self.assertEqual({}, self.stats.as_dict()["phases"])
+        self.assertEqual(set([0]), set(self.stats.as_dict()["counters"].values()))
+
+    def test_timed_adds_to_the_shared_stats(self):
+        @cleaner_module.timed("test_phase")
+        def work(value):
+            return value * 2
+
+        cleaner_module.stats.reset()
+        self.assertEqual(4, work(2))
+        work(3)
+        self.assertEqual(2, cleaner_module.stats.as_dict()["phases"]["test_phase"]["calls"])
+
+    def test_prometheus_text_format(self):
+        self.fill()
+        text = self.stats.to_prometheus(True)
+        self.assertTrue(text.endswith("\n"))
+        described = set()
+        samples = {}
+        for line in text.splitlines():
+            if line.startswith("# HELP "):
+                described.add(line.split()[2])
+            elif line.startswith("# TYPE "):
+                _, _, name, kind = line.split()
+                self.assertIn(name, described)
+                self.assertEqual("gauge", kind)
+            else:
+                self.assertRegex(line, SAMPLE)
+                name = line.split("{")[0].split()[0]
+                self.assertIn(name, described)
+                samples[line.rsplit(" ", 1)[0]] = float(line.rsplit(" ", 1)[1])
+        self.assertEqual(1000, samples["registry_cleaner_files_opened"])
+        self.assertEqual(2, samples["registry_cleaner_s3_list_requests"])
+        self.assertEqual(3, samples['registry_cleaner_phase_calls{phase="delete"}'])
+        self.assertIn('registry_cleaner_phase_seconds{phase="link_index"}', samples)
+        self.assertEqual(1, samples["registry_cleaner_last_run_success"])
+        self.assertIn("registry_cleaner_last_run_success 0", self.stats.to_prometheus(False).splitlines())
+
+    def test_file_format_follows_the_extension(self):
+        self.fill()
+        prom = os.path.join(self.workdir, "cleaner.prom")
+        self.stats.write(prom, True)
+        with open(prom) as stream:
+            self.assertEqual(self.stats.to_prometheus(True).splitlines()[:-1], stream.read().splitlines()[:-1])
+
+        path = os.path.join(self.workdir, "cleaner.json")
+        self.stats.write(path, False)
+        with open(path) as stream:
+            data = json.load(stream)
+        self.assertFalse(data["success"])
+        self.assertEqual(self.stats.as_dict()["counters"], data["counters"])
+        self.assertEqual(3, data["phases"]["delete"]["calls"])
+        self.assertEqual(["cleaner.json", "cleaner.prom"], sorted(os.listdir(self.workdir)))
+
+
+class CleanerStatsTest(RegistryTreeTest):
+
+    def test_counters_of_a_run(self):
+        cleaner = cleaner_module.RegistryCleaner(self.root)
+        cleaner.delete_repository_tag(REPO, "0")
+        planned = len(cleaner.plan)
+        total_bytes = sum(item[1] for item in cleaner.plan.items)
+        cleaner.execute_plan()
+        data = cleaner_module.stats.as_dict()
+        self.assertEqual(planned, data["counters"]["paths_planned"])
+        self.assertEqual(total_bytes, data["counters"]["bytes_deleted"])
+        self.assertTrue(data["counters"]["directories_listed"])
+        self.assertEqual(1, data["phases"]["delete"]["calls"])
+
+
+if __name__ == "__main__":
+    unittest.main()
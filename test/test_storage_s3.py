@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Run the cleaner against a registry stored in an S3 bucket stood in for by
+moto (pip install boto3 moto), comparing what is left with the same
+operations on a local copy; skipped if boto3 or moto are missing.
+"""
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from registry_testing import cleaner_module, files_under, quiet_cleaner
+from generate_registry_tree import generate_registry
+
+try:
+    import boto3
+    try:
+        from moto import mock_aws
+    except ImportError:
+        # moto before 5.0
+        from moto import mock_s3 as mock_aws
+except ImportError:
+    boto3 = None
+
+BUCKET = "registry"
+DATA_DIR = "/docker/registry/v2"
+REPO = "ns0/repo0"
+
+
+@unittest.skipIf(boto3 is None, "needs boto3 and moto")
+class S3StorageTest(unittest.TestCase):
+
+    def setUp(self):
+        quiet_cleaner()
+        cleaner_module.stats.reset()
+        self.mock = mock_aws()
+        self.mock.start()
+        os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+        self.client = boto3.client("s3", region_name="us-east-1")
+        self.client.create_bucket(Bucket=BUCKET)
+        self.root = tempfile.mkdtemp(prefix="registry-s3-test-")
+        generate_registry(self.root, repos=4, tags=3, layers=4, untagged=1, schema1_ratio=0.3)
+        for relpath in files_under(self.root):
+            with open(os.path.join(self.root, relpath), "rb") as stream:
+                self.client.put_object(Bucket=BUCKET, Key=DATA_DIR.strip("/") + "/" + relpath, Body=stream.read())
+        self.storage = cleaner_module.S3Storage(BUCKET, client=self.client, jobs=4)
+
+    def tearDown(self):
+        self.mock.stop()
+        shutil.rmtree(self.root)
+
+    def keys(self):
+        prefix = DATA_DIR.strip("/") + "/"
+        result = set()
+        for page in self.client.get_paginator("list_objects_v2").paginate(Bucket=BUCKET, Prefix=prefix):
+            result.update(entry["Key"][len(prefix):] for entry in page.get("Contents", ()))
+        return result
+
+    def assert_same_as_local(self, operation):
+        """run `operation` on the bucket and on the local tree, and compare what is left"""
+        operation(cleaner_module.RegistryCleaner(DATA_DIR, storage=self.storage, delete_jobs=2))
+        operation(cleaner_module.RegistryCleaner(self.root))
+        self.assertEqual(files_under(self.root), self.keys())
+
+    def test_delete_tag(self):
+        def delete_tag(cleaner):
+            cleaner.delete_repository_tag(REPO, "0")
+            cleaner.execute_plan()
+
+        self.assert_same_as_local(delete_tag)
+
+    def test_delete_entire_repository(self):
+        def delete_repository(cleaner):
+            cleaner.delete_entire_repository(REPO)
+            cleaner.execute_plan()
+            cleaner.prune()
+
+        self.assert_same_as_local(delete_repository)
+        self.assertFalse(any(key.startswith("repositories/" + REPO + "/") for key in self.keys()))
+
+    def test_untagged_and_garbage_collection(self):
+        def collect(cleaner):
+            cleaner.delete_untagged_repositories(cleaner.get_repositories_matching("."))
+            cleaner.garbage_collect()
+            cleaner.execute_plan()
+
+        self.assert_same_as_local(collect)
+
+    def test_deletes_are_batched(self):
+        self.storage.MAX_DELETE_KEYS = 5
+        keys = sorted(key for key in self.keys() if key.startswith("blobs/"))
+        paths = [os.path.dirname(os.path.join(DATA_DIR, key)) for key in keys[:12]]
+        self.assertEqual([None] * 12, self.storage.delete_trees(paths))
+        counters = cleaner_module.stats.as_dict()["counters"]
+        self.assertEqual(3, counters["s3_delete_requests"])
+        # the keys of blob directories are known without listing them
+        self.assertNotIn("s3_list_requests", counters)
+        self.assertEqual(set(keys[12:]), set(key for key in self.keys() if key.startswith("blobs/")))
+
+    def test_garbage_collection_sizes_come_from_listings(self):
+        def planned_sizes(storage_root, storage):
+            cleaner = cleaner_module.RegistryCleaner(storage_root, storage=storage)
+            cleaner.delete_entire_repository(REPO)
+            cleaner.execute_plan()
+            cleaner_module.stats.reset()
+            cleaner.garbage_collect()
+            return sorted((os.path.relpath(path, storage_root), size) for path, size, _, _, _ in cleaner.plan.items)
+
+        sizes = planned_sizes(DATA_DIR, self.storage)
+        self.assertNotIn("s3_head_requests", cleaner_module.stats.as_dict()["counters"])
+        self.assertTrue(sizes)
+        self.assertEqual(planned_sizes(self.root, None), sizes)
+
+    def test_plan_and_usage_match_local(self):
+        def plan(storage_root, storage):
+            output = io.StringIO()
+            cleaner = cleaner_module.RegistryCleaner(storage_root, dry_run=True, plan_output=output,
+                                                     storage=storage)
+            cleaner.delete_untagged(REPO)
+            cleaner.plan_writer.close()
+            return sorted(output.getvalue().splitlines()), cleaner.usage()
+
+        self.assertEqual(plan(self.root, None), plan(DATA_DIR, self.storage))
+
+    def test_index_file_needs_directories(self):
+        with self.assertRaises(cleaner_module.RegistryCleanerError):
+            cleaner_module.RegistryCleaner(DATA_DIR, storage=self.storage,
+                                           index_file=os.path.join(self.root, "index.sqlite"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Check that deleting revisions removes their entries from the index of every
+tag, through the tag index map listed once per run.
+"""
+
+import glob
+import os
+import unittest
+
+from registry_testing import RegistryTreeTest, cleaner_module
+from generate_registry_tree import write_link
+
+REPO = "ns0/repo0"
+
+
+class ListingStorage(cleaner_module.LocalStorage):
+    """local storage remembering every directory listed"""
+
+    def __init__(self):
+        self.listed = []
+
+    def list_dir(self, path):
+        self.listed.append(path)
+        return cleaner_module.LocalStorage.list_dir(self, path)
+
+
+class TagIndexTest(RegistryTreeTest):
+
+    def setUp(self):
+        RegistryTreeTest.setUp(self)
+        self.tags_dir = os.path.join(self.root, "repositories", REPO, "_manifests/tags")
+        self.tagged = dict((tag, cleaner_module.get_digest_from_blob(os.path.join(self.tags_dir, tag, "current/link")))
+                           for tag in os.listdir(self.tags_dir))
+        revisions = os.listdir(os.path.join(self.root, "repositories", REPO, "_manifests/revisions/sha256"))
+        self.untagged = sorted(set(revisions) - set(self.tagged.values()))
+        # tags 1 and 2 pointed to the untagged revisions before, so their indexes still name them
+        for tag in ("1", "2"):
+            for digest in self.untagged:
+                write_link(os.path.join(self.tags_dir, tag, "index/sha256", digest), digest)
+
+    def index_entries(self, digest):
+        return sorted(glob.glob(os.path.join(self.tags_dir, "*/index/sha256", digest)))
+
+    def test_untagged_revisions_leave_every_tag_index(self):
+        cleaner = cleaner_module.RegistryCleaner(self.root)
+        cleaner.delete_untagged(REPO)
+        planned = sorted(path for path, _, kind, _, _ in cleaner.plan.items if kind == "tag_index")
+        self.assertEqual(sorted(entry for digest in self.untagged for entry in self.index_entries(digest)), planned)
+
+        tag_index = cleaner._tag_indexes[REPO]
+        for digest in self.untagged:
+            self.assertNotIn(cleaner_module.pack_digest(digest), tag_index)
+        for digest in self.tagged.values():
+            self.assertIn(cleaner_module.pack_digest(digest), tag_index)
+
+        cleaner.execute_plan()
+        for digest in self.untagged:
+            self.assertEqual([], self.index_entries(digest))
+        for tag, digest in self.tagged.items():
+            self.assertEqual([os.path.join(self.tags_dir, tag, "index/sha256", digest)], self.index_entries(digest))
+
+    def test_tag_index_is_listed_once_per_run(self):
+        storage = ListingStorage()
+        cleaner = cleaner_module.RegistryCleaner(self.root, storage=storage)
+        cleaner.delete_repository_tag(REPO, "0")
+        cleaner.delete_untagged(REPO)
+        index_dirs = [path for path in storage.listed if path.endswith(os.path.join("index", "sha256"))]
+        self.assertEqual(sorted(set(index_dirs)), sorted(index_dirs))
+        self.assertEqual(len(self.tagged), len(index_dirs))
+
+        cleaner.reset_run_state()
+        self.assertEqual({}, cleaner._tag_indexes)
+
+
+if __name__ == "__main__":
+    unittest.main()
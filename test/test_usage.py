@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Check the storage accounting of the cleaner's --usage mode against what
+deleting each repository and tag would reclaim.
+"""
+
+import io
+import shutil
+import tempfile
+import unittest
+
+from registry_testing import cleaner_module, quiet_cleaner
+from generate_registry_tree import generate_registry
+
+
+class UsageTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        quiet_cleaner()
+        cls.root = tempfile.mkdtemp(prefix="registry-usage-test-")
+        generate_registry(cls.root, repos=5, tags=3, layers=4, shared_ratio=0.5, untagged=1, schema1_ratio=0.3)
+        cls.report = cleaner_module.RegistryCleaner(cls.root, jobs=3).usage()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.root)
+
+    def reclaimed_by(self, operation):
+        """bytes a dry run of `operation` plans to delete"""
+        cleaner = cleaner_module.RegistryCleaner(self.root, dry_run=True, plan_output=io.StringIO())
+        operation(cleaner)
+        return cleaner.plan_writer.close()["reclaimable_bytes"]
+
+    def test_exclusive_bytes_are_reclaimed_by_deleting_repository(self):
+        for repo in self.report["repositories"]:
+            self.assertEqual(repo["exclusive_bytes"], self.reclaimed_by(
+                lambda cleaner: cleaner.delete_entire_repository(repo["repository"])))
+
+    def test_exclusive_bytes_are_reclaimed_by_deleting_tag(self):
+        for repo in self.report["repositories"]:
+            for tag in repo["tags"]:
+                self.assertEqual(tag["exclusive_bytes"], self.reclaimed_by(
+                    lambda cleaner: cleaner.delete_repository_tag(repo["repository"], tag["tag"])))
+
+    def test_apportioned_bytes_add_up_to_bytes_in_use(self):
+        in_use = self.report["total_bytes"] - self.report["unreferenced_bytes"]
+        apportioned = sum(repo["apportioned_bytes"] for repo in self.report["repositories"])
+        self.assertAlmostEqual(in_use, apportioned, delta=len(self.report["repositories"]))
+        self.assertTrue(any(repo["shared_bytes"] for repo in self.report["repositories"]))
+
+    def test_repositories_sorted_by_exclusive_bytes(self):
+        exclusive = [repo["exclusive_bytes"] for repo in self.report["repositories"]]
+        self.assertEqual(sorted(exclusive, reverse=True), exclusive)
+
+    def test_table_lists_every_tag(self):
+        stream = io.StringIO()
+        cleaner_module.write_usage(self.report, stream)
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(1 + 5 + 5 * 3 + 1, len(lines))
+
+
+if __name__ == "__main__":
+    unittest.main()